@@ -11,149 +11,96 @@ import os
 import io
 import uuid
 import base64
+import hashlib
 import datetime as dt
 import time
-import requests
+import random
+import email.utils
+import json
+import threading
+import numpy as np
 import pandas as pd
 import streamlit as st
 import matplotlib.pyplot as plt
+import altair as alt
 import math  # 復習間隔の計算で使用
 import re    # トピック抽出で使用（既にあれば重複OK）
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Dict, Any
-from ui import inject_global_css, render_header, metric_card
+from types import SimpleNamespace
+from typing import Dict, Any
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from ui import inject_global_css, render_header, metric_card, history_card_html
 from collections import Counter, defaultdict
 from utils import save_to_azure_blob_csv_append
 from utils import (
     run_ocr,
     summarize_text,
     save_to_azure_blob_csv_append,
-    load_csv_from_blob,
+    migrate_csv_to_append_blob,
+    make_history_store,
+    HistoryStore,
+    SharedSnapshot,
+    HistoryOverlay,
+    RecordStore,
+    NgramIndex,
+    TimeSubjectIndex,
+    LruCache,
+    DiskLruCache,
+    BlobCache,
+    TieredCache,
+    content_key,
+    ResponseCache,
+    http_session,
+    iter_chat_deltas,
+    stream_to_placeholder,
+    preprocess_image,
+    OcrEngine,
+    EasyOcrEngine,
+    pack_chunks,
+    QuizBank,
+    Rollups,
+    ReviewScheduler,
+    read_json_blob,
+    update_json_blob,
+    delete_json_blob,
+    CsvHistoryStore,
+    PatchLog,
+    WriteBehindQueue,
+    JobRunner,
+    append_rows_to_azure_blob_csv,
 )
-from utils import load_csv_from_blob
-
-def load_records_from_blob(blob_name: str = "studyrecord_history.csv") -> list:
-    """Azure Blob 上の CSV を読み込み、OcrRecord のリストにして返す"""
-
-    try:
-        df = load_csv_from_blob(blob_name)
-    except Exception as e:
-        print("[load_records_from_blob] load error:", e)
-        return []
-
-    if df is None or df.empty:
-        return []
-
-    records = []
-    for _, row in df.iterrows():
-        try:
-            rec = OcrRecord(
-                id=row.get("id", ""),
-                created_at=row.get("created_at", ""),
-                filename=row.get("filename", ""),
-                text=row.get("text", ""),
-                summary=row.get("summary", ""),
-                subject=row.get("subject", "未分類"),
-                meta={},  # CSVに保存していないので空dictでOK
-            )
-            records.append(rec)
-        except Exception as e:
-            print("[load_records_from_blob] row convert error:", e)
-
-    return records
 
+def records_from_frame(df) -> RecordStore:
+    """履歴の DataFrame を列指向の RecordStore にする（行ごとの変換はしない）"""
+    return RecordStore.from_frame(df, RECORD_SCHEMA)
 
 
-
-import re
-
-def _clean_for_card(text: str | None) -> str:
-    if not isinstance(text, str) or not text.strip():
-        return ""
-    t = text
-
-    # よく混ざってくる HTML 断片を丸ごと除去
-    t = re.sub(r"<details.*?</details>", "", t, flags=re.S | re.I)
-    t = re.sub(r'<div\s+class="sr-sec".*?</div>', "", t, flags=re.S | re.I)
-    t = re.sub(r'<div\s+class="box".*?</div>', "", t, flags=re.S | re.I)
-
-    # ``` ～ ``` のコードブロックも消す
-    t = re.sub(r"```.*?```", "", t, flags=re.S)
-
-    # もし残りのタグも全部いらないならコメントアウト解除
-    # t = re.sub(r"<[^>]+>", "", t)
-
-    # 余分な空白を整理
-    lines = [ln.strip() for ln in t.splitlines()]
-    t = "\n".join([ln for ln in lines if ln])  # 空行削除
-    return t.strip()
-
-
-
-# --- fallback for render_history_card (safe & signature-agnostic) ---
-try:
-    # ui.py 等に本実装がある場合はそちらを優先
-    from ui import render_history_card  # 無ければ except に落ちる
-except Exception:
-    import streamlit as st
-
-import re  # ← ファイルの先頭付近で1回だけでOK（まだなければ追加）
-
-def render_history_card(*args, **kwargs):
-    import re, html, streamlit as st
-
-    def _clean_html(text: str | None) -> str:
-        if not text: return ""
-        t = re.sub(r"<details.*?</details>", "", text, flags=re.S)
-        t = re.sub(r"<div.*?</div>", "", t, flags=re.S)
-        t = re.sub(r"```.*?```", "", t, flags=re.S)
-        t = re.sub(r"<[^>]+>", "", t)
-        return t.strip()
-
-    def _to_html(text: str) -> str:
-        if not text: return ""
-        esc = html.escape(text)
-        lines = [ln.strip() for ln in esc.splitlines() if ln.strip()]
-        if any(ln[:1] in ("・","-","•","*") for ln in lines):
-            items = []
-            for ln in lines:
-                items.append(f"<li>{(ln[1:] if ln[:1] in ('・','-','•','*') else ln).strip()}</li>")
-            return "<ul>" + "".join(items) + "</ul>"
-        return "<p>" + "<br>".join(lines) + "</p>"
-
-    # 引数取り出し
-    title    = kwargs.get("title") or "Record"
-    meta     = kwargs.get("meta") or ""
-    summary  = _clean_html(kwargs.get("summary") or "")
-    fulltext = _clean_html(kwargs.get("fulltext") or "")
-
-    # f文字列で使う値はここで生成（←重要）
-    title_html   = html.escape(title)
-    meta_html    = html.escape(meta)
-    summary_html = _to_html(summary)
-    full_html    = _to_html(fulltext)
-
-    # 付箋カード（インラインCSS・関数“内側”）
-    html_block = f"""
-    <div style="background:#FFF7C2;border:1px solid #F3E19A;border-radius:12px;
-                padding:16px 18px;box-shadow:0 6px 20px rgba(0,0,0,.08);
-                position:relative;margin:8px 0 14px;">
-      <div style="position:absolute;top:-12px;left:50%;transform:translateX(-50%) rotate(-2deg);
-                  width:120px;height:18px;background:rgba(255,235,130,.95);
-                  box-shadow:0 2px 6px rgba(0,0,0,.15);border-radius:2px;"></div>
-
-      <div style="font-weight:700;font-size:1rem;margin:0 0 2px;">{title_html}</div>
-      {f'<div style="font-size:.825rem;color:#6b7280;margin:0 0 10px;">{meta_html}</div>' if meta_html else ''}
-      {f'<div>{summary_html}</div>' if summary_html else ''}
-      {f'<details style="margin-top:10px;"><summary>全文を表示</summary><div style="margin-top:8px;white-space:pre-wrap;">{full_html}</div></details>' if full_html else ''}
-    </div>
+def card_html(rec, fulltext: str = "") -> str:
     """
-    st.markdown(html_block, unsafe_allow_html=True)
-
-
-
+    履歴カードの HTML。サニタイズ・HTML 生成は (id, 内容のハッシュ) ごとに1回だけ行い、
+    結果はプロセス共有の LRU に置く。
+    """
+    meta = f"科目: {rec.subject} ｜ 作成日: {rec.created_at} ｜ ID: {rec.id}"
+    title = rec.filename or "Record"
+    summary = rec.summary or ""
+    digest = hashlib.blake2b(
+        "\0".join((title, meta, summary, fulltext)).encode("utf-8"), digest_size=16
+    ).hexdigest()
+    return _card_html_cache().get_or_set(
+        (rec.id, digest),
+        lambda: history_card_html(title=title, meta=meta, summary=summary, fulltext=fulltext),
+    )
 
 
+def render_history_cards(records, expanded: set) -> None:
+    """カードを CARD_BATCH_SIZE 枚ずつまとめて1回の markdown で送る"""
+    blocks = [
+        card_html(rec, record_text(rec) if rec.id in expanded else "")
+        for rec in records
+    ]
+    for i in range(0, len(blocks), CARD_BATCH_SIZE):
+        st.markdown("\n".join(blocks[i:i + CARD_BATCH_SIZE]), unsafe_allow_html=True)
 
 
 # =====================
@@ -171,6 +118,104 @@ AZURE_OPENAI_KEY = st.secrets.get("AZURE_OPENAI_API_KEY", "")
 AZURE_OPENAI_DEPLOYMENT = st.secrets.get("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-35-turbo")
 AZURE_OPENAI_API_VERSION = st.secrets.get("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
 
+# Read API のポーリング: 初回の待ち時間・最大間隔・締め切り（基本＋1ページあたり）
+OCR_POLL_INITIAL_SECONDS = float(st.secrets.get("OCR_POLL_INITIAL_SECONDS", 0.25))
+OCR_POLL_MAX_INTERVAL_SECONDS = float(st.secrets.get("OCR_POLL_MAX_INTERVAL_SECONDS", 2.0))
+OCR_TIMEOUT_BASE_SECONDS = float(st.secrets.get("OCR_TIMEOUT_BASE_SECONDS", 20))
+OCR_TIMEOUT_PER_PAGE_SECONDS = float(st.secrets.get("OCR_TIMEOUT_PER_PAGE_SECONDS", 10))
+
+# OCR 結果キャッシュ（画像の SHA-256 ＋ 言語 ＋ エンジン版）
+OCR_LANGUAGE = "ja"
+OCR_ENGINE_VERSION = "azure-read-v3.2"
+CACHE_DIR = st.secrets.get("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+OCR_CACHE_MAX_MB = int(st.secrets.get("OCR_CACHE_MAX_MB", 256))
+
+# OCR エンジン: "azure"（Read API）/ "easyocr"（CPU ローカル）/ "auto"（Azure が未設定・遅い・失敗なら easyocr）
+OCR_ENGINE = st.secrets.get("OCR_ENGINE", "azure")
+OCR_FALLBACK_TIMEOUT_SECONDS = float(st.secrets.get("OCR_FALLBACK_TIMEOUT_SECONDS", 15))
+EASYOCR_LANGUAGES = tuple(st.secrets.get("EASYOCR_LANGUAGES", ["ja", "en"]))
+
+# OCR 前の画像の前処理（向き補正・縮小・グレースケール・コントラスト補正・JPEG 再圧縮）
+OCR_PREPROCESS = bool(st.secrets.get("OCR_PREPROCESS", True))
+OCR_PREPROCESS_OPTIONS = {
+    "max_side": int(st.secrets.get("OCR_MAX_SIDE", 2200)),
+    "grayscale": bool(st.secrets.get("OCR_GRAYSCALE", True)),
+    "autocontrast": bool(st.secrets.get("OCR_AUTOCONTRAST", True)),
+    "quality": int(st.secrets.get("OCR_JPEG_QUALITY", 85)),
+}
+
+# クイズ生成: 1チャンクのトークン予算・必要数に対する候補の倍率・同時生成数
+QUIZ_CHUNK_TOKENS = int(st.secrets.get("QUIZ_CHUNK_TOKENS", 1500))
+QUIZ_OVERSAMPLE = float(st.secrets.get("QUIZ_OVERSAMPLE", 1.5))
+QUIZ_MAX_WORKERS = int(st.secrets.get("QUIZ_MAX_WORKERS", 6))
+
+# 科目ごとのクイズバンク（バックグラウンドで事前生成しておく問題数の目安）
+QUIZ_BANK_ENABLED = bool(st.secrets.get("QUIZ_BANK_ENABLED", True))
+QUIZ_BANK_TARGET = int(st.secrets.get("QUIZ_BANK_TARGET", 30))
+QUIZ_BANK_PER_NOTE = int(st.secrets.get("QUIZ_BANK_PER_NOTE", 3))  # 1回の補充で1ノートから作る問題数の上限
+
+# 進捗グラフの描き方: "altair"（ブラウザ側で描画）/ "png"（matplotlib で描いた画像をキャッシュ）
+PROGRESS_CHART_BACKEND = st.secrets.get("PROGRESS_CHART_BACKEND", "altair")
+
+# 要約・クイズの応答キャッシュの有効期間（時間）
+LLM_CACHE_TTL_HOURS = float(st.secrets.get("LLM_CACHE_TTL_HOURS", 168))
+
+# 複数枚アップロード時の同時処理数とプレビュー枚数
+OCR_MAX_WORKERS = int(st.secrets.get("OCR_MAX_WORKERS", 6))
+OCR_PREVIEW_MAX = 8
+
+# OCR ジョブの状態表示の更新間隔（秒）と、終わったジョブをジョブ表に残す時間（秒）
+JOB_POLL_SECONDS = float(st.secrets.get("JOB_POLL_SECONDS", 1.0))
+JOB_RETAIN_SECONDS = float(st.secrets.get("JOB_RETAIN_SECONDS", 3600))
+
+# 履歴の保存先: "parquet"（月別シャード＋マニフェスト）/ "csv"（従来の単一CSV）
+HISTORY_STORE_KIND = st.secrets.get("HISTORY_STORE", "parquet")
+HISTORY_BLOB = "studyrecord_history.csv"
+QUIZ_HISTORY_BLOB = "studyrecord_quiz_history.csv"
+ROLLUP_BLOB = "studyrecord_rollups.json"  # 進捗タブ用の集計（日×科目の件数・クイズの成績）
+REVIEW_STATE_BLOB = "studyrecord_review_state.json"  # ノートごとの間隔反復（SM-2）の状態
+QUIZ_PATCH_BLOB = "studyrecord_quiz_history.patches.csv"  # 復習クイズ履歴の削除（トゥームストーン）
+
+# 保存の後回し（ライトビハインド）: ローカルのジャーナルに書いてすぐ返し、裏でまとめて Blob に書く
+WRITE_BEHIND_ENABLED = bool(st.secrets.get("WRITE_BEHIND_ENABLED", True))
+WRITE_BEHIND_INTERVAL_SECONDS = float(st.secrets.get("WRITE_BEHIND_INTERVAL_SECONDS", 1.0))
+WRITE_BEHIND_BATCH = int(st.secrets.get("WRITE_BEHIND_BATCH", 200))
+
+# 削除・修正のパッチを本体に畳み込む間隔（秒）と、このプロセスで何件溜まったら早めに畳み込むか
+COMPACTION_INTERVAL_SECONDS = float(st.secrets.get("COMPACTION_INTERVAL_SECONDS", 3600))
+PATCH_COMPACT_THRESHOLD = int(st.secrets.get("PATCH_COMPACT_THRESHOLD", 50))
+
+# 列指向ストアのスキーマ（列名 → 既定値）
+RECORD_SCHEMA = {"id": "", "created_at": "", "filename": "", "text": "", "summary": "", "subject": "未分類",
+                 "updated_at": ""}
+QUIZ_LOG_SCHEMA = {
+    "id": "", "created_at": "", "subject": "", "total": 0, "answered": 0,
+    "correct_count": 0, "rate": 0.0, "comment": "",
+}
+
+# 起動時に読む列（OCR全文は表示・検索するときに遅延取得する）
+RECORD_LIST_COLUMNS = ["id", "created_at", "filename", "summary", "subject", "updated_at"]
+
+# 一覧の既定で読む履歴の月数（古い月は「古い履歴も読み込む」で取りに行く。0 なら最初から全件）
+HISTORY_RECENT_MONTHS = int(st.secrets.get("HISTORY_RECENT_MONTHS", 3))
+
+# 履歴タブの1ページあたりの件数（既定）
+HISTORY_PAGE_SIZE = int(st.secrets.get("HISTORY_PAGE_SIZE", 20))
+
+# 履歴カード HTML のキャッシュ件数と、1回の markdown にまとめる枚数
+CARD_CACHE_SIZE = int(st.secrets.get("CARD_CACHE_SIZE", 2000))
+CARD_BATCH_SIZE = 10
+
+# キーワード検索の対象列
+SEARCH_FIELDS = ("filename", "text", "summary")
+# 索引の入れ直しが要るかを比べる列（全文は一覧に無いので、修正時に付く updated_at で見る）
+SEARCH_SIGNATURE = ("filename", "summary", "updated_at")
+# 検索索引が手元に置く本文の件数（残りは検索の最後の確認のときにストアから取り直す）
+SEARCH_TEXT_CACHE_SIZE = int(st.secrets.get("SEARCH_TEXT_CACHE_SIZE", 2000))
+
+# 共有スナップショットの ETag 再検証の最短間隔（秒）
+SNAPSHOT_REVALIDATE_SECONDS = float(st.secrets.get("SNAPSHOT_REVALIDATE_SECONDS", 10))
+
 # ===== utils.py が参照する環境変数にも同じ値を渡す =====
 import os
 
@@ -185,6 +230,10 @@ os.environ["AZURE_OPENAI_API_KEY"] = st.secrets.get("AZURE_OPENAI_API_KEY", "")
 os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"] = st.secrets.get("AZURE_OPENAI_DEPLOYMENT_NAME", "")
 os.environ["AZURE_OPENAI_API_VERSION"] = st.secrets.get("AZURE_OPENAI_API_VERSION", "")
 
+# 共有 HTTP / Blob クライアントの接続プールの大きさとリトライ回数
+os.environ["HTTP_POOL_SIZE"] = str(st.secrets.get("HTTP_POOL_SIZE", 16))
+os.environ["HTTP_RETRY_TOTAL"] = str(st.secrets.get("HTTP_RETRY_TOTAL", 3))
+
 
 # =====================
 # データモデル
@@ -205,145 +254,187 @@ class OcrRecord:
 def _now_iso() -> str:
     return dt.datetime.now().isoformat(timespec="seconds")
 
-def df_from_records(records: List[OcrRecord]) -> pd.DataFrame:
-    if not records:
-        return pd.DataFrame(columns=["id", "created_at", "filename", "text", "summary", "subject"])
-    return pd.DataFrame([{
-        "id": r.id,
-        "created_at": r.created_at,
-        "filename": r.filename,
-        "text": r.text,
-        "summary": r.summary,
-        "subject": r.subject,
-    } for r in records])
-
 # =====================
 # Azure 関数
 # =====================
-def run_azure_ocr(image_bytes: bytes) -> str:
-    """Azure Computer Vision Read API v3.2 を使って OCR"""
+def _retry_after_seconds(resp) -> float | None:
+    """Retry-After ヘッダ（秒数 または HTTP 日付）を秒に直す"""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (when - dt.datetime.now(when.tzinfo)).total_seconds())
+    except Exception:
+        return None
+
+
+def _read_result_text(data: dict) -> str:
+    lines = []
+    try:
+        for readres in data["analyzeResult"]["readResults"]:
+            for line in readres.get("lines", []):
+                lines.append(line.get("text", ""))
+    except Exception:
+        pass
+    return "\n".join(lines).strip()
+
+
+def run_azure_ocr(image_bytes: bytes, *, pages: int = 1, stats: dict | None = None,
+                  timeout: float | None = None) -> str:
+    """
+    Azure Computer Vision Read API v3.2 を使って OCR。
+    ポーリングは短い間隔から指数バックオフ（ジッタ付き）で伸ばし、Retry-After があればそれ以上待つ。
+    締め切りはページ数に応じて延ばす（timeout を渡すとそちらを使う）。stats を渡すとポーリング回数などを書き込む。
+    """
     if not AZURE_CV_ENDPOINT or not AZURE_CV_KEY:
         return "(Azure CV 未設定)"
+    stats = stats if stats is not None else {}
+    session = http_session()
+    started = time.monotonic()
+    if timeout is None:
+        timeout = OCR_TIMEOUT_BASE_SECONDS + OCR_TIMEOUT_PER_PAGE_SECONDS * max(1, pages)
+    deadline = started + timeout
+
     analyze_url = AZURE_CV_ENDPOINT.rstrip("/") + "/vision/v3.2/read/analyze?language=ja"
     headers = {
         "Ocp-Apim-Subscription-Key": AZURE_CV_KEY,
         "Content-Type": "application/octet-stream",
     }
-    resp = requests.post(analyze_url, headers=headers, data=image_bytes, timeout=30)
+    for _ in range(5):
+        resp = session.post(analyze_url, headers=headers, data=image_bytes, timeout=30)
+        if resp.status_code != 429:
+            break
+        wait = _retry_after_seconds(resp) or 1.0
+        if time.monotonic() + wait > deadline:
+            break
+        time.sleep(wait)
     resp.raise_for_status()
     op_location = resp.headers.get("Operation-Location")
     if not op_location:
         raise RuntimeError("Operation-Location ヘッダがありません。")
 
-    for _ in range(40):
-        time.sleep(0.5)
-        poll = requests.get(op_location, headers={"Ocp-Apim-Subscription-Key": AZURE_CV_KEY}, timeout=30)
+    delay = OCR_POLL_INITIAL_SECONDS
+    retry_after = _retry_after_seconds(resp)
+    polls = 0
+    while True:
+        wait = delay * random.uniform(0.8, 1.2)
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        if time.monotonic() + wait > deadline:
+            stats.update(polls=polls, seconds=time.monotonic() - started, status="timeout")
+            raise TimeoutError(f"OCR のポーリングがタイムアウトしました（{polls} 回）。")
+        time.sleep(wait)
+
+        poll = session.get(op_location, headers={"Ocp-Apim-Subscription-Key": AZURE_CV_KEY}, timeout=30)
+        polls += 1
+        retry_after = _retry_after_seconds(poll)
+        delay = min(delay * 1.6, OCR_POLL_MAX_INTERVAL_SECONDS)
+        if poll.status_code == 429:
+            continue
         poll.raise_for_status()
         data = poll.json()
         status = data.get("status")
         if status == "succeeded":
-            lines = []
-            try:
-                for readres in data["analyzeResult"]["readResults"]:
-                    for line in readres.get("lines", []):
-                        lines.append(line.get("text", ""))
-            except Exception:
-                pass
-            return "\n".join(lines).strip()
+            stats.update(polls=polls, seconds=time.monotonic() - started, status=status)
+            return _read_result_text(data)
         if status == "failed":
+            stats.update(polls=polls, seconds=time.monotonic() - started, status=status)
             raise RuntimeError(f"OCR が失敗しました: {data}")
-    raise TimeoutError("OCR のポーリングがタイムアウトしました。")
 
-def run_azure_summary(text: str) -> str:
-    """Azure OpenAI (Chat Completions) で要約"""
-    if not AZURE_OPENAI_ENDPOINT or not AZURE_OPENAI_KEY or not AZURE_OPENAI_DEPLOYMENT:
-        return "(Azure OpenAI 未設定)"
-    url = (AZURE_OPENAI_ENDPOINT.rstrip("/") +
-           f"/openai/deployments/{AZURE_OPENAI_DEPLOYMENT}/chat/completions?api-version={AZURE_OPENAI_API_VERSION}")
+@st.cache_resource(show_spinner=False)
+def _llm_cache() -> ResponseCache:
+    """要約・クイズの応答キャッシュ（ディスクに保存するので再起動後も使える）"""
+    return ResponseCache(os.path.join(CACHE_DIR, "llm"), ttl_seconds=LLM_CACHE_TTL_HOURS * 3600)
+
+
+def _chat_url() -> str:
+    return (
+        AZURE_OPENAI_ENDPOINT.rstrip("/")
+        + f"/openai/deployments/{AZURE_OPENAI_DEPLOYMENT}/chat/completions"
+        + f"?api-version={AZURE_OPENAI_API_VERSION}"
+    )
+
+
+def _post_chat(payload: dict) -> str:
+    """Chat Completions を呼んで本文を返す（HTTP エラーは例外）"""
     headers = {
         "api-key": AZURE_OPENAI_KEY,
         "Content-Type": "application/json",
     }
-    payload = {
-        "messages": [
-            {"role": "system", "content": "あなたは有能な日本語アシスタントです。OCR結果を箇条書きで簡潔に要約してください。"},
-            {"role": "user", "content": f"次のOCRテキストを要約:\n{text}"}
-        ],
-        "temperature": 0.2,
-        "max_tokens": 400,
-    }
-    resp = requests.post(url, headers=headers, json=payload, timeout=60)
+    resp = http_session().post(_chat_url(), headers=headers, json=payload, timeout=60)
     resp.raise_for_status()
     data = resp.json()
     try:
         return data["choices"][0]["message"]["content"].strip()
     except Exception:
         return ""
-    
-def run_azure_quiz(text: str, subject: str, num_questions: int = 3) -> list[dict]:
-    """Azure OpenAI で4択クイズを生成する"""
-
-    import json
-    if not AZURE_OPENAI_ENDPOINT or not AZURE_OPENAI_KEY or not AZURE_OPENAI_DEPLOYMENT:
-        return []
 
 
-    if not AZURE_OPENAI_ENDPOINT or not AZURE_OPENAI_KEY or not AZURE_OPENAI_DEPLOYMENT:
-        # 設定されてない場合は何も返さない
-        return []
-
-    # モデルのエンドポイント（要約と同じ形式）
-    url = (
-        AZURE_OPENAI_ENDPOINT.rstrip("/")
-        + f"/openai/deployments/{AZURE_OPENAI_DEPLOYMENT}/chat/completions"
-        + f"?api-version={AZURE_OPENAI_API_VERSION}"
-    )
+def _stream_chat(payload: dict, placeholder) -> str:
+    """stream=True で Chat Completions を呼び、届いた分から placeholder に書き出す"""
     headers = {
         "api-key": AZURE_OPENAI_KEY,
         "Content-Type": "application/json",
     }
+    with http_session().post(_chat_url(), headers=headers, json={**payload, "stream": True},
+                             timeout=60, stream=True) as resp:
+        resp.raise_for_status()
+        return stream_to_placeholder(iter_chat_deltas(resp.iter_lines()), placeholder)
 
-    system_msg = (
-        "あなたは高校生向けの日本語の家庭教師です。"
-        "与えられたテキストから、内容理解を確認するための4択クイズ問題を作成してください。"
-        "すべての出力は必ず JSON 配列形式にしてください。"
-        "各要素は {\"q\", \"correct\", \"choices\", \"ex\"} をキーに持ちます。"
-        "q: 問題文, correct: 正解の選択肢文字列, choices: 正解を含む4つの選択肢リスト,"
-        "ex: 正解の簡単な日本語解説です。"
-        "choices の順番はランダムで構いません。"
-        "マークダウンや説明文は一切書かず、純粋な JSON だけを返してください。"
+
+def cached_chat(payload: dict, *, regenerate: bool = False, accept=None, placeholder=None) -> str:
+    """
+    メッセージ・デプロイ名・API バージョン・サンプリング設定が同じなら、前回の応答をそのまま返す。
+    regenerate=True ならキャッシュを使わずに呼び直す。accept で使える応答だけを保存する。
+    placeholder を渡すと応答をストリーミングで受け取り、届いた分から表示する。
+    """
+    cache = _llm_cache()
+    fp = ResponseCache.fingerprint(
+        deployment=AZURE_OPENAI_DEPLOYMENT,
+        api_version=AZURE_OPENAI_API_VERSION,
+        payload=payload,
     )
+    if not regenerate:
+        hit = cache.get(fp)
+        if hit is not None:
+            if placeholder is not None:
+                placeholder.markdown(hit)
+            return hit
 
-    # 長すぎるとき用に一応切っておく
-    base_text = text[:4000]
+    content = _stream_chat(payload, placeholder) if placeholder is not None else _post_chat(payload)
+    if content and (accept is None or accept(content)):
+        cache.put(fp, content)
+    return content
 
-    user_msg = (
-        f"科目: {subject}\n"
-        f"問題数: {num_questions}\n\n"
-        "以下の内容から、高校生向けの4択クイズ問題を作ってください。\n\n"
-        f"{base_text}"
-    )
 
+def run_azure_summary(text: str, *, regenerate: bool = False, placeholder=None) -> str:
+    """
+    Azure OpenAI (Chat Completions) で要約（同じ入力ならキャッシュから返す）。
+    placeholder を渡すと生成中の要約を少しずつ表示する。
+    """
+    if not AZURE_OPENAI_ENDPOINT or not AZURE_OPENAI_KEY or not AZURE_OPENAI_DEPLOYMENT:
+        return "(Azure OpenAI 未設定)"
     payload = {
         "messages": [
-            {"role": "system", "content": system_msg},
-            {"role": "user", "content": user_msg},
+            {"role": "system", "content": "あなたは有能な日本語アシスタントです。OCR結果を箇条書きで簡潔に要約してください。"},
+            {"role": "user", "content": f"次のOCRテキストを要約:\n{text}"}
         ],
-        "temperature": 0.7,
-        "max_tokens": 800,
+        "temperature": 0.2,
+        "max_tokens": 400,
     }
+    return cached_chat(payload, regenerate=regenerate, placeholder=placeholder)
 
-    try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=60)
-        resp.raise_for_status()
-        data = resp.json()
-        content = data["choices"][0]["message"]["content"]
-    except Exception as e:
-        print("[run_azure_quiz] API error:", e)
-        return []
+
+def parse_quiz_content(content: str, num_questions: int) -> list[dict]:
+    """モデルの応答（JSON 配列）をクイズ問題のリストに整える"""
 
     # コードブロックで返ってきた場合のガード
-    content = content.strip()
+    content = (content or "").strip()
     if content.startswith("```"):
         lines = content.splitlines()
         # 先頭の ``` or ```json を削る
@@ -366,7 +457,7 @@ def run_azure_quiz(text: str, subject: str, num_questions: int = 3) -> list[dict
     for q in raw_questions[:num_questions]:
         question = q.get("q") or q.get("question")
         correct = q.get("correct") or q.get("answer")
-        choices = q.get("choices") or []
+        choices = list(q.get("choices") or [])
         ex = q.get("ex") or q.get("explanation") or ""
 
         if not question or not correct:
@@ -401,49 +492,346 @@ def run_azure_quiz(text: str, subject: str, num_questions: int = 3) -> list[dict
     return questions
 
 
-from utils import save_to_azure_blob_csv_append  # ← ファイル先頭で必ず import しておく
+def run_azure_quiz(text: str, subject: str, num_questions: int = 3, *, regenerate: bool = False) -> list[dict]:
+    """Azure OpenAI で4択クイズを生成する（同じ入力ならキャッシュから返す）"""
 
-def save_to_blob_csv(record: OcrRecord, blob_name: str = "studyrecord_history.csv") -> None:
-    """utils.py の関数を使って Azure Blob Storage 上の CSV に追記保存する"""
+    if not AZURE_OPENAI_ENDPOINT or not AZURE_OPENAI_KEY or not AZURE_OPENAI_DEPLOYMENT:
+        # 設定されてない場合は何も返さない
+        return []
 
-    row = {
-        "id": record.id,
-        "created_at": record.created_at,
-        "filename": record.filename,
-        "text": record.text,
-        "summary": record.summary,
-        "subject": record.subject,
+    system_msg = (
+        "あなたは高校生向けの日本語の家庭教師です。"
+        "与えられたテキストから、内容理解を確認するための4択クイズ問題を作成してください。"
+        "すべての出力は必ず JSON 配列形式にしてください。"
+        "各要素は {\"q\", \"correct\", \"choices\", \"ex\"} をキーに持ちます。"
+        "q: 問題文, correct: 正解の選択肢文字列, choices: 正解を含む4つの選択肢リスト,"
+        "ex: 正解の簡単な日本語解説です。"
+        "choices の順番はランダムで構いません。"
+        "マークダウンや説明文は一切書かず、純粋な JSON だけを返してください。"
+    )
+
+    # text は呼び出し側で QUIZ_CHUNK_TOKENS 以内に分割してある前提（generate_subject_quiz を参照）
+    user_msg = (
+        f"科目: {subject}\n"
+        f"問題数: {num_questions}\n\n"
+        "以下の内容から、高校生向けの4択クイズ問題を作ってください。\n\n"
+        f"{text}"
+    )
+
+    payload = {
+        "messages": [
+            {"role": "system", "content": system_msg},
+            {"role": "user", "content": user_msg},
+        ],
+        "temperature": 0.7,
+        # 1問（問題文・選択肢4つ・解説の JSON）あたりの出力を見込んで、問題数に合わせて上限を決める
+        "max_tokens": min(4000, 200 + 250 * num_questions),
     }
 
     try:
-        save_to_azure_blob_csv_append(blob_name, row)
+        content = cached_chat(
+            payload,
+            regenerate=regenerate,
+            accept=lambda c: bool(parse_quiz_content(c, num_questions)),
+        )
     except Exception as e:
-        print("[save_to_blob_csv] error:", e)
-from utils import save_to_azure_blob_csv_append  # ← ファイル先頭で必ず import しておく
+        print("[run_azure_quiz] API error:", e)
+        return []
 
-def save_to_blob_csv(record: OcrRecord, blob_name: str = "studyrecord_history.csv") -> None:
-    """utils.py の関数を使って Azure Blob Storage 上の CSV に追記保存する"""
+    return parse_quiz_content(content, num_questions)
 
-    row = {
-        "id": record.id,
-        "created_at": record.created_at,
-        "filename": record.filename,
-        "text": record.text,
-        "summary": record.summary,
-        "subject": record.subject,
-    }
 
+def _question_key(q: dict) -> str:
+    return re.sub(r"[\s、。,.?？!！「」『』()（）]", "", q["q"]).lower()
+
+
+def _is_near_duplicate(key: str, seen: list, threshold: float = 0.8) -> bool:
+    """問題文の文字バイグラムの Jaccard 係数で、言い回しだけ違う重複を落とす"""
+    grams = {key[i:i + 2] for i in range(max(1, len(key) - 1))}
+    for other in seen:
+        union = grams | other
+        if union and len(grams & other) / len(union) >= threshold:
+            return True
+    seen.append(grams)
+    return False
+
+
+class _ChunkCursors:
+    """科目ごとに、次のクイズ生成で使い始めるチャンクの位置（プロセス全体で共有するのでロックで守る）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cursors: dict = {}
+
+    def take(self, subject: str, count: int, size: int) -> int:
+        """size 個のチャンクから count 個使う。使い始める位置を返し、次の回のために進める"""
+        with self._lock:
+            start = self._cursors.get(subject, 0) % size
+            self._cursors[subject] = start + count
+            return start
+
+
+@st.cache_resource(show_spinner=False)
+def _quiz_chunk_cursors() -> _ChunkCursors:
+    return _ChunkCursors()
+
+
+def generate_subject_quiz(notes: list, subject: str, num_questions: int, *,
+                          regenerate: bool = False, per_note: bool = False) -> list[dict]:
+    """
+    科目のノート全体からクイズを作る（map-reduce）。
+    notes: [(レコードID, 要約や本文)] を QUIZ_CHUNK_TOKENS ごとのチャンクに分け、
+    必要な候補数ぶんのチャンクを前回の続きから選び、チャンクごとに候補問題を並列に生成
+    → 重複を除き → チャンクを巡回しながら num_questions 問を選ぶ。
+    各問題には出題元のレコード ID を source_ids として付ける。
+    per_note=True ならノートをまたいで詰めない（問題ごとの出題元が1ノートに絞れる）。
+    """
+    if per_note:
+        chunks = [c for note in notes for c in pack_chunks([note], QUIZ_CHUNK_TOKENS)]
+    else:
+        chunks = pack_chunks(notes, QUIZ_CHUNK_TOKENS)
+    if not chunks:
+        return []
+    # 使うチャンクは必要な候補数（num_questions × QUIZ_OVERSAMPLE）ぶんまで。
+    # ノートが多い科目でも全チャンクには投げず、前回の続きから巡回して選ぶ（回を重ねると全体から出題される）
+    wanted = max(1, math.ceil(num_questions * QUIZ_OVERSAMPLE))
+    if len(chunks) > wanted:
+        start = _quiz_chunk_cursors().take(subject, wanted, len(chunks))
+        chunks = [chunks[(start + i) % len(chunks)] for i in range(wanted)]
+    # チャンクが少ないときは1チャンクあたりの問題数を増やす（max_tokens は run_azure_quiz が問題数から決める）
+    per_chunk = max(1, math.ceil(wanted / len(chunks)))
+
+    def _map(chunk: list) -> list[dict]:
+        text = "\n\n".join(piece for _, piece in chunk)
+        source_ids = list(dict.fromkeys(rid for rid, _ in chunk))
+        qs = run_azure_quiz(text, subject, num_questions=per_chunk, regenerate=regenerate)
+        return [{**q, "source_ids": source_ids} for q in qs]
+
+    workers = max(1, min(QUIZ_MAX_WORKERS, len(chunks)))
+    with ThreadPoolExecutor(max_workers=workers, initializer=_attach_script_ctx,
+                            initargs=(get_script_run_ctx(),)) as ex:
+        candidates = list(ex.map(_map, chunks))
+
+    # 重複を除く（チャンク内・チャンク間とも）
+    seen_keys: set = set()
+    seen_grams: list = []
+    groups: list = []
+    for qs in candidates:
+        kept = []
+        for q in qs:
+            key = _question_key(q)
+            if key in seen_keys or _is_near_duplicate(key, seen_grams):
+                continue
+            seen_keys.add(key)
+            kept.append(q)
+        if kept:
+            groups.append(kept)
+
+    # チャンクの順番をばらしてから1問ずつ巡回して選ぶ（どのノートからも満遍なく出題する）
+    random.shuffle(groups)
+    picked: list[dict] = []
+    while groups and len(picked) < num_questions:
+        for g in list(groups):
+            if len(picked) >= num_questions:
+                break
+            picked.append(g.pop(random.randrange(len(g))))
+            if not g:
+                groups.remove(g)
+    return picked
+
+
+# =====================
+# クイズバンク（科目ごとの事前生成）
+# =====================
+@st.cache_resource(show_spinner=False)
+def _quiz_bank() -> QuizBank:
+    return QuizBank("quiz_bank", max_questions=max(60, 2 * QUIZ_BANK_TARGET))
+
+
+def _subject_notes(store: RecordStore, subject: str, only: set | None = None) -> list:
+    """科目のノートを [(レコードID, 要約 または 本文)] で返す（only を渡すとその ID だけ）"""
+    notes = []
+    for rec in store.where(store.column("subject") == subject):
+        if only is not None and rec.id not in only:
+            continue
+        t = rec.summary or record_text(rec)
+        if t:
+            notes.append((rec.id, t))
+    return notes
+
+
+def top_up_quiz_bank(subject: str, notes: list) -> None:
+    """
+    クイズバンクから出題元が変わった問題を外し、QUIZ_BANK_TARGET 問に足りない分だけ新しく作って足す。
+    ノート単位で作るので、1ノートの書き換えで外れる問題はそのノートの分だけ。
+    """
+    _quiz_bank().top_up(
+        subject, notes,
+        lambda picked, n: generate_subject_quiz(picked, subject, n, per_note=True),
+        key=_question_key, target=QUIZ_BANK_TARGET, per_note=QUIZ_BANK_PER_NOTE,
+    )
+
+
+class _QuizBankWorker:
+    """
+    クイズバンクの補充をプロセスで1本のスレッドで順に流す。
+    同じ科目の補充がまだ待っていれば1回にまとめる。ノートは動く直前に共有スナップショットから読む
+    （セッションには触らないので、保存したセッションが無くなっていても補充される）。
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quiz-bank")
+        self._pending: set = set()
+        self._lock = threading.Lock()
+
+    def submit(self, subject: str) -> None:
+        with self._lock:
+            if subject in self._pending:
+                return
+            self._pending.add(subject)
+        self._executor.submit(self._run, subject, get_script_run_ctx())
+
+    def _run(self, subject: str, ctx) -> None:
+        _attach_script_ctx(ctx)
+        with self._lock:
+            self._pending.discard(subject)
+        try:
+            notes = _subject_notes(_records_snapshot().get()[1], subject)
+            if notes:
+                top_up_quiz_bank(subject, notes)
+        except Exception as e:
+            print("[quiz_bank] top-up error:", subject, e)
+
+
+@st.cache_resource(show_spinner=False)
+def _quiz_bank_worker() -> _QuizBankWorker:
+    return _QuizBankWorker()
+
+
+def schedule_quiz_bank_top_up(subjects) -> None:
+    """科目ごとにクイズバンクの補充をバックグラウンドに積む（保存したノートが履歴ストアに入った後に呼ぶ）"""
+    if not QUIZ_BANK_ENABLED or not AZURE_STORAGE_CONNECTION_STRING or not AZURE_OPENAI_KEY:
+        return
+    for subject in subjects:
+        _quiz_bank_worker().submit(subject)
+
+
+def draw_from_quiz_bank(subject: str, notes: list, num_questions: int) -> list[dict]:
+    """クイズバンクから今も有効な問題を num_questions 問引く（足りなければ空）"""
+    if not QUIZ_BANK_ENABLED:
+        return []
+    hashes = {rid: QuizBank.note_hash(t) for rid, t in notes}
+    try:
+        pool = QuizBank.valid(_quiz_bank().load(subject), hashes)
+    except Exception as e:
+        print("[draw_from_quiz_bank] load error:", e)
+        return []
+    if len(pool) < num_questions:
+        return []
+    return random.sample(pool, num_questions)
+
+
+@st.cache_resource(show_spinner=False)
+def get_history_store() -> HistoryStore:
+    """OCR履歴のストア（プロセスで1つ）"""
+    return make_history_store(HISTORY_STORE_KIND, HISTORY_BLOB)
+
+
+@st.cache_resource(show_spinner=False)
+def quiz_store() -> CsvHistoryStore:
+    """復習クイズ履歴のストア（プロセスで1つ・削除はパッチで記録）"""
+    return CsvHistoryStore(QUIZ_HISTORY_BLOB, patches=PatchLog(QUIZ_PATCH_BLOB),
+                           default_columns=list(QUIZ_LOG_SCHEMA))
+
+
+def record_text(rec) -> str:
+    """OCR全文を返す。一覧読み込みで省いた全文はストアから取得する"""
+    text = getattr(rec, "text", "") or ""
+    rid = getattr(rec, "id", "")
+    if text or not rid:
+        return text
+    try:
+        return get_history_store().load_text([rid]).get(rid, "")
+    except Exception as e:
+        print("[record_text] load error:", e)
+        return ""
+
+
+def _flush_rows(kind: str, rows: list, ctx) -> None:
+    """ライトビハインドのキューから呼ばれる（バックグラウンドスレッド）。同じ種類の行をまとめて1回で書く"""
+    _attach_script_ctx(ctx)
+    if kind == "records":
+        get_history_store().append(rows)
+        invalidate_records_snapshots()
+        bump_rollups(records=[SimpleNamespace(**row) for row in rows])
+        # 新しいノートの科目のクイズバンクを裏で補充する
+        schedule_quiz_bank_top_up({row["subject"] for row in rows})
+    elif kind == "quiz":
+        append_rows_to_azure_blob_csv(QUIZ_HISTORY_BLOB, rows)
+        _quiz_snapshot().invalidate()
+        bump_rollups(quiz_logs=rows)
+    else:
+        print("[_flush_rows] unknown kind:", kind)
+
+
+@st.cache_resource(show_spinner=False)
+def _write_behind() -> WriteBehindQueue:
+    """保存の後回しキュー（プロセスで1つ）。前に落ちたプロセスの書き残しもここで引き取る"""
+    ctx = get_script_run_ctx()
+    return WriteBehindQueue(
+        os.path.join(CACHE_DIR, "write_behind"),
+        lambda kind, rows: _flush_rows(kind, rows, ctx),
+        batch_size=WRITE_BEHIND_BATCH,
+        interval=WRITE_BEHIND_INTERVAL_SECONDS,
+    )
+
+
+def _submit_write_behind(kind: str, rows: list) -> bool:
+    """キューに積めたら True（積めなければ呼び出し側がその場で書く）"""
+    if not WRITE_BEHIND_ENABLED or not _storage_configured():
+        return False
     try:
-        save_to_azure_blob_csv_append(blob_name, row)
+        _write_behind().submit(kind, rows)
+        return True
     except Exception as e:
-        print("[save_to_blob_csv] error:", e)
+        print("[_submit_write_behind] error:", kind, e)
+        return False
+
+
+def persist_records(records: list) -> None:
+    """
+    履歴ストア（既定は Parquet シャード、旧形式は CSV）に複数件をまとめて1回で追記保存し、
+    その科目のクイズバンクの補充を積む。
+    ライトビハインドが有効ならキューに積むだけで、Blob への書き込み（と補充）はキューが書いた後。
+    セッションには触らないのでジョブのスレッドからも呼べる。失敗したら例外を投げる。
+    """
+
+    rows = [
+        {
+            "id": record.id,
+            "created_at": record.created_at,
+            "filename": record.filename,
+            "text": record.text,
+            "summary": record.summary,
+            "subject": record.subject,
+        }
+        for record in records
+    ]
+
+    if _submit_write_behind("records", rows):
+        return
+    get_history_store().append(rows)
+    invalidate_records_snapshots()
+    bump_rollups(records=records)
+    schedule_quiz_bank_top_up({record.subject for record in records})
 
 
 # ==== ★ ここから復習クイズ履歴用の関数を追加 ★ ====
 
-def save_quiz_log_to_blob(log: dict, blob_name: str = "studyrecord_quiz_history.csv") -> None:
+def save_quiz_log_to_blob(log: dict, blob_name: str = QUIZ_HISTORY_BLOB) -> None:
     """復習クイズ履歴を Azure Blob Storage の CSV に追記保存"""
     row = {
+        "id": log["id"],
         "created_at": log["created_at"],
         "subject": log["subject"],
         "total": log["total"],
@@ -453,37 +841,249 @@ def save_quiz_log_to_blob(log: dict, blob_name: str = "studyrecord_quiz_history.
         "comment": log["comment"],
     }
 
+    if blob_name == QUIZ_HISTORY_BLOB and _submit_write_behind("quiz", [row]):
+        return
+
     try:
-        save_to_azure_blob_csv_append(blob_name, row)
+        saved = save_to_azure_blob_csv_append(blob_name, row)
     except Exception as e:
         print("[save_quiz_log_to_blob] error:", e)
+        return
+    if saved and blob_name == QUIZ_HISTORY_BLOB:
+        bump_rollups(quiz_logs=[row])
+
+
+def quiz_logs_from_frame(df) -> RecordStore:
+    """復習クイズ履歴の DataFrame を列指向の RecordStore にする"""
+    return RecordStore.from_frame(df, QUIZ_LOG_SCHEMA, key="id")
+
+
+# ==== 共有スナップショット（プロセスで1つ・ETag で再検証） ====
+def _load_quiz_snapshot() -> RecordStore:
+    return quiz_logs_from_frame(quiz_store().load())
+
+
+def _load_records_snapshot() -> RecordStore:
+    return records_from_frame(get_history_store().load(columns=RECORD_LIST_COLUMNS))
+
+
+def _recent_since(today: dt.date) -> str:
+    """一覧の既定で読む範囲の始まり（HISTORY_RECENT_MONTHS か月前の月初。期間フィルタの直近30日は必ず含む）"""
+    start = today.replace(day=1)
+    for _ in range(HISTORY_RECENT_MONTHS - 1):
+        start = (start - dt.timedelta(days=1)).replace(day=1)
+    return min(start, today - dt.timedelta(days=31)).isoformat()
+
+
+def _load_recent_records_snapshot() -> RecordStore:
+    since = _recent_since(dt.date.today())
+    return records_from_frame(get_history_store().load(columns=RECORD_LIST_COLUMNS, since=since))
 
 
-def load_quiz_history_from_blob(blob_name: str = "studyrecord_quiz_history.csv") -> list[dict]:
-    """Azure Blob 上の復習クイズCSVを読み込んで list[dict] で返す"""
+@st.cache_resource(show_spinner=False)
+def _records_snapshot() -> SharedSnapshot:
+    """全期間の履歴（クイズの出題元・古い履歴の表示用。必要になったときだけ読む）"""
+    return SharedSnapshot(get_history_store().version_blobs, _load_records_snapshot,
+                          empty=RecordStore.empty(RECORD_SCHEMA),
+                          min_interval=SNAPSHOT_REVALIDATE_SECONDS)
+
+
+@st.cache_resource(show_spinner=False)
+def _recent_records_snapshot() -> SharedSnapshot:
+    """直近 HISTORY_RECENT_MONTHS か月の履歴（一覧の既定。Parquet ストアなら古い月のシャードは読まない）"""
+    return SharedSnapshot(get_history_store().version_blobs, _load_recent_records_snapshot,
+                          empty=RecordStore.empty(RECORD_SCHEMA),
+                          min_interval=SNAPSHOT_REVALIDATE_SECONDS)
+
+
+def invalidate_records_snapshots() -> None:
+    _records_snapshot().invalidate()
+    _recent_records_snapshot().invalidate()
+
+
+@st.cache_resource(show_spinner=False)
+def _quiz_snapshot() -> SharedSnapshot:
+    return SharedSnapshot(quiz_store().version_blobs, _load_quiz_snapshot,
+                          empty=RecordStore.empty(QUIZ_LOG_SCHEMA, key="id"),
+                          min_interval=SNAPSHOT_REVALIDATE_SECONDS)
+
+
+def _load_rollups() -> Rollups:
+    """集計の Blob を読む。まだ無ければ履歴の全件から1回だけ作って保存する"""
+    data, _ = read_json_blob(ROLLUP_BLOB)
+    if data is not None:
+        return Rollups(data)
+    quiz_df = quiz_store().load()
+    built = Rollups.build(get_history_store().load(columns=["id", "created_at", "subject"]), quiz_df)
+    # 他のプロセスが先に作っていたらそちらを使う
+    return Rollups(update_json_blob(ROLLUP_BLOB, lambda cur: built.data if cur is None else None))
+
+
+@st.cache_resource(show_spinner=False)
+def _rollup_snapshot() -> SharedSnapshot:
+    return SharedSnapshot(ROLLUP_BLOB, _load_rollups, empty=None,
+                          min_interval=SNAPSHOT_REVALIDATE_SECONDS)
+
+
+def bump_rollups(records=(), quiz_logs=(), n: int = 1) -> None:
+    """
+    保存した記録・クイズ結果の分だけ集計に足す（全件は読み直さない）。n=-1 で削除した分を引く。
+    id のある行は足す・引くをそれぞれ1回だけ数える（ジャーナルの再生や二重の削除で数がずれない）。
+    Blob の更新に失敗したら集計を消し、次に読むときに全件から作り直させる。
+    """
+    if not AZURE_STORAGE_CONNECTION_STRING or not AZURE_BLOB_CONTAINER:
+        return
+
+    def _apply(current):
+        if current is None:
+            return None  # まだ集計が無ければ、次に読むときに全件から作る
+        r = Rollups(current)
+        return r.data if r.bump(records, quiz_logs, n) else None  # 全部もう数えてあれば書かない
+
     try:
-        df = load_csv_from_blob(blob_name)
+        update_json_blob(ROLLUP_BLOB, _apply)
     except Exception as e:
-        print("[load_quiz_history_from_blob] load error:", e)
-        return []
+        # 足し損ねた集計はずれたままになるので、消して次に読むときに全件から作り直させる
+        print("[bump_rollups] error:", e)
+        delete_json_blob(ROLLUP_BLOB)
+    _rollup_snapshot().invalidate()
 
-    if df is None or df.empty:
-        return []
 
-    logs: list[dict] = []
-    for _, row in df.iterrows():
-        logs.append(
-            {
-                "created_at": row.get("created_at", ""),
-                "subject": row.get("subject", ""),
-                "total": int(row.get("total", 0) or 0),
-                "answered": int(row.get("answered", 0) or 0),
-                "correct_count": int(row.get("correct_count", 0) or 0),
-                "rate": float(row.get("rate", 0.0) or 0.0),
-                "comment": row.get("comment", ""),
-            }
-        )
-    return logs
+def _session_records_snapshot() -> SharedSnapshot:
+    if st.session_state.get("history_full") or HISTORY_RECENT_MONTHS <= 0:
+        return _records_snapshot()
+    return _recent_records_snapshot()
+
+
+def use_full_history() -> None:
+    """このセッションの履歴を古い月も含めた全件に切り替える（復習クイズ・古い履歴の表示のとき）"""
+    if not st.session_state.get("history_full"):
+        st.session_state.history_full = True
+        st.session_state.records.rebase(*_records_snapshot().get())
+
+
+def sync_session_history() -> None:
+    """
+    セッションの records / quiz_history を共有スナップショットに合わせる。
+    セッションが持つのは自分で追加した分（オーバーレイ）だけ。
+    """
+    if not isinstance(st.session_state.get("records"), HistoryOverlay):
+        st.session_state.records = HistoryOverlay(key="id")
+    quiz_history = st.session_state.get("quiz_history")
+    if not isinstance(quiz_history, HistoryOverlay) or quiz_history.key != "id":
+        st.session_state.quiz_history = HistoryOverlay(key="id")
+
+    st.session_state.records.rebase(*_session_records_snapshot().get())
+    st.session_state.quiz_history.rebase(*_quiz_snapshot().get())
+    _search_index_warmer().submit(st.session_state.records.base)
+
+
+# ==== 削除・修正（パッチを追記し、まとめて本体に畳み込む） ====
+class _Compactor:
+    """
+    削除・修正のパッチを履歴本体に畳み込み、溜まった小さなシャードをまとめるスレッド（プロセスで1本）。
+    保存（append）の側ではまとめないので、シャードの書き直しはここだけで起きる。
+    COMPACTION_INTERVAL_SECONDS ごとに動き、このプロセスでパッチが
+    PATCH_COMPACT_THRESHOLD 件溜まったら待たずに動く。
+    """
+
+    def __init__(self, stores):
+        self._stores = stores
+        self._wake = threading.Event()
+        self._count = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, args=(get_script_run_ctx(),),
+                                        name="history-compactor", daemon=True)
+        self._thread.start()
+
+    def request(self) -> None:
+        """パッチを1件書いたら呼ぶ"""
+        with self._lock:
+            self._count += 1
+            if self._count < PATCH_COMPACT_THRESHOLD:
+                return
+            self._count = 0
+        self._wake.set()
+
+    def _loop(self, ctx) -> None:
+        _attach_script_ctx(ctx)
+        while True:
+            self._wake.wait(COMPACTION_INTERVAL_SECONDS)
+            self._wake.clear()
+            for store, snapshot in self._stores():
+                try:
+                    if store.compact():
+                        snapshot().invalidate()
+                except Exception as e:
+                    print("[compactor] error:", type(store).__name__, e)
+
+
+@st.cache_resource(show_spinner=False)
+def _compactor() -> _Compactor:
+    return _Compactor(lambda: [(get_history_store(), _records_snapshot), (quiz_store(), _quiz_snapshot)])
+
+
+def delete_record(rec) -> bool:
+    """OCR履歴を1件削除する（パッチを1行追記するだけ）"""
+    try:
+        get_history_store().delete(rec.id)
+    except Exception as e:
+        print("[delete_record] error:", e)
+        st.error(f"削除中にエラーが発生しました: {e}")
+        return False
+    st.session_state.records.hide(rec.id)
+    _search_index().remove(rec.id)
+    invalidate_records_snapshots()
+    bump_rollups(records=[rec], n=-1)
+    _update_review_state(lambda items: ReviewScheduler.forget(items, rec.id), "delete_record")
+    _compactor().request()
+    return True
+
+
+def update_record(rec, changes: dict) -> bool:
+    """OCR履歴の列を書き換える（パッチを1行追記するだけ）"""
+    current = {k: record_text(rec) if k == "text" else (getattr(rec, k, "") or "") for k in changes}
+    changes = {k: v for k, v in changes.items() if v != current[k]}
+    if not changes:
+        return False
+    # 一覧に無い全文の修正も、他のプロセスの検索索引が気付けるように
+    changes["updated_at"] = _now_iso()
+    try:
+        get_history_store().update(rec.id, changes)
+    except Exception as e:
+        print("[update_record] error:", e)
+        st.error(f"保存中にエラーが発生しました: {e}")
+        return False
+    # 検索索引からは外しておき、更新後のスナップショットを読んだときに入れ直す
+    _search_index().remove(rec.id)
+    invalidate_records_snapshots()
+    if "subject" in changes:
+        # 科目の付け替えは同じ id で何度も起きるので、id を付けずに（重複除けなしで）引いて足す
+        bump_rollups(records=[SimpleNamespace(created_at=rec.created_at, subject=rec.subject)], n=-1)
+        bump_rollups(records=[SimpleNamespace(created_at=rec.created_at, subject=changes["subject"])])
+        # 復習の状態は科目ごとのキューに入っているので、新しい科目のキューへ移す
+        _update_review_state(lambda items: ReviewScheduler.move(items, rec.id, changes["subject"]), "update_record")
+    if "subject" in changes or "text" in changes:
+        schedule_quiz_bank_top_up({rec.subject, changes.get("subject", rec.subject)})
+    _compactor().request()
+    return True
+
+
+def delete_quiz_log(log) -> bool:
+    """復習クイズ履歴を1件削除する（パッチを1行追記するだけ）"""
+    st.session_state.quiz_history.hide(log["id"])
+    if not _storage_configured():
+        return True
+    try:
+        quiz_store().delete(log["id"])
+    except Exception as e:
+        print("[delete_quiz_log] error:", e)
+        st.error(f"削除中にエラーが発生しました: {e}")
+        return False
+    _quiz_snapshot().invalidate()
+    bump_rollups(quiz_logs=[log], n=-1)
+    _compactor().request()
+    return True
 # ==== ★ ここまで追加 ★ ====
 
 
@@ -494,29 +1094,112 @@ def load_quiz_history_from_blob(blob_name: str = "studyrecord_quiz_history.csv")
 # UI ヘルパ
 # =====================
 
-def matches_filters(rec: OcrRecord, q: str, period: str, subject_filter: str) -> bool:
-    if q:
-        q_lower = q.lower()
-        target = f"{rec.filename} {rec.text} {rec.summary}".lower()
-        if q_lower not in target:
-            return False
-
-    # ★ 日付フィルタ
-    if period != "すべて":
-        rec_date = dt.date.fromisoformat(rec.created_at[:10])
-        today = dt.date.today()
-        if period == "直近7日" and rec_date < today - dt.timedelta(days=7):
-            return False
-        elif period == "直近30日" and rec_date < today - dt.timedelta(days=30):
-            return False
-        elif period == "今月" and rec_date < today.replace(day=1):
-            return False
-
-    # 科目フィルタ
-    if subject_filter != "すべて" and rec.subject != subject_filter:
-        return False
+def _period_start(period: str, today: dt.date) -> dt.date | None:
+    if period == "直近7日":
+        return today - dt.timedelta(days=7)
+    if period == "直近30日":
+        return today - dt.timedelta(days=30)
+    if period == "今月":
+        return today.replace(day=1)
+    return None
+
+
+def matches_filters(store: RecordStore, q: str, period: str, subject_filter: str) -> np.ndarray:
+    """
+    フィルタに合う行の行番号を新しい順で返す。
+    期間・科目は時刻索引の bisect / バケット、キーワードは n-gram 索引で引く。
+    """
+    index = store.derived(TimeSubjectIndex.NAME, TimeSubjectIndex)
+    start = _period_start(period, dt.date.today()) if period != "すべて" else None
+    start_key = start.isoformat() if start else None
+    subject = subject_filter if subject_filter != "すべて" else None
+
+    if not q:
+        return index.select(start_key, subject)
+
+    hits = search_records(store, q)
+    if start_key is None and subject is None:
+        candidates = index.order[::-1]
+    else:
+        candidates = index.select(start_key, subject)
+
+    # 件数の少ない方から絞る
+    if len(hits) < len(candidates):
+        created = store.column("created_at")[hits].astype(str)
+        keep = np.ones(len(hits), dtype=bool)
+        if start_key:
+            keep &= created >= start_key
+        if subject is not None:
+            keep &= store.column("subject")[hits] == subject
+        hits, created = hits[keep], created[keep]
+        return hits[np.argsort(created, kind="stable")[::-1]]
+
+    hit = np.zeros(len(store), dtype=bool)
+    hit[hits] = True
+    return candidates[hit[candidates]]
 
-    return True
+
+@st.cache_resource(show_spinner=False)
+def _card_html_cache() -> LruCache:
+    """履歴カード HTML のキャッシュ（プロセスで1つ）"""
+    return LruCache(CARD_CACHE_SIZE)
+
+
+@st.cache_resource(show_spinner=False)
+def _search_index() -> NgramIndex:
+    """キーワード検索用の n-gram 索引（プロセスで1つ・追加分だけ更新）"""
+    return NgramIndex(_JA_TOKEN, n=2, cache_size=SEARCH_TEXT_CACHE_SIZE)
+
+
+def _sync_search_index(store: RecordStore) -> None:
+    _search_index().sync(store, SEARCH_FIELDS, text_loader=get_history_store().load_text,
+                         signature=SEARCH_SIGNATURE)
+
+
+class _SearchIndexWarmer:
+    """
+    共有スナップショットが変わったら、検索索引をバックグラウンドで合わせておく
+    （最初の検索がスクリプトのスレッドで全件の全文を読まずに済むように）。
+    待っている間にさらに変わったら、最新のスナップショットにだけ合わせる。
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")
+        self._submitted = None
+        self._latest = None
+        self._lock = threading.Lock()
+
+    def submit(self, store: RecordStore) -> None:
+        with self._lock:
+            if store is self._submitted:
+                return
+            self._submitted = store
+            pending = self._latest is not None
+            self._latest = store
+        if not pending:
+            self._executor.submit(self._run, get_script_run_ctx())
+
+    def _run(self, ctx) -> None:
+        _attach_script_ctx(ctx)
+        with self._lock:
+            store, self._latest = self._latest, None
+        try:
+            _sync_search_index(store)
+        except Exception as e:
+            print("[search_index] warm-up error:", e)
+
+
+@st.cache_resource(show_spinner=False)
+def _search_index_warmer() -> _SearchIndexWarmer:
+    return _SearchIndexWarmer()
+
+
+def search_records(store: RecordStore, q: str, rank: bool = False) -> np.ndarray:
+    """ファイル名/本文/要約に q を含む行の行番号（rank=True なら関連度順）"""
+    index = _search_index()
+    _sync_search_index(store)
+    loader = index.loader(store, SEARCH_FIELDS, text_loader=get_history_store().load_text)
+    return store.positions(index.search(q, rank=rank, loader=loader))
 
 
 def copy_to_clipboard_button(label, text, key):
@@ -524,6 +1207,73 @@ def copy_to_clipboard_button(label, text, key):
     copy_js = f"navigator.clipboard.writeText(atob('{b64}'));"
     st.markdown(f"<button id='copy-btn-{key}' onclick=\"{copy_js}\">{label}</button>", unsafe_allow_html=True)
 
+def _paginate(total: int, key: str, filters: Dict[str, Any]) -> slice:
+    """ページ送りを表示して、今のページの範囲を slice で返す（フィルタが変わったら1ページ目に戻す）"""
+    page_size = int(filters.get("page_size") or HISTORY_PAGE_SIZE)
+    pages = max(1, math.ceil(total / page_size))
+
+    signature = (filters.get("q"), filters.get("period"), filters.get("subject_filter"), page_size)
+    if st.session_state.get(f"{key}_signature") != signature:
+        st.session_state[f"{key}_signature"] = signature
+        st.session_state[f"{key}_page"] = 1
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = pages
+
+    if pages > 1:
+        page = st.number_input("ページ", min_value=1, max_value=pages, step=1, key=f"{key}_page")
+    else:
+        page = 1
+    start = (int(page) - 1) * page_size
+    end = min(total, start + page_size)
+    st.caption(f"全 {total} 件中 {start + 1}〜{end} 件を表示（{page} / {pages} ページ）")
+    return slice(start, end)
+
+
+def _record_label(store: RecordStore, rid: str) -> str:
+    rec = store[int(store.positions([rid])[0])]
+    return f"{rec.filename}（{rec.created_at[:10]}）"
+
+
+def render_record_editor(page_records: RecordStore) -> None:
+    """表示中のページのノートを1件選んで修正・削除する"""
+    if not _storage_configured():
+        return
+    with st.expander("ノートを修正・削除する"):
+        rid = st.selectbox(
+            "対象のノート",
+            options=page_records.column("id").tolist(),
+            format_func=lambda rid: _record_label(page_records, rid),
+            key="history_edit_target",
+        )
+        if not rid:
+            return
+        rec = page_records[int(page_records.positions([rid])[0])]
+        # OCR全文は重いので、編集すると選んだときだけ読む（再実行のたびには取りに行かない）
+        edit_text = st.checkbox("OCR全文も編集する", key=f"history_edit_text_{rid}")
+        with st.form(f"history_edit_{rid}"):
+            filename = st.text_input("ファイル名", value=rec.filename or "")
+            subject = st.text_input("科目", value=rec.subject or "未分類")
+            summary = st.text_area("要約", value=rec.summary or "", height=160)
+            text = st.text_area("OCR全文", value=record_text(rec), height=220) if edit_text else None
+            col_save, col_del = st.columns(2)
+            save = col_save.form_submit_button("修正を保存")
+            delete = col_del.form_submit_button("削除", type="secondary")
+
+        if delete:
+            if delete_record(rec):
+                st.success("ノートを削除しました。")
+                st.rerun()
+        elif save:
+            changes = {"filename": filename, "subject": subject.strip() or "未分類", "summary": summary}
+            if text is not None:
+                changes["text"] = text
+            if update_record(rec, changes):
+                st.success("ノートを修正しました。")
+                st.rerun()
+            else:
+                st.info("変更はありません。")
+
+
 def render_history(filters: Dict[str, Any]):
     history_type = filters.get("history_type", "OCR")
 
@@ -533,33 +1283,43 @@ def render_history(filters: Dict[str, Any]):
     if history_type == "OCR":
         st.markdown("### 履歴（OCR）")
 
-        records: List[OcrRecord] = st.session_state.records
+        if _session_records_snapshot() is not _records_snapshot():
+            col_note, col_more = st.columns([3, 1])
+            col_note.caption(f"{_recent_since(dt.date.today())} 以降の履歴を表示しています。")
+            if col_more.button("古い履歴も読み込む", key="history_load_older"):
+                use_full_history()
+
+        records: RecordStore = st.session_state.records.view()
         if not records:
             st.info("まだ履歴がありません。")
             return
 
-        # 新しい順にソート
-        records = sorted(records, key=lambda r: r.created_at, reverse=True)
-
-        # フィルタ適用
-        filtered = [
-            r for r in records
-            if matches_filters(r, filters["q"], filters["period"], filters["subject_filter"])
-        ]
-
-        if not filtered:
+        # フィルタ適用（索引は新しい順に並んでいるので並べ替えは不要）
+        positions = matches_filters(records, filters["q"], filters["period"], filters["subject_filter"])
+        if filters["q"] and filters.get("rank_by_relevance"):
+            ranked = search_records(records, filters["q"], rank=True)
+            keep = np.zeros(len(records), dtype=bool)
+            keep[positions] = True
+            positions = ranked[keep[ranked]]
+        if not len(positions):
             st.info("条件に合致する履歴はありません。")
             return
 
-        # カードで表示
-        for rec in filtered:
-            meta = f"科目: {rec.subject} ｜ 作成日: {rec.created_at} ｜ ID: {rec.id}"
-            render_history_card(
-                title=rec.filename,
-                meta=meta,
-                summary=rec.summary,
-                fulltext=rec.text,
-            )
+        # 表示するページの分だけ取り出す
+        page = _paginate(len(positions), "history_ocr", filters)
+        page_records = records.take(positions[page])
+
+        # OCR全文は選んだノートの分だけ取得・送信する
+        expanded = set(st.multiselect(
+            "全文を表示するノート",
+            options=page_records.column("id").tolist(),
+            format_func=lambda rid: _record_label(page_records, rid),
+            key=f"history_expand_{page.start}",
+        ))
+
+        # カードで表示（HTML はキャッシュ済み、数枚ずつまとめて送る）
+        render_history_cards(page_records, expanded)
+        render_record_editor(page_records)
         return
 
 
@@ -568,13 +1328,15 @@ def render_history(filters: Dict[str, Any]):
     # =========================
     st.markdown("### 復習クイズ履歴")
 
-    quiz_history = st.session_state.get("quiz_history", [])
+    quiz_history: RecordStore = st.session_state.quiz_history.view()
     if not quiz_history:
         st.info("復習クイズの履歴はまだありません。")
         return
 
-    # 新しいものから順に表示
-    for idx, log in enumerate(reversed(quiz_history)):
+    # 新しいものから順に、表示するページの分だけ
+    order = quiz_history.argsort("created_at", reverse=True)
+    page = _paginate(len(order), "history_quiz", filters)
+    for idx, log in enumerate(quiz_history.take(order[page])):
         # 1行を「カード本体」と「削除ボタン」の2カラムに分ける
         col_main, col_del = st.columns([10, 1])
 
@@ -607,16 +1369,11 @@ def render_history(filters: Dict[str, Any]):
 
         # 右上：削除ボタン（カードの右上っぽい位置）
         with col_del:
-            # created_at をキーとして削除対象を特定
-            if st.button("✕", key=f"delete_quiz_{log['created_at']}"):
-                target_ts = log["created_at"]
-                # created_at が同じものを除外した新リストを作る
-                st.session_state.quiz_history = [
-                    h for h in st.session_state.quiz_history
-                    if h["created_at"] != target_ts
-                ]
-                st.success("この復習履歴を削除しました。")
-                st.rerun()
+            # id をキーとして削除対象を特定（削除はトゥームストーンを1行追記するだけ）
+            if st.button("✕", key=f"delete_quiz_{log['id']}"):
+                if delete_quiz_log(log):
+                    st.success("この復習履歴を削除しました。")
+                    st.rerun()
 
 
 
@@ -625,16 +1382,6 @@ def render_history(filters: Dict[str, Any]):
 # 復習用ユーティリティ（科目ベース）
 # =====================
 
-def get_subject(rec) -> str:
-    # OcrRecord(subject: str) なので属性で取得
-    try:
-        v = getattr(rec, "subject", None)
-        if not v and isinstance(rec, dict):
-            v = rec.get("subject")
-        return (v or "未分類").strip()
-    except Exception:
-        return "未分類"
-
 # 簡易弱点度（0〜1）
 _WEAK_HINT_WORDS = ("わから","不明","注意","課題","難し","苦手")
 def _weakness_score(text: str) -> float:
@@ -655,23 +1402,103 @@ def _tokenize(text: str) -> list[str]:
     return [t for t in toks if len(t) > 1 and t not in _STOP]
 
 # 学習状態（SM-2簡易）
-def _learn_state(rid: str) -> dict:
-    st.session_state.setdefault("_learn_state", {})
-    return st.session_state["_learn_state"].setdefault(
-        rid, {"streak": 0, "ef": 2.5, "interval": 1, "next_due": None, "last": None}
-    )
+# ノートごとの状態は Blob（REVIEW_STATE_BLOB）に保存し、全セッションで共有する ReviewScheduler で読む。
+# ストレージ未設定のときは同じ形の ReviewScheduler をセッション内だけで持つ（読み書きの経路は同じ）。
+def _load_scheduler() -> ReviewScheduler:
+    data, _ = read_json_blob(REVIEW_STATE_BLOB)
+    return ReviewScheduler((data or {}).get("items", {}))
+
+
+@st.cache_resource(show_spinner=False)
+def _scheduler_snapshot() -> SharedSnapshot:
+    return SharedSnapshot(REVIEW_STATE_BLOB, _load_scheduler, empty=ReviewScheduler(),
+                          min_interval=SNAPSHOT_REVALIDATE_SECONDS)
+
+
+def _storage_configured() -> bool:
+    return bool(AZURE_STORAGE_CONNECTION_STRING and AZURE_BLOB_CONTAINER)
+
+
+def review_scheduler() -> ReviewScheduler:
+    if _storage_configured():
+        return _scheduler_snapshot().get()[1]
+    return st.session_state.setdefault("_review_scheduler", ReviewScheduler())
+
+
+def _update_review_state(fn, label: str) -> None:
+    """
+    復習状態の items を fn(items) で書き換えて保存する。fn が False を返したら（変更なし）書き込まない。
+    保存後は review_scheduler() が新しい ReviewScheduler を返す（作ったものは書き換えない）。
+    """
+    def _apply(data):
+        items = dict((data or {}).get("items", {}))
+        if fn(items) is False:
+            return None
+        return {"version": 1, "items": items}
+
+    if not _storage_configured():
+        data = _apply({"items": review_scheduler().items})
+        if data is not None:
+            st.session_state["_review_scheduler"] = ReviewScheduler(data["items"])
+        return
+    try:
+        update_json_blob(REVIEW_STATE_BLOB, _apply)
+        _scheduler_snapshot().invalidate()
+    except Exception as e:
+        print(f"[{label}] error:", e)
+
+
+def record_reviews(answers: dict, today: dt.date) -> None:
+    """answers: {レコードID: (科目, quality)} をまとめて反映して保存する"""
+    if not answers:
+        return
+
+    def _apply(items):
+        for rid, (subject, quality) in answers.items():
+            ReviewScheduler.apply(items, rid, subject, quality, today)
+
+    _update_review_state(_apply, "record_reviews")
+
+
+def _review_quality(questions: list, results: dict) -> dict:
+    """
+    採点結果から出題元ノートごとの quality（0〜5）を出す。
+    そのノート由来の問題の正答率で、全問正解 5・半分以上 3・それ未満 1。
+    """
+    per_note: dict = {}
+    for i, q in enumerate(questions):
+        res = results.get(i)
+        if res is None:
+            continue
+        for rid in q.get("source_ids") or []:
+            per_note.setdefault(rid, []).append(bool(res["correct"]))
+    quality = {}
+    for rid, marks in per_note.items():
+        ratio = sum(marks) / len(marks)
+        quality[rid] = 5 if ratio == 1 else (3 if ratio >= 0.5 else 1)
+    return quality
+
+
+def _seeded_scheduler(records: RecordStore) -> ReviewScheduler:
+    """
+    復習状態に、まだ一度も復習していないノートを期限 0 で足したスケジューラ。
+    履歴か復習状態が変わったときだけ作り直す（再実行のたびに全ノートを見ない）。
+    """
+    scheduler = review_scheduler()
+    cached = st.session_state.get("_seeded_scheduler")
+    if cached and cached[0] is scheduler and cached[1] is records:
+        return cached[2]
+    seeded = scheduler.seeded(zip(records.column("id").tolist(), records.column("subject").tolist()))
+    st.session_state["_seeded_scheduler"] = (scheduler, records, seeded)
+    return seeded
 
-def _update_review(rid: str, quality: int, today: dt.date):
-    s = _learn_state(rid)
-    ef = s["ef"] + (0.1 - (5-quality)*(0.08+(5-quality)*0.02))
-    s["ef"] = max(1.3, min(2.8, ef))
-    s["streak"] = 0 if quality < 3 else s["streak"] + 1
-    if s["streak"] <= 1: interval = 1
-    elif s["streak"] == 2: interval = 2
-    else: interval = math.ceil(s["interval"] * s["ef"])
-    s["interval"] = interval
-    s["next_due"] = today + dt.timedelta(days=interval)
-    s["last"] = quality
+
+def due_note_ids(records: RecordStore, subject: str, today: dt.date) -> set:
+    """
+    今日が復習期限のノート ID（まだ一度も復習していないノートも含む）。
+    期限が来たものは科目ごとのヒープから順に取り出すので、全ノートの状態を見比べない。
+    """
+    return set(_seeded_scheduler(records).due(subject, today))
 
 
 def render_review_tab():
@@ -687,13 +1514,16 @@ def render_review_tab():
     if "quiz_saved_flag" not in st.session_state:
         st.session_state.quiz_saved_flag = False
 
-    records: List[OcrRecord] = st.session_state.records
+    # 出題元は古い月のノートも含めた全件
+    use_full_history()
+    records: RecordStore = st.session_state.records.view()
     if not records:
         st.info("まだデータがありません。")
         return
 
     # 科目一覧
-    subjects = sorted({get_subject(r) for r in records})
+    subject_col = records.column("subject")
+    subjects = sorted(set(subject_col.tolist()))
     subject = st.selectbox(
         "科目を選択",
         subjects,
@@ -701,7 +1531,7 @@ def render_review_tab():
     )
 
     # 選んだ科目のレコード
-    subject_records = [r for r in records if get_subject(r) == subject]
+    subject_records = records.where(subject_col == subject)
     if not subject_records:
         st.info("この科目の記録がありません。")
         return
@@ -718,27 +1548,36 @@ def render_review_tab():
         key="quiz_num_questions",
     )
 
+    today = dt.date.today()
+    due_ids = due_note_ids(records, subject, today)
+    due_only = st.checkbox(
+        f"復習期限が来たノートだけから出題する（今日の対象: {len(due_ids)}件）",
+        value=True,
+        key="quiz_due_only",
+    )
+
+    regenerate = st.checkbox(
+        "前回と同じ内容でも作り直す（キャッシュを使わない）",
+        value=False,
+        key="quiz_regenerate",
+    )
+
     # --- クイズ生成ボタン ---
     if st.button("クイズ生成"):
-        texts = []
-        for rec in subject_records:
-            s = getattr(rec, "summary", "") or (
-                rec.meta.get("summary")
-                if hasattr(rec, "meta") and isinstance(rec.meta, dict)
-                else ""
-            )
-            t = getattr(rec, "text", "") or ""
-            if s:
-                texts.append(s)
-            elif t:
-                texts.append(t)
-
-        if not texts:
-            st.warning("この科目には要約やテキストがありません。")
+        notes = _subject_notes(records, subject, only=due_ids if due_only else None)
+
+        if not notes:
+            if due_only:
+                st.info("今日が復習期限のノートはありません。チェックを外すと全ノートから出題します。")
+            else:
+                st.warning("この科目には要約やテキストがありません。")
         else:
-            joined = "\n\n".join(texts)
-            with st.spinner("問題を生成中..."):
-                qs = run_azure_quiz(joined, subject, num_questions=num_questions)
+            # 事前生成したクイズバンクから引けるならすぐ出題する（作り直し指定のときは使わない）
+            qs = [] if regenerate else draw_from_quiz_bank(subject, notes, num_questions)
+            if not qs:
+                with st.spinner("問題を生成中..."):
+                    qs = generate_subject_quiz(notes, subject, num_questions, regenerate=regenerate)
+                schedule_quiz_bank_top_up([subject])
 
             if not qs:
                 st.warning("問題を生成できませんでした。")
@@ -812,6 +1651,7 @@ def render_review_tab():
                 comment = "難しかったかもしれません。間違えた問題を中心に復習しましょう。"
 
             log = {
+                "id": str(uuid.uuid4()),
                 "created_at": _now_iso(),
                 "subject": subject,
                 "total": total,
@@ -829,6 +1669,12 @@ def render_review_tab():
             # ★ 復習履歴CSVにも保存
             save_quiz_log_to_blob(log)
 
+            # 出題元ノートの復習間隔を更新する
+            record_reviews(
+                {rid: (subject, q) for rid, q in _review_quality(questions, results).items()},
+                dt.date.today(),
+            )
+
         if answered < total:
             st.caption("※ まだ解いていない問題があります。全部解くとより正確に実力がわかります。")
         else:
@@ -847,6 +1693,401 @@ def render_review_tab():
 
 
 
+def _attach_script_ctx(ctx) -> None:
+    """ワーカースレッドからも st.cache_resource の共有リソースを使えるようにする"""
+    add_script_run_ctx(threading.current_thread(), ctx)
+
+
+@st.cache_resource(show_spinner=False)
+def _ocr_cache() -> TieredCache:
+    """OCR 結果のキャッシュ（ローカルのディスク LRU ＋ Blob 上の共有キャッシュ）"""
+    shared = BlobCache("cache/ocr") if AZURE_STORAGE_CONNECTION_STRING and AZURE_BLOB_CONTAINER else None
+    return TieredCache(DiskLruCache(os.path.join(CACHE_DIR, "ocr"), OCR_CACHE_MAX_MB * 1024 * 1024), shared)
+
+
+class AzureReadEngine(OcrEngine):
+    """Azure Read API（run_azure_ocr）を OcrEngine として使う"""
+
+    name = "azure"
+    version = OCR_ENGINE_VERSION
+
+    def __init__(self, timeout: float | None = None):
+        self.timeout = timeout
+
+    def available(self) -> bool:
+        return bool(AZURE_CV_ENDPOINT and AZURE_CV_KEY)
+
+    def recognize(self, image_bytes: bytes, *, stats: dict | None = None) -> str:
+        return run_azure_ocr(image_bytes, stats=stats, timeout=self.timeout)
+
+
+@st.cache_resource(show_spinner=False)
+def _ocr_engines() -> list:
+    """OCR_ENGINE に応じた、試す順のエンジン一覧（先頭で失敗したら次へ）"""
+    if OCR_ENGINE == "easyocr":
+        engines = [EasyOcrEngine(EASYOCR_LANGUAGES)]
+    elif OCR_ENGINE == "auto":
+        engines = [AzureReadEngine(timeout=OCR_FALLBACK_TIMEOUT_SECONDS), EasyOcrEngine(EASYOCR_LANGUAGES)]
+    else:
+        engines = [AzureReadEngine()]
+    engines = [e for e in engines if e.available()]
+    if not engines:
+        raise RuntimeError(f"使える OCR エンジンがありません（OCR_ENGINE={OCR_ENGINE}）。")
+    return engines
+
+
+def _preprocess_signature() -> str:
+    if not OCR_PREPROCESS:
+        return "raw"
+    return json.dumps(OCR_PREPROCESS_OPTIONS, sort_keys=True)
+
+
+def _ocr_payload(image_bytes: bytes) -> tuple[bytes, dict]:
+    if OCR_PREPROCESS:
+        return preprocess_image(image_bytes, **OCR_PREPROCESS_OPTIONS)
+    return image_bytes, {"orig_bytes": len(image_bytes), "sent_bytes": len(image_bytes), "prep_seconds": 0.0}
+
+
+def _ocr_key(image_bytes: bytes, engine: OcrEngine) -> str:
+    return content_key(image_bytes, engine.version, OCR_LANGUAGE, _preprocess_signature())
+
+
+def run_ocr_cached(image_bytes: bytes, stats: dict | None = None) -> str:
+    """
+    同じ画像（同じ言語・エンジン版・前処理設定）なら OCR を呼ばずにキャッシュから返す。
+    キャッシュに無ければ前処理してから OCR_ENGINE のエンジンに順に渡し、最初に成功した結果を使う。
+    送信量・前処理時間・使ったエンジンを stats に書き込む。
+    """
+    stats = stats if stats is not None else {}
+    cache = _ocr_cache()
+    engines = _ocr_engines()
+    for engine in engines:
+        try:
+            hit = cache.get(_ocr_key(image_bytes, engine))
+        except Exception as e:
+            print("[run_ocr_cached] cache get error:", e)
+            hit = None
+        if hit is not None:
+            stats.update(polls=0, seconds=0.0, status="cached", engine=engine.name)
+            return hit.decode("utf-8")
+
+    payload, prep = _ocr_payload(image_bytes)
+    stats.update(prep)
+    error = None
+    for engine in engines:
+        try:
+            text = engine.recognize(payload, stats=stats)
+        except Exception as e:
+            print(f"[run_ocr_cached] {engine.name} failed:", e)
+            error = e
+            continue
+        stats["engine"] = engine.name
+        try:
+            cache.put(_ocr_key(image_bytes, engine), text.encode("utf-8"))
+        except Exception as e:
+            print("[run_ocr_cached] cache put error:", e)
+        return text
+    raise error
+
+
+def ocr_prefetch_batch(images: list) -> None:
+    """
+    先頭のエンジンがローカル（easyocr）のとき、キャッシュに無い画像をまとめて1回で推論して
+    キャッシュに入れておく（このあと画像ごとの run_ocr_cached はキャッシュから返る）。
+    """
+    engine = _ocr_engines()[0]
+    if not isinstance(engine, EasyOcrEngine) or len(images) < 2:
+        return
+    cache = _ocr_cache()
+    pending: dict = {}
+    for data in images:
+        key = _ocr_key(data, engine)
+        if key not in pending and cache.get(key) is None:
+            pending[key] = _ocr_payload(data)[0]
+    if len(pending) < 2:
+        return
+    texts = engine.recognize_batch(list(pending.values()))
+    for key, text in zip(pending, texts):
+        cache.put(key, text.encode("utf-8"))
+
+
+class _BatchPrefetch:
+    """同じ送信のジョブのうち最初に動いたものが一括OCR（ocr_prefetch_batch）をし、ほかはそれを待つ"""
+
+    def __init__(self, images: list):
+        self._images = images
+        self._lock = threading.Lock()
+
+    def run(self) -> None:
+        with self._lock:
+            if self._images is None:
+                return
+            try:
+                ocr_prefetch_batch(self._images)
+            except Exception as e:
+                print("[ocr_prefetch_batch] batch OCR skipped:", e)
+            self._images = None
+
+
+class _SubmissionSave:
+    """
+    同じ送信のジョブのノートを集め、最後に終わったジョブが1回でまとめて保存する。
+    ライトビハインドが有効なときはキューがまとめて書くので、ジョブごとにすぐ積む（ローカルのジャーナルに残る）。
+    """
+
+    def __init__(self, total: int):
+        self._left = total
+        self._done: list = []   # [(job, record)]
+        self._lock = threading.Lock()
+
+    def finish(self, job, record: OcrRecord | None) -> None:
+        """ジョブの終わりに必ず呼ぶ（失敗したジョブは record=None）"""
+        if WRITE_BEHIND_ENABLED:
+            if record is not None:
+                self._persist([(job, record)])
+            return
+        with self._lock:
+            if record is not None:
+                self._done.append((job, record))
+            self._left -= 1
+            if self._left:
+                return
+            done, self._done = self._done, []
+        if done:
+            self._persist(done)
+
+    @staticmethod
+    def _persist(done: list) -> None:
+        if not _storage_configured():
+            return
+        for job, _ in done:
+            job.stage = "保存中"
+        try:
+            persist_records([record for _, record in done])
+        except Exception as e:
+            print("[_SubmissionSave] save error:", e)
+            for job, _ in done:
+                job.warning = f"履歴の保存中にエラーが発生しました: {e}"
+
+
+def _ocr_job(job, ctx, name: str, image_bytes: bytes, subject: str,
+             prefetch: _BatchPrefetch | None, save: _SubmissionSave) -> OcrRecord:
+    """
+    1枚分のジョブ（OCR → 要約 → 保存）。ジョブのスレッドで動き、段階は job.stage に書く。
+    要約は job.partial にストリーミングで書き出す。保存（save）まで済ませるので、画面を離れても履歴に残る。
+    保存に失敗してもノートは返す（job.warning に理由を残し、セッションの履歴には入る）。
+    """
+    _attach_script_ctx(ctx)
+    record = None
+    try:
+        if prefetch is not None:
+            job.stage = "一括OCR中"
+            prefetch.run()
+        job.stage = "OCR中"
+        ocr_stats: dict = {}
+        text = run_ocr_cached(image_bytes, stats=ocr_stats)
+        job.stage = "要約中"
+        summary = run_azure_summary(text, placeholder=job)
+        record = _new_record(name, image_bytes, subject, text, summary, ocr_stats)
+    finally:
+        save.finish(job, record)
+    return record
+
+
+def _new_record(name: str, image_bytes: bytes, subject: str, text: str, summary: str,
+                ocr_stats: dict) -> OcrRecord:
+    return OcrRecord(
+        id=str(uuid.uuid4()),
+        created_at=_now_iso(),
+        filename=name,
+        text=text,
+        summary=summary,
+        subject=subject,
+        meta={
+            "size": len(image_bytes),
+            "sent_bytes": ocr_stats.get("sent_bytes", 0),
+            "prep_seconds": ocr_stats.get("prep_seconds", 0.0),
+            "ocr_seconds": ocr_stats.get("seconds", 0.0),
+            "ocr_polls": ocr_stats.get("polls", 0),
+            "ocr_engine": ocr_stats.get("engine", ""),
+        },
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def _job_runner() -> JobRunner:
+    """OCR → 要約 → 保存 のジョブを流すスレッドプールとジョブ表（プロセスで1つ）"""
+    return JobRunner(max_workers=OCR_MAX_WORKERS, retain_seconds=JOB_RETAIN_SECONDS)
+
+
+def _job_owner() -> str:
+    return st.session_state.setdefault("_job_owner", uuid.uuid4().hex)
+
+
+def submit_ocr_jobs(files: list, subject: str) -> list:
+    """files: [(ファイル名, バイト列)] を1枚1ジョブで積み、ジョブ ID のリストを返す（待たない）"""
+    ctx = get_script_run_ctx()
+    prefetch = _BatchPrefetch([data for _, data in files]) if len(files) > 1 else None
+    save = _SubmissionSave(len(files))
+    return [
+        _job_runner().submit(_ocr_job, ctx, name, data, subject, prefetch, save,
+                             owner=_job_owner(), label=name)
+        for name, data in files
+    ]
+
+
+def _absorb_finished_jobs(jobs: list) -> None:
+    """終わったジョブのノートをセッションの履歴・検索索引に入れる（1ジョブ1回だけ）"""
+    absorbed = st.session_state.setdefault("ocr_jobs_absorbed", set())
+    for job in jobs:
+        if job.status != "done" or job.id in absorbed:
+            continue
+        absorbed.add(job.id)
+        rec = job.result
+        st.session_state.records.add(rec)
+        _search_index().add(rec.id, rec.filename, rec.text, rec.summary)
+        card_html(rec)
+
+
+_JOB_ICONS = {"queued": "⏳", "running": "🔄", "done": "✅", "failed": "❌"}
+
+
+def render_ocr_jobs() -> None:
+    """
+    このセッションで積んだ OCR ジョブの状態を表示する。
+    動いているジョブがある間は、この部分だけを JOB_POLL_SECONDS ごとに描き直す（ジョブ表を見るだけ）。
+    """
+    runner = _job_runner()
+    ids = [i for i in st.session_state.get("ocr_jobs", []) if runner.get(i) is not None]
+    st.session_state.ocr_jobs = ids
+    if not ids:
+        return
+    active = any(not runner.get(i).finished for i in ids)
+
+    @st.fragment(run_every=JOB_POLL_SECONDS if active else None)
+    def _panel():
+        jobs = [j for j in (runner.get(i) for i in ids) if j is not None]
+        _absorb_finished_jobs(jobs)
+        finished = sum(j.finished for j in jobs)
+        st.progress(finished / len(jobs), text=f"{finished} / {len(jobs)} 件完了")
+        for job in jobs:
+            stage = {"done": "完了", "failed": "失敗"}.get(job.status, job.stage)
+            st.markdown(f"{_JOB_ICONS[job.status]} {job.label} — {stage}")
+            if job.status == "running" and job.partial:
+                st.markdown(job.partial)
+            if job.status == "failed":
+                st.error(f"❌ {job.label}: {job.error}")
+            elif job.warning:
+                st.warning(f"⚠️ {job.label}: {job.warning}")
+        if active and finished == len(jobs):
+            st.rerun()  # 全部終わったら定期更新を止める
+
+    _panel()
+    if active:
+        return
+
+    records = [j.result for j in (runner.get(i) for i in ids) if j is not None and j.status == "done"]
+    if records:
+        polls = [r.meta.get("ocr_polls", 0) for r in records]
+        st.caption(f"OCR: {len(records)} 件 ／ ポーリング 平均 {sum(polls) / len(polls):.1f} 回")
+        sent = [r for r in records if r.meta.get("sent_bytes")]
+        if sent:
+            orig_mb = sum(r.meta["size"] for r in sent) / 1e6
+            sent_mb = sum(r.meta["sent_bytes"] for r in sent) / 1e6
+            prep = sum(r.meta.get("prep_seconds", 0.0) for r in sent) / len(sent)
+            ocr = sum(r.meta.get("ocr_seconds", 0.0) for r in sent) / len(sent)
+            st.caption(
+                f"送信量 {orig_mb:.1f} MB → {sent_mb:.1f} MB ／ 前処理 平均 {prep:.2f} 秒 ／ OCR 平均 {ocr:.1f} 秒"
+            )
+        render_ocr_done()
+    if st.button("結果の表示を消す", key="ocr_jobs_clear"):
+        st.session_state.ocr_jobs = []
+        st.rerun()
+
+
+def render_ocr_done() -> None:
+    """完了アニメーション（中央に丸＋チェックがポンっと出る）"""
+    st.markdown(
+        """
+        <div class="ocr-done-wrapper">
+        <div class="ocr-done-circle">
+            <span class="ocr-done-check">✓</span>
+        </div>
+        <div class="ocr-done-text">保存完了！</div>
+        </div>
+
+        <style>
+        .ocr-done-wrapper {
+            display: flex;
+            flex-direction: column;
+            align-items: center;
+            margin-top: 24px;
+            animation: fadeInUp 0.6s ease-out;
+        }
+
+        .ocr-done-circle {
+            width: 80px;
+            height: 80px;
+            border-radius: 999px;
+            background: linear-gradient(135deg, #34D399, #22C55E);
+            display: flex;
+            align-items: center;
+            justify-content: center;
+            box-shadow: 0 8px 20px rgba(16, 185, 129, 0.6);
+            animation: popIn 0.4s ease-out;
+        }
+
+        .ocr-done-check {
+            color: #ffffff;
+            font-size: 42px;
+            font-weight: 700;
+            transform: translateY(2px);
+            animation: bounce 0.6s ease-out 0.1s both;
+        }
+
+        .ocr-done-text {
+            margin-top: 12px;
+            font-size: 18px;
+            font-weight: 600;
+            color: #166534;
+        }
+
+        @keyframes popIn {
+            0% {
+                transform: scale(0.4);
+                opacity: 0;
+            }
+            70% {
+                transform: scale(1.08);
+                opacity: 1;
+            }
+            100% {
+                transform: scale(1.0);
+            }
+        }
+
+        @keyframes bounce {
+            0%   { transform: translateY(-8px); }
+            50%  { transform: translateY(2px);  }
+            100% { transform: translateY(0);    }
+        }
+
+        @keyframes fadeInUp {
+            0% {
+                opacity: 0;
+                transform: translateY(10px);
+            }
+            100% {
+                opacity: 1;
+                transform: translateY(0);
+            }
+        }
+        </style>
+        """,
+        unsafe_allow_html=True,
+    )
+
+
 def render_ocr_tab():
     st.markdown("### OCR")
 
@@ -867,20 +2108,29 @@ def render_ocr_tab():
         key="ocr_subject_select",  # ← 追加
     )
 
-    # 画像アップロード
-    uploaded = st.file_uploader(
-        "画像をアップロード",
+    # 画像アップロード（複数枚まとめて可）
+    uploaded_files = st.file_uploader(
+        "画像をアップロード（複数可）",
         type=["png", "jpg", "jpeg", "webp"],
+        accept_multiple_files=True,
     )
 
-    if uploaded is not None:
+    if uploaded_files:
         # =============================
         # ① プレビュー画像の位置調整（画像専用カラム）
         # =============================
-        img_left, img_center, img_right = st.columns([1.125, 2, 1])
+        if len(uploaded_files) == 1:
+            img_left, img_center, img_right = st.columns([1.125, 2, 1])
 
-        with img_center:
-            st.image(uploaded, caption=uploaded.name, width=350)
+            with img_center:
+                st.image(uploaded_files[0], caption=uploaded_files[0].name, width=350)
+        else:
+            grid = st.columns(4)
+            for i, f in enumerate(uploaded_files[:OCR_PREVIEW_MAX]):
+                with grid[i % 4]:
+                    st.image(f, caption=f.name, width=150)
+            if len(uploaded_files) > OCR_PREVIEW_MAX:
+                st.caption(f"ほか {len(uploaded_files) - OCR_PREVIEW_MAX} 枚")
 
         # 余白
         st.markdown("<div style='height: 40px;'></div>", unsafe_allow_html=True)
@@ -912,116 +2162,26 @@ def render_ocr_tab():
                 unsafe_allow_html=True,
             )
 
-            if st.button("実行", key="round_big_run"):
-                # ファイルをバイト列として読み込み
-                # uploaded.seek(0) はなくてもOKなので削っています
-                image_bytes = uploaded.read()
-
-                # OCR と 要約
-                text = run_azure_ocr(image_bytes)
-                summary = run_azure_summary(text)
-
-                # OcrRecord の作成（★ 科目は selected_subject を使う）
-                rec = OcrRecord(
-                    id=str(uuid.uuid4()),
-                    created_at=_now_iso(),
-                    filename=uploaded.name,
-                    text=text,
-                    summary=summary,
-                    subject=subject,  # ← ここを subject にする
-                    meta={"size": len(image_bytes)},
-                )
-
-                # セッションの履歴に追加
-                st.session_state.records.insert(0, rec)
-
-                # Azure Blob Storage の CSV に追記保存
-                save_to_blob_csv(rec)
-                # 完了アニメーション（中央に丸＋チェックがポンっと出る）
-                st.markdown(
-                    """
-                    <div class="ocr-done-wrapper">
-                    <div class="ocr-done-circle">
-                        <span class="ocr-done-check">✓</span>
-                    </div>
-                    <div class="ocr-done-text">保存完了！</div>
-                    </div>
-
-                    <style>
-                    .ocr-done-wrapper {
-                        display: flex;
-                        flex-direction: column;
-                        align-items: center;
-                        margin-top: 24px;
-                        animation: fadeInUp 0.6s ease-out;
-                    }
-
-                    .ocr-done-circle {
-                        width: 80px;
-                        height: 80px;
-                        border-radius: 999px;
-                        background: linear-gradient(135deg, #34D399, #22C55E);
-                        display: flex;
-                        align-items: center;
-                        justify-content: center;
-                        box-shadow: 0 8px 20px rgba(16, 185, 129, 0.6);
-                        animation: popIn 0.4s ease-out;
-                    }
-
-                    .ocr-done-check {
-                        color: #ffffff;
-                        font-size: 42px;
-                        font-weight: 700;
-                        transform: translateY(2px);
-                        animation: bounce 0.6s ease-out 0.1s both;
-                    }
-
-                    .ocr-done-text {
-                        margin-top: 12px;
-                        font-size: 18px;
-                        font-weight: 600;
-                        color: #166534;
-                    }
-
-                    @keyframes popIn {
-                        0% {
-                            transform: scale(0.4);
-                            opacity: 0;
-                        }
-                        70% {
-                            transform: scale(1.08);
-                            opacity: 1;
-                        }
-                        100% {
-                            transform: scale(1.0);
-                        }
-                    }
-
-                    @keyframes bounce {
-                        0%   { transform: translateY(-8px); }
-                        50%  { transform: translateY(2px);  }
-                        100% { transform: translateY(0);    }
-                    }
-
-                    @keyframes fadeInUp {
-                        0% {
-                            opacity: 0;
-                            transform: translateY(10px);
-                        }
-                        100% {
-                            opacity: 1;
-                            transform: translateY(0);
-                        }
-                    }
-                    </style>
-                    """,
-                    unsafe_allow_html=True,
-                )
+            run_clicked = st.button("実行", key="round_big_run")
+
+        if run_clicked:
+            # ファイルをバイト列として読み込み、1枚1ジョブで OCR → 要約 → 保存 を裏で流す（ここでは待たない）
+            files = [(f.name, f.getvalue()) for f in uploaded_files]
+            st.session_state.setdefault("ocr_jobs", []).extend(submit_ocr_jobs(files, subject))
 
 
     else:
         st.info("まず画像ファイルをアップロードしてください。")
 
+    render_ocr_jobs()
+
+    cache_stats = _ocr_cache().stats
+    hits = cache_stats["local_hits"] + cache_stats["shared_hits"]
+    st.caption(
+        f"OCRキャッシュ: ヒット {hits} 件（ローカル {cache_stats['local_hits']} ／ 共有 {cache_stats['shared_hits']}）"
+        f" ／ ミス {cache_stats['misses']} 件"
+    )
+
 
 
 
@@ -1041,6 +2201,7 @@ def render_sidebar():
         )
 
         q = st.text_input("キーワード検索（ファイル名/本文/要約）")
+        rank_by_relevance = st.checkbox("関連度順に並べる", value=False, disabled=not q)
 
         period = st.selectbox(
             "期間フィルタ",
@@ -1052,11 +2213,30 @@ def render_sidebar():
             ["すべて"] + (st.session_state.get("subjects") or ["未分類"])
         )
 
+        page_sizes = sorted({10, 20, 50, HISTORY_PAGE_SIZE})
+        page_size = st.selectbox(
+            "1ページの表示件数",
+            page_sizes,
+            index=page_sizes.index(HISTORY_PAGE_SIZE),
+        )
+
+        if WRITE_BEHIND_ENABLED and _storage_configured():
+            wb = _write_behind().stats
+            st.caption(f"保存待ち: {wb['depth']} 件 ／ 遅れ {wb['lag_seconds']:.1f} 秒")
+            if wb["last_error"]:
+                st.warning(f"保存を再試行しています: {wb['last_error']}")
+
+        jobs = _job_runner().counts()
+        if jobs["queued"] or jobs["running"]:
+            st.caption(f"OCRジョブ: 実行中 {jobs['running']} 件 ／ 待機 {jobs['queued']} 件")
+
     return {
         "history_type": history_type,  # ← ここが重要！
         "q": q,
+        "rank_by_relevance": rank_by_relevance,
         "period": period,
         "subject_filter": subject_filter,
+        "page_size": page_size,
     }
 
 
@@ -1064,49 +2244,124 @@ def render_sidebar():
 # =====================
 # 学習進捗の可視化
 # =====================
-def render_progress_chart():
-    records: List[OcrRecord] = st.session_state.records
-    if not records:
-        st.info("まだデータがありません。OCRを実行すると進捗が表示されます。")
-        return
-
-    # ========= 日本語フォント設定 =========
+@st.cache_resource(show_spinner=False)
+def _jp_font():
+    """グラフ用の日本語フォント（プロセスで1回だけ読み込む）"""
     import matplotlib.font_manager as fm
     font_path = os.path.join(os.path.dirname(__file__), "fonts", "NotoSansJP-Regular.ttf")
-    prop = fm.FontProperties(fname=font_path) if os.path.exists(font_path) else None
+    return fm.FontProperties(fname=font_path) if os.path.exists(font_path) else None
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _bar_chart_png(labels: tuple, values: tuple, xlabel: str, ylabel: str, rotation: int) -> bytes:
+    """matplotlib で棒グラフを PNG にする（同じデータなら描き直さない）"""
+    prop = _jp_font()
+    font = {"fontproperties": prop} if prop else {}
+
+    fig, ax = plt.subplots(figsize=(4.2, 2.6))
+    ax.bar(labels, values)
+    ax.set_xlabel(xlabel, fontsize=10, **font)
+    ax.set_ylabel(ylabel, fontsize=10, **font)
+    ax.grid(axis="y", linestyle="--", alpha=0.4)
+
+    # 棒の上に件数ラベル（整数）
+    for x, v in enumerate(values):
+        ax.text(x, v + 0.05, str(v), ha="center", va="bottom", fontsize=8)
+
+    # Y軸を整数目盛りにする
+    max_v = max(values)
+    ax.set_ylim(0, max_v + 1)
+    ax.set_yticks(range(0, max_v + 2))
+    ax.set_xticks(range(len(labels)))
+    ax.set_xticklabels(labels, rotation=rotation, ha="right", fontsize=8, **font)
+    ax.tick_params(axis="y", labelsize=8)
+
+    fig.tight_layout(pad=0.3)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=150)
+    plt.close(fig)
+    return buf.getvalue()
+
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def _bar_chart_altair(labels: tuple, values: tuple, xlabel: str, ylabel: str, rotation: int):
+    """Vega-Lite（Altair）の棒グラフ。描画はブラウザ側なのでサーバーは仕様を送るだけ"""
+    data = pd.DataFrame({"label": labels, "count": values})
+    x = alt.X("label:N", sort=None, title=xlabel, axis=alt.Axis(labelAngle=-rotation))
+    bars = alt.Chart(data).mark_bar().encode(
+        x=x,
+        y=alt.Y("count:Q", title=ylabel, axis=alt.Axis(tickMinStep=1)),
+        tooltip=["label", "count"],
+    )
+    text = alt.Chart(data).mark_text(dy=-6, fontSize=10).encode(x=x, y="count:Q", text="count:Q")
+    return (bars + text).properties(height=240)
 
-    def apply_jp_font(ax):
-        if not prop:
-            return
-        # タイトル・軸ラベル
-        t = ax.get_title()
-        if t:
-            ax.set_title(t, fontproperties=prop, fontsize=13)
-        xl = ax.get_xlabel()
-        if xl:
-            ax.set_xlabel(xl, fontproperties=prop, fontsize=10)
-        yl = ax.get_ylabel()
-        if yl:
-            ax.set_ylabel(yl, fontproperties=prop, fontsize=10)
-        # 目盛りラベル
-        for lab in ax.get_xticklabels() + ax.get_yticklabels():
-            lab.set_fontproperties(prop)
-            lab.set_fontsize(8)
-
-    # ========= データ準備 =========
-    df = df_from_records(records)
-    df["date"] = pd.to_datetime(df["created_at"]).dt.date
 
-    # ========= サマリー（上段） =========
-    total_ocr = len(df)
-    last7 = df[df["date"] >= (dt.date.today() - dt.timedelta(days=7))]
-    recent_ocr = len(last7)
+def _bar_chart(labels, values, xlabel: str, ylabel: str, rotation: int) -> None:
+    labels = tuple(str(v) for v in labels)
+    values = tuple(int(v) for v in values)
+    if PROGRESS_CHART_BACKEND == "png":
+        st.image(_bar_chart_png(labels, values, xlabel, ylabel, rotation), width="stretch")
+    else:
+        st.altair_chart(_bar_chart_altair(labels, values, xlabel, ylabel, rotation), width="stretch")
+
 
-    c1, c2 = st.columns(2)
+def _progress_summary(overlay: HistoryOverlay) -> dict:
+    """
+    進捗タブの集計（総件数・直近7日・日別30日・科目別）。
+    履歴のバージョンと日付が変わらなければ、セッションに持っている前回の結果を返す。
+    """
+    today = dt.date.today()
+    version = (overlay.version, st.session_state.quiz_history.version, today)
+    cached = st.session_state.get("_progress_summary")
+    if cached and cached[0] == version:
+        return cached[1]
+
+    df = overlay.view().frame(["created_at", "subject"])
+    dates = pd.to_datetime(df["created_at"], errors="coerce").dt.date
+    start = today - dt.timedelta(days=29)
+    daily = dates[dates >= start].value_counts().sort_index()
+    subjects = df["subject"].dropna().value_counts()  # 件数が多い科目を左に
+    summary = {
+        "total": len(df),
+        "recent7": int((dates >= today - dt.timedelta(days=7)).sum()),
+        "daily": (tuple(str(d) for d in daily.index), tuple(daily.tolist())),
+        "subjects": (tuple(subjects.index.tolist()), tuple(subjects.tolist())),
+    }
+    quiz = st.session_state.quiz_history.view()
+    questions = int(quiz.column("total").astype(float).sum()) if len(quiz) else 0
+    summary["quiz_count"] = len(quiz)
+    summary["quiz_rate"] = (float(quiz.column("correct_count").astype(float).sum()) / questions * 100) if questions else None
+    st.session_state["_progress_summary"] = (version, summary)
+    return summary
+
+
+def render_progress_chart():
+    # Blob 上の集計（ロールアップ）があればそれを使い、履歴の全件は見ない
+    rollups = None
+    if AZURE_STORAGE_CONNECTION_STRING and AZURE_BLOB_CONTAINER:
+        _, rollups = _rollup_snapshot().get()
+    if rollups is not None:
+        summary = rollups.summary(dt.date.today())
+    else:
+        use_full_history()
+        summary = _progress_summary(st.session_state.records)
+
+    if not summary["total"]:
+        st.info("まだデータがありません。OCRを実行すると進捗が表示されます。")
+        return
+
+    # ========= サマリー（上段） =========
+    c1, c2, c3, c4 = st.columns(4)
     with c1:
-        metric_card("総OCR件数", f"{total_ocr} 件")
+        metric_card("総OCR件数", f"{summary['total']} 件")
     with c2:
-        metric_card("直近7日間のOCR件数", f"{recent_ocr} 件")
+        metric_card("直近7日間のOCR件数", f"{summary['recent7']} 件")
+    with c3:
+        metric_card("復習クイズ回数", f"{summary['quiz_count']} 回")
+    with c4:
+        rate = summary["quiz_rate"]
+        metric_card("クイズ正答率", f"{rate:.0f} %" if rate is not None else "—")
 
     st.divider()
 
@@ -1120,132 +2375,46 @@ def render_progress_chart():
         # ---- 左：日別OCR件数（直近30日） ----
         with col_left:
             st.markdown("#### 日別OCR件数（直近30日）")
-
-            daily_counts = (
-                df.groupby("date")
-                  .size()
-                  .rename("count")
-                  .reset_index()
-                  .sort_values("date")
-            )
-
-            today = dt.date.today()
-            start = today - dt.timedelta(days=29)
-            daily_counts = daily_counts[daily_counts["date"] >= start]
-
-            if not daily_counts.empty:
-                # 横並び用にコンパクトなサイズ
-                fig1, ax1 = plt.subplots(figsize=(4.2, 2.6))
-                x_labels = daily_counts["date"].astype(str)
-
-                ax1.bar(x_labels, daily_counts["count"])
-                ax1.set_xlabel("日付")
-                ax1.set_ylabel("件数")
-                ax1.grid(axis="y", linestyle="--", alpha=0.4)
-
-                # 上に件数（整数）を表示
-                for x, y in zip(range(len(x_labels)), daily_counts["count"]):
-                    ax1.text(
-                        x,
-                        y + 0.05,
-                        str(int(y)),
-                        ha="center",
-                        va="bottom",
-                        fontsize=8,
-                    )
-
-                # Y軸を整数目盛りにする
-                max_count = int(daily_counts["count"].max())
-                ax1.set_ylim(0, max_count + 1)
-                ax1.set_yticks(range(0, max_count + 2))
-
-                plt.setp(ax1.get_xticklabels(), rotation=45, ha="right")
-
-                apply_jp_font(ax1)
-                fig1.tight_layout(pad=0.3)
-                st.pyplot(fig1, use_container_width=True)
-                plt.close(fig1)
+            labels, values = summary["daily"]
+            if labels:
+                _bar_chart(labels, values, "日付", "件数", rotation=45)
             else:
                 st.info("直近30日間のデータがありません。")
 
         # ---- 右：科目別OCR件数（累計） ----
         with col_right:
             st.markdown("#### 科目別OCR件数（累計）")
-
-            if "subject" in df.columns and not df["subject"].isna().all():
-                subject_counts = (
-                    df.groupby("subject")
-                      .size()
-                      .sort_values(ascending=False)  # 件数が多い科目を左に
-                )
-
-                fig2, ax2 = plt.subplots(figsize=(4.2, 2.6))
-
-                # ★ 縦棒グラフ：x=科目, y=件数
-                x_labels = subject_counts.index.tolist()
-                y_values = subject_counts.values
-
-                ax2.bar(x_labels, y_values)
-                ax2.set_xlabel("科目")
-                ax2.set_ylabel("件数")
-                ax2.grid(axis="y", linestyle="--", alpha=0.4)
-
-                # 棒の上に件数ラベル（整数）
-                for x, v in enumerate(y_values):
-                    ax2.text(
-                        x,
-                        int(v) + 0.05,
-                        str(int(v)),
-                        ha="center",
-                        va="bottom",
-                        fontsize=8,
-                    )
-
-                # Y軸を整数目盛りにする
-                max_v = int(y_values.max())
-                ax2.set_ylim(0, max_v + 1)
-                ax2.set_yticks(range(0, max_v + 2))
-
-                # 科目名が重ならないように少し斜めに
-                plt.setp(ax2.get_xticklabels(), rotation=30, ha="right")
-
-                apply_jp_font(ax2)
-                fig2.tight_layout(pad=0.4)
-                st.pyplot(fig2, use_container_width=True)
-                plt.close(fig2)
+            labels, values = summary["subjects"]
+            if labels:
+                _bar_chart(labels, values, "科目", "件数", rotation=30)
             else:
                 st.info("科目情報が未設定のため、科目別グラフは表示できません。")
 
 
-
-
-
-
-
-
-
-
-
 # =====================
 # メイン
 # =====================
-def main():
+@st.cache_resource(show_spinner=False)
+def _migrate_history_blobs() -> None:
+    """既存の履歴CSV（Block Blob）を Append Blob へ移行する（プロセスごとに1回）"""
+    if not AZURE_STORAGE_CONNECTION_STRING or not AZURE_BLOB_CONTAINER:
+        return
+    for name in (HISTORY_BLOB, QUIZ_HISTORY_BLOB):
+        try:
+            migrate_csv_to_append_blob(name)
+        except Exception as e:
+            print("[_migrate_history_blobs] error:", name, e)
 
-        # 起動時に CSV 読み込み
-    if "records" not in st.session_state or not st.session_state.records:
-        blob_records = load_records_from_blob()
-        if blob_records:
-            st.session_state.records = blob_records
-
-        # ★ 復習クイズ履歴CSVも読み込む
-    if "quiz_history" not in st.session_state:
-        quiz_logs = load_quiz_history_from_blob()
-        st.session_state.quiz_history = quiz_logs
 
+def main():
+    _migrate_history_blobs()
+    if _storage_configured():
+        _compactor()  # 削除・修正のパッチを定期的に本体へ畳み込む
+        if WRITE_BEHIND_ENABLED:
+            _write_behind()  # 前に落ちたプロセスの書き残しがあれば引き取って書く
 
-    # セッション初期化
-    if "records" not in st.session_state:
-        st.session_state.records: List[OcrRecord] = []
+    # 履歴は共有スナップショット＋このセッションの追加分
+    sync_session_history()
 
     st.set_page_config(page_title=APP_TITLE, layout="wide")
     inject_global_css()
@@ -1323,8 +2492,11 @@ def main():
     # 左サイドバー
     filters = render_sidebar()
 
-    # タブ
-    tab_ocr, tab_hist, tab_progress, tab_review = st.tabs(["OCR", "履歴", "進捗", "復習"])
+    # タブ（選んでいるタブを覚えておき、復習タブは開いたときだけ描く。
+    # 復習は古い月も含めた全件の履歴を使うので、開くまでは直近の月だけで済ませる）
+    tab_ocr, tab_hist, tab_progress, tab_review = st.tabs(
+        ["OCR", "履歴", "進捗", "復習"], key="main_tab", on_change="rerun"
+    )
 
     # --- OCRタブ ---
     with tab_ocr:
@@ -1340,7 +2512,8 @@ def main():
 
     # --- 復習タブ ---
     with tab_review:
-        render_review_tab()
+        if tab_review.open:
+            render_review_tab()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,152 @@
+"""
+テスト共通: Azure の代わりにメモリ上の Blob（ETag・appendpos_condition の 412 を再現）を使う。
+"""
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+from azure.storage.blob import BlobType
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils  # noqa: E402
+
+
+class _Download:
+    def __init__(self, data: bytes, etag: str):
+        self._data = data
+        self.properties = type("Properties", (), {"etag": etag})()
+
+    def readall(self) -> bytes:
+        return self._data
+
+    def readinto(self, buf) -> int:
+        buf.write(self._data)
+        return len(self._data)
+
+
+class FakeBlobClient:
+    """
+    BlobClient のうち utils が使うメソッドだけをメモリ上で再現する。
+    1回の呼び出しは1つのロックの中で完結し（Azure 側の1リクエストに相当）、
+    呼び出しの前に少し待って、スレッド同士の割り込みを起こしやすくする。
+    """
+
+    def __init__(self, service: "FakeBlobService", name: str):
+        self.service = service
+        self.name = name
+
+    def _blob(self) -> dict:
+        blob = self.service.blobs.get(self.name)
+        if blob is None:
+            raise ResourceNotFoundError("BlobNotFound")
+        return blob
+
+    def _check(self, etag, match_condition) -> None:
+        blob = self.service.blobs.get(self.name)
+        if match_condition == MatchConditions.IfNotModified and (blob is None or blob["etag"] != etag):
+            raise ResourceModifiedError("ConditionNotMet")
+        if match_condition == MatchConditions.IfMissing and blob is not None:
+            raise ResourceExistsError("BlobAlreadyExists")
+        if match_condition == MatchConditions.IfModified and blob is not None and blob["etag"] == etag:
+            e = HttpResponseError("NotModified")
+            e.status_code = 304
+            raise e
+
+    def _write(self, blob_type, data: bytes, blocks: int) -> dict:
+        blob = {"type": blob_type, "data": data, "etag": uuid.uuid4().hex, "blocks": blocks}
+        self.service.blobs[self.name] = blob
+        return blob
+
+    def get_blob_properties(self, **kwargs):
+        with self.service.request():
+            blob = self._blob()
+            return type("Properties", (), {
+                "blob_type": blob["type"],
+                "etag": blob["etag"],
+                "size": len(blob["data"]),
+                "last_modified": None,
+                "append_blob_committed_block_count": blob["blocks"],
+            })()
+
+    def download_blob(self, offset=None, length=None, etag=None, match_condition=None, **kwargs):
+        with self.service.request():
+            self._check(etag, match_condition)
+            blob = self._blob()
+            data = blob["data"]
+            if offset is not None:
+                data = data[offset:offset + length] if length else data[offset:]
+            return _Download(data, blob["etag"])
+
+    def upload_blob(self, data, blob_type=BlobType.BLOCKBLOB, overwrite=False,
+                    etag=None, match_condition=None, **kwargs):
+        with self.service.request():
+            self._check(etag, match_condition)
+            if self.name in self.service.blobs and not overwrite:
+                raise ResourceExistsError("BlobAlreadyExists")
+            if hasattr(data, "read"):
+                data = data.read()
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            return {"etag": self._write(blob_type, bytes(data), 1)["etag"]}
+
+    def create_append_blob(self, etag=None, match_condition=None, **kwargs):
+        with self.service.request():
+            self._check(etag, match_condition)
+            self._write(BlobType.APPENDBLOB, b"", 0)
+
+    def append_block(self, data, appendpos_condition=None, **kwargs):
+        with self.service.request():
+            blob = self._blob()
+            assert blob["type"] == BlobType.APPENDBLOB
+            if appendpos_condition is not None and len(blob["data"]) != appendpos_condition:
+                e = HttpResponseError("AppendPositionConditionNotMet")
+                e.status_code = 412
+                self.service.append_conflicts += 1
+                raise e
+            blob["data"] += bytes(data)
+            blob["etag"] = uuid.uuid4().hex
+            blob["blocks"] += 1
+            return {"blob_committed_block_count": blob["blocks"], "etag": blob["etag"]}
+
+    def delete_blob(self, **kwargs):
+        with self.service.request():
+            self._blob()
+            del self.service.blobs[self.name]
+
+    def exists(self) -> bool:
+        return self.name in self.service.blobs
+
+
+class FakeBlobService:
+    def __init__(self):
+        self.blobs: dict = {}
+        self.append_conflicts = 0
+        self._lock = threading.RLock()
+
+    def request(self):
+        time.sleep(random.uniform(0, 0.002))
+        return self._lock
+
+    def get_blob_client(self, name: str) -> FakeBlobClient:
+        return FakeBlobClient(self, name)
+
+
+@pytest.fixture
+def blob_service(monkeypatch):
+    service = FakeBlobService()
+    monkeypatch.setattr(utils, "_get_blob_client", service.get_blob_client)
+    monkeypatch.setattr(utils, "_append_headers", {})
+    # 作り直しを複数ブロックに分けて、ブロックの間に他スレッドの追記が割り込むようにする
+    monkeypatch.setattr(utils, "_APPEND_BLOCK_MAX", 300)
+    return service
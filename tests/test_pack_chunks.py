@@ -0,0 +1,29 @@
+"""
+クイズ生成用のチャンク分け（pack_chunks）のテスト。
+英数字とかな・漢字が混ざった長いノートでも、どのチャンクも予算を超えないことを確かめる。
+"""
+import random
+
+import utils
+
+
+def test_long_mixed_note_fits_budget():
+    # 前半が英数字・後半が漢字のノートは、文字数で按分すると後半の切れ端が予算を超えていた
+    text = "abcd efgh " * 300 + "漢字かな交じりの文章" * 300
+    chunks = utils.pack_chunks([("r1", text)], budget=500)
+    assert all(sum(utils.estimate_tokens(p) for _, p in chunk) <= 500 for chunk in chunks)
+    assert "".join(p for chunk in chunks for _, p in chunk) == text
+
+
+def test_random_notes_fit_budget_and_keep_order():
+    rng = random.Random(0)
+    alphabet = "abcxyz 0123,.漢字かなカナ"
+    items = [(f"r{i}", "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 3000)))) for i in range(30)]
+    chunks = utils.pack_chunks(items, budget=300)
+    for chunk in chunks:
+        assert sum(utils.estimate_tokens(p) for _, p in chunk) <= 300
+    joined: dict = {}
+    for chunk in chunks:
+        for rid, piece in chunk:
+            joined[rid] = joined.get(rid, "") + piece
+    assert joined == {rid: text.strip() for rid, text in items if text.strip()}
@@ -0,0 +1,75 @@
+"""
+削除・修正のパッチ（PatchLog）のテスト。
+トゥームストーンと修正を記録順に反映し、畳み込んだパッチ行を消せることを確かめる。
+"""
+import json
+
+import pandas as pd
+
+import utils
+
+
+def _patches(*ops) -> pd.DataFrame:
+    return pd.DataFrame([
+        {"op_id": f"op{i}", "at": "2026-10-18T00:00:00", "target": target, "op": op,
+         "changes": json.dumps(changes, ensure_ascii=False)}
+        for i, (target, op, changes) in enumerate(ops)
+    ], columns=utils.PATCH_COLUMNS)
+
+
+def _history() -> pd.DataFrame:
+    return pd.DataFrame({
+        "id": ["a", "b", "c", "a"],
+        "subject": ["数学", "英語", "物理", "数学(新)"],
+        "summary": ["s1", "s2", "s3", "s1b"],
+    })
+
+
+def test_apply_keeps_last_duplicate_without_patches():
+    df = utils.PatchLog.apply(_history(), None)
+    assert df["id"].tolist() == ["b", "c", "a"]
+    assert df.set_index("id").loc["a", "subject"] == "数学(新)"
+
+
+def test_apply_updates_and_tombstones_in_order():
+    df = utils.PatchLog.apply(_history(), _patches(
+        ("b", "update", {"subject": "国語"}),
+        ("b", "update", {"summary": "s2b"}),
+        ("c", "update", {"subject": "化学"}),
+        ("c", "delete", {}),
+        ("c", "update", {"subject": "生物"}),  # 削除の後の修正は無視する
+        ("zz", "delete", {}),  # 本体にまだ無い行
+        ("a", "update", {"updated_at": "2026-10-18T10:00:00"}),  # 本体に無い列
+    ))
+    by_id = df.set_index("id")
+    assert sorted(by_id.index) == ["a", "b"]
+    assert by_id.loc["b", "subject"] == "国語" and by_id.loc["b", "summary"] == "s2b"
+    assert list(df.columns)[-1] == "updated_at"
+    assert by_id.loc["a", "updated_at"] == "2026-10-18T10:00:00"
+    assert by_id.loc["b", "updated_at"] == ""
+
+
+def test_settled_keeps_patches_for_rows_not_yet_written():
+    patches = _patches(("a", "delete", {}), ("later", "update", {"subject": "x"}))
+    patches.loc[2] = ["old", "1999-01-01T00:00:00", "gone", "delete", "{}"]
+    settled = utils.PatchLog.settled(patches, ["a", "b"])
+    assert set(settled["op_id"]) == {"op0", "old"}
+
+
+def test_patch_log_roundtrip_and_remove(blob_service):
+    log = utils.PatchLog("history.patches.csv")
+    assert log.load().empty
+    log.delete("a")
+    log.update("b", {"subject": "国語, 古文"})
+    log.update("c", {"summary": "改行\nあり"})
+    loaded = log.load()
+    assert loaded["op"].tolist() == ["delete", "update", "update"]
+    assert json.loads(loaded["changes"].iloc[1]) == {"subject": "国語, 古文"}
+
+    df = utils.PatchLog.apply(_history(), loaded)
+    assert sorted(df["id"]) == ["b", "c"]
+
+    log.remove(set(loaded["op_id"].iloc[:2]))
+    rest = log.load()
+    assert rest["target"].tolist() == ["c"]
+    assert json.loads(rest["changes"].iloc[0]) == {"summary": "改行\nあり"}
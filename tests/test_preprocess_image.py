@@ -0,0 +1,68 @@
+"""
+OCR 前の画像の前処理（preprocess_image）のテスト。
+透過のある画像は白地に合成し、EXIF の向きは回して直し、大きな写真は縮めることを確かめる。
+"""
+import io
+
+from PIL import Image
+
+import utils
+
+
+def _png(img: Image.Image) -> bytes:
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+def _decode(data: bytes) -> Image.Image:
+    return Image.open(io.BytesIO(data))
+
+
+def test_transparent_png_is_composited_on_white():
+    # 透明な背景に黒い文字（の代わりの四角）
+    img = Image.new("RGBA", (400, 300), (0, 0, 0, 0))
+    img.paste((0, 0, 0, 255), (150, 100, 250, 200))
+    data, info = utils.preprocess_image(_png(img), autocontrast=False)
+    out = _decode(data).convert("L")
+    assert info["preprocessed"]
+    assert out.getpixel((10, 10)) > 240  # 透明だった所は白（黒にならない）
+    assert out.getpixel((200, 150)) < 15
+
+
+def test_palette_with_transparency_is_composited_on_white():
+    img = Image.new("P", (300, 300), 0)
+    img.putpalette([0, 0, 0] * 256)
+    img.info["transparency"] = 0
+    data, _ = utils.preprocess_image(_png(img), autocontrast=False)
+    assert _decode(data).convert("L").getpixel((5, 5)) > 240
+
+
+def test_exif_orientation_is_applied():
+    img = Image.new("RGB", (600, 200), (255, 255, 255))
+    img.paste((0, 0, 0), (0, 0, 100, 200))  # 左端に黒い帯
+    exif = Image.Exif()
+    exif[0x0112] = 6  # 時計回りに 90° 回して表示する
+    out = io.BytesIO()
+    img.save(out, format="JPEG", exif=exif.tobytes())
+
+    data, info = utils.preprocess_image(out.getvalue(), autocontrast=False)
+    rotated = _decode(data)
+    assert info["preprocessed"]
+    assert rotated.size == (200, 600)
+    assert rotated.getexif().get(0x0112, 1) == 1
+    assert rotated.convert("L").getpixel((100, 20)) < 30  # 黒い帯が上に来る
+    assert rotated.convert("L").getpixel((100, 580)) > 220
+
+
+def test_large_photo_is_downscaled_and_unreadable_data_is_passed_through():
+    img = Image.new("RGB", (4000, 3000), (200, 200, 200))
+    out = io.BytesIO()
+    img.save(out, format="JPEG")
+    data, info = utils.preprocess_image(out.getvalue(), max_side=1000)
+    assert max(_decode(data).size) <= 1000
+    assert info["sent_bytes"] == len(data) < info["orig_bytes"]
+
+    raw = b"not an image"
+    data, info = utils.preprocess_image(raw)
+    assert data == raw and not info["preprocessed"]
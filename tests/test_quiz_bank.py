@@ -0,0 +1,72 @@
+"""
+クイズバンク（QuizBank.top_up）のテスト。
+LLM の代わりに呼び出し回数を数える関数で問題を作り、目標数に達したら呼ばないこと・
+ノートを巡回して選ぶこと・足したばかりの問題が上限で落ちないことを確かめる。
+"""
+import utils
+
+
+def _key(q: dict) -> str:
+    return q["question"]
+
+
+class _Generator:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, picked: list, n: int) -> list:
+        self.calls.append(([rid for rid, _ in picked], n))
+        out = []
+        for i in range(n):
+            rid = picked[i % len(picked)][0]
+            out.append({"question": f"{rid}-{len(self.calls)}-{i}", "source_ids": [rid]})
+        return out
+
+
+def _notes(n: int) -> list:
+    return [(f"r{i}", f"ノート{i}の本文") for i in range(n)]
+
+
+def test_top_up_stops_at_target(blob_service):
+    bank = utils.QuizBank("quiz_bank", max_questions=120)
+    notes = _notes(200)
+    gen = _Generator()
+
+    added = bank.top_up("数学", notes, gen, key=_key, target=60, per_note=3)
+    assert len(added) == 60
+    assert len(gen.calls) == 1
+    picked, n = gen.calls[0]
+    assert n == 60 and len(picked) == 20  # 200 ノート全部ではなく、目標に必要な分だけ
+
+    # ノートが増えていなければ、2回目は LLM を呼ばない
+    assert bank.top_up("数学", notes, gen, key=_key, target=60, per_note=3) == []
+    assert len(gen.calls) == 1
+    assert len(bank.load("数学")) == 60
+
+
+def test_top_up_rotates_through_notes(blob_service):
+    bank = utils.QuizBank("quiz_bank", max_questions=120)
+    notes = _notes(10)
+    gen = _Generator()
+
+    bank.top_up("数学", notes, gen, key=_key, target=6, per_note=3)
+    assert gen.calls[-1][0] == ["r0", "r1"]
+
+    # r0 を書き換えると r0 の問題だけが外れ、まだ問題の無いノートから続きで補充する
+    notes[0] = ("r0", "書き換えた本文")
+    bank.top_up("数学", notes, gen, key=_key, target=6, per_note=3)
+    assert gen.calls[-1] == (["r3"], 3)
+    sources = {q["source_ids"][0] for q in bank.load("数学")}
+    assert sources == {"r1", "r3"}
+
+
+def test_merge_keeps_new_questions_over_cap(blob_service):
+    bank = utils.QuizBank("quiz_bank", max_questions=5)
+    notes = _notes(3)
+    hashes = {rid: utils.QuizBank.note_hash(t) for rid, t in notes}
+    old = [{"question": f"old{i}", "source_ids": ["r0"], "source_hash": {"r0": hashes["r0"]}} for i in range(5)]
+    bank.merge("数学", old, hashes, key=_key)
+    new = [{"question": f"new{i}", "source_ids": ["r1"], "source_hash": {"r1": hashes["r1"]}} for i in range(3)]
+
+    kept = bank.merge("数学", new, hashes, key=_key)
+    assert [q["question"] for q in kept] == ["old3", "old4", "new0", "new1", "new2"]
@@ -0,0 +1,49 @@
+"""
+列指向の履歴（RecordStore / RecordRow）のテスト。
+"""
+import pandas as pd
+
+import utils
+
+SCHEMA = {"id": "", "created_at": "", "subject": "未分類", "score": 0}
+
+
+def _store() -> utils.RecordStore:
+    df = pd.DataFrame({
+        "id": ["a", "b", "c", "d", "e"],
+        "created_at": ["2026-10-03T09:00:00", "2026-10-01T09:00:00", "2026-10-02T09:00:00",
+                       "2026-10-02T09:00:00", "2026-10-05T09:00:00"],
+        "subject": ["数学", "英語", "", "数学", None],
+        "score": ["1", "x", None, "4", "5"],
+    })
+    return utils.RecordStore.from_frame(df, SCHEMA)
+
+
+def test_from_frame_fills_defaults_and_types():
+    store = _store()
+    assert len(store) == 5 and store
+    assert store.column("subject").tolist() == ["数学", "英語", "未分類", "数学", "未分類"]
+    assert store.column("score").tolist() == [1, 0, 0, 4, 5]
+    assert store.column("missing").tolist() == [""] * 5
+    assert not utils.RecordStore.empty(SCHEMA)
+
+
+def test_record_row_reads_like_object_and_mapping():
+    row = _store()[0]
+    assert row.id == "a" and row["subject"] == "数学" and row.score == 1
+    assert isinstance(row.score, int)  # numpy の型ではなく Python の値
+    assert row.get("nothing", "-") == "-"
+    assert row.to_dict() == {"id": "a", "created_at": "2026-10-03T09:00:00", "subject": "数学", "score": 1}
+    assert _store()[-1].id == "e"
+
+
+def test_take_where_positions_and_extend():
+    store = _store()
+    math = store.where(store.column("subject") == "数学")
+    assert [r.id for r in math] == ["a", "d"]
+    assert store.positions(["d", "zz", "a"]).tolist() == [3, 0]
+    assert store.keys == frozenset("abcde")
+
+    more = store.extend([{"id": "f", "created_at": "2026-10-06T00:00:00"}])
+    assert len(more) == 6 and len(store) == 5  # 元のストアは変えない
+    assert more[5].subject == "未分類" and more[5].score == 0
@@ -0,0 +1,50 @@
+"""
+復習スケジューラ（ReviewScheduler）のテスト。
+期限の来たノートの取り出しと、科目の付け替え・削除でキューがずれないことを確かめる。
+"""
+from datetime import date
+
+import utils
+
+TODAY = date(2026, 10, 18)
+
+
+def _items() -> dict:
+    items: dict = {}
+    utils.ReviewScheduler.apply(items, "a", "数学", 5, date(2026, 10, 10))
+    utils.ReviewScheduler.apply(items, "b", "数学", 1, date(2026, 10, 18))
+    utils.ReviewScheduler.apply(items, "c", "英語", 5, date(2026, 10, 1))
+    return items
+
+
+def test_due_returns_overdue_notes_oldest_first():
+    scheduler = utils.ReviewScheduler(_items())
+    assert scheduler.due("数学", TODAY) == ["a"]
+    assert scheduler.due("数学", date(2026, 10, 19)) == ["a", "b"]
+    assert scheduler.due("物理", TODAY) == []
+
+
+def test_seeded_adds_only_unreviewed_notes():
+    scheduler = utils.ReviewScheduler(_items())
+    seeded = scheduler.seeded([("a", "数学"), ("d", "数学")])
+    assert seeded.due("数学", TODAY) == ["d", "a"]
+    assert "d" not in scheduler  # 元のスケジューラは変えない
+
+
+def test_move_rekeys_note_into_new_subject_queue():
+    items = _items()
+    before = list(items["a"])
+    assert utils.ReviewScheduler.move(items, "a", "英語")
+    assert not utils.ReviewScheduler.move(items, "a", "英語")
+    assert not utils.ReviewScheduler.move(items, "missing", "英語")
+    scheduler = utils.ReviewScheduler(items)
+    assert scheduler.due("数学", TODAY) == []
+    assert scheduler.due("英語", TODAY) == ["c", "a"]
+    assert items["a"][1:] == before[1:]  # 間隔などはそのまま
+
+
+def test_forget_drops_deleted_note():
+    items = _items()
+    assert utils.ReviewScheduler.forget(items, "a")
+    assert not utils.ReviewScheduler.forget(items, "a")
+    assert utils.ReviewScheduler(items).due("数学", date(2026, 10, 19)) == ["b"]
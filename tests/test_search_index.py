@@ -0,0 +1,80 @@
+"""
+キーワード検索（NgramIndex）のテスト。
+n-gram で絞り込んだ結果が、全件を部分文字列で見比べた結果と同じになることを確かめる。
+"""
+import random
+import re
+
+import pandas as pd
+
+import utils
+
+TOKEN = re.compile(r"[ぁ-んァ-ヶ一-龥A-Za-z0-9]+")
+FIELDS = ("filename", "text", "summary")
+SCHEMA = {"id": "", "filename": "", "text": "", "summary": "", "updated_at": ""}
+WORDS = ["微分", "積分", "関数", "ベクトル", "光合成", "細胞", "英単語", "Past", "tense", "x2", "の", "は", "、", "!"]
+
+
+def _store(n: int, rng: random.Random, stamp: str = "") -> utils.RecordStore:
+    rows = [{
+        "id": f"r{i}",
+        "filename": f"note{i}.jpg",
+        "text": "".join(rng.choice(WORDS) for _ in range(rng.randint(0, 30))),
+        "summary": " ".join(rng.choice(WORDS) for _ in range(3)),
+        "updated_at": stamp,
+    } for i in range(n)]
+    return utils.RecordStore.from_frame(pd.DataFrame(rows), SCHEMA)
+
+
+def _scan(store: utils.RecordStore, q: str) -> set:
+    ql = q.lower()
+    return {
+        r.id for r in store
+        if ql in " ".join(str(r[f] or "") for f in FIELDS).lower()
+    }
+
+
+QUERIES = ["微分", "分", "積分関数", "past", "PAST TENSE", "x", "note1", "、", "!", "ベクトルの", "存在しない"]
+
+
+def test_search_matches_substring_scan():
+    rng = random.Random(1)
+    store = _store(300, rng)
+    index = utils.NgramIndex(TOKEN, n=2, cache_size=20)  # キャッシュに入りきらない本文は loader から読む
+    index.sync(store, FIELDS)
+    loader = index.loader(store, FIELDS)
+    for q in QUERIES:
+        assert set(index.search(q, loader=loader)) == _scan(store, q), q
+
+
+def test_search_follows_changed_and_removed_notes():
+    rng = random.Random(2)
+    store = _store(200, rng, stamp="v1")
+    index = utils.NgramIndex(TOKEN, n=2, cache_size=50)
+    index.sync(store, FIELDS, signature=("summary", "updated_at"))
+
+    # 他のプロセスで書き換えられたノート（updated_at が変わる）と、削除されたノート
+    df = store.frame()
+    df.loc[df.index[:40], "text"] = "光合成だけのノート"
+    df.loc[df.index[:40], "updated_at"] = "v2"
+    df = df.iloc[:-10]
+    updated = utils.RecordStore.from_frame(df, SCHEMA)
+    for rid in store.column("id")[-10:]:
+        index.remove(rid)
+    index.sync(updated, FIELDS, signature=("summary", "updated_at"))
+
+    loader = index.loader(updated, FIELDS)
+    for q in QUERIES + ["光合成だけ", "だけのノート"]:
+        assert set(index.search(q, loader=loader)) == _scan(updated, q), q
+    assert len(index) == len(updated)
+
+
+def test_rank_orders_by_occurrences():
+    store = utils.RecordStore.from_frame(pd.DataFrame([
+        {"id": "a", "text": "微分"},
+        {"id": "b", "text": "微分 微分 微分"},
+        {"id": "c", "text": "積分"},
+    ]), SCHEMA)
+    index = utils.NgramIndex(TOKEN)
+    index.sync(store, FIELDS)
+    assert index.search("微分", rank=True) == ["b", "a"]
@@ -0,0 +1,46 @@
+"""
+共有クライアント（_shared_client）のテスト。
+同じキーは1回だけ作り、時間のかかるクライアントを作っている間も他のキーは待たないことを確かめる。
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+
+
+def test_each_key_is_built_once(monkeypatch):
+    monkeypatch.setattr(utils, "_clients", {})
+    monkeypatch.setattr(utils, "_client_locks", {})
+    calls = []
+
+    def build():
+        calls.append(1)
+        time.sleep(0.05)
+        return object()
+
+    with ThreadPoolExecutor(max_workers=16) as ex:
+        clients = list(ex.map(lambda _: utils._shared_client("k", build), range(32)))
+    assert len(calls) == 1
+    assert all(c is clients[0] for c in clients)
+
+
+def test_slow_build_does_not_block_other_keys(monkeypatch):
+    monkeypatch.setattr(utils, "_clients", {})
+    monkeypatch.setattr(utils, "_client_locks", {})
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_build():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        slow = ex.submit(utils._shared_client, "easyocr", slow_build)
+        assert started.wait(5)
+        t0 = time.monotonic()
+        assert utils._shared_client("http", lambda: "fast") == "fast"
+        assert time.monotonic() - t0 < 1
+        release.set()
+        assert slow.result() == "slow"
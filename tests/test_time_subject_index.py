@@ -0,0 +1,55 @@
+"""
+時刻・科目の索引（TimeSubjectIndex）のテスト。
+期間の境界（bisect）と、追加分だけ差し込んだ索引が作り直した索引と同じになることを確かめる。
+"""
+import numpy as np
+import pandas as pd
+
+import utils
+
+SCHEMA = {"id": "", "created_at": "", "subject": "未分類", "score": 0}
+
+
+def _store() -> utils.RecordStore:
+    df = pd.DataFrame({
+        "id": ["a", "b", "c", "d", "e"],
+        "created_at": ["2026-10-03T09:00:00", "2026-10-01T09:00:00", "2026-10-02T09:00:00",
+                       "2026-10-02T09:00:00", "2026-10-05T09:00:00"],
+        "subject": ["数学", "英語", "", "数学", None],
+        "score": ["1", "x", None, "4", "5"],
+    })
+    return utils.RecordStore.from_frame(df, SCHEMA)
+
+
+def test_time_subject_index_range_boundaries():
+    store = _store()
+    index = utils.TimeSubjectIndex(store)
+    ids = store.column("id")
+
+    def select(start=None, subject=None):
+        return ids[index.select(start, subject)].tolist()
+
+    assert select() == ["e", "a", "d", "c", "b"]  # 新しい順（同時刻は並びの逆順）
+    assert select("2026-10-02T09:00:00") == ["e", "a", "d", "c"]  # 境界ちょうどは含む
+    assert select("2026-10-02T09:00:01") == ["e", "a"]
+    assert select("2026-10-06") == []
+    assert select("", "数学") == ["a", "d"]
+    assert select("2026-10-03", "数学") == ["a"]
+    assert select(None, "物理") == []
+
+
+def test_time_subject_index_with_rows_matches_rebuild():
+    store = _store()
+    index = utils.TimeSubjectIndex(store)
+    more = store.extend([
+        {"id": "f", "created_at": "2026-10-02T09:00:00", "subject": "英語"},
+        {"id": "g", "created_at": "2026-09-30T00:00:00", "subject": "数学"},
+    ])
+    patched = index.with_rows(more, [5, 6])
+    rebuilt = utils.TimeSubjectIndex(more)
+    for start in (None, "2026-10-01", "2026-10-02T09:00:00", "2026-10-04"):
+        for subject in (None, "数学", "英語"):
+            got = set(patched.select(start, subject).tolist())
+            assert got == set(rebuilt.select(start, subject).tolist())
+    assert len(index.select()) == 5  # 元の索引は変えない
+    assert isinstance(patched.order, np.ndarray)
@@ -0,0 +1,96 @@
+"""
+書き込みの後回し（WriteBehindQueue）のテスト。
+ジャーナルからの再生・失敗したときの再試行・持ち主のいないジャーナルの引き取りを確かめる。
+"""
+import json
+import os
+import threading
+
+import pytest
+
+import utils
+
+
+class _Sink:
+    """flush の代わり。fail_times 回だけ失敗してから受け取る"""
+
+    def __init__(self, fail_times: int = 0):
+        self.fail_times = fail_times
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def __call__(self, kind: str, rows: list) -> None:
+        with self._lock:
+            if self.fail_times > 0:
+                self.fail_times -= 1
+                raise ConnectionError("一時的な失敗")
+            self.batches.append((kind, list(rows)))
+
+    def rows(self, kind: str) -> list:
+        return [r for k, rows in self.batches if k == kind for r in rows]
+
+
+def _journals(directory) -> list:
+    return sorted(n for n in os.listdir(directory) if n.startswith("journal-"))
+
+
+def test_rows_are_flushed_per_kind_and_journal_is_cleared(tmp_path):
+    sink = _Sink()
+    queue = utils.WriteBehindQueue(str(tmp_path), sink, batch_size=2, interval=0.01)
+    queue.submit("history", [{"id": "a"}, {"id": "b"}, {"id": "c"}])
+    queue.submit("quiz", [{"id": "q1"}])
+    assert queue.drain(5)
+
+    assert [r["id"] for r in sink.rows("history")] == ["a", "b", "c"]
+    assert [r["id"] for r in sink.rows("quiz")] == ["q1"]
+    assert all(len(rows) <= 2 for _, rows in sink.batches)
+    assert queue.stats["depth"] == 0 and queue.stats["flushed_rows"] == 4
+    queue.close()
+    assert _journals(tmp_path) == []
+
+
+def test_failed_flush_is_retried(tmp_path):
+    sink = _Sink(fail_times=2)
+    queue = utils.WriteBehindQueue(str(tmp_path), sink, interval=0.01, max_backoff=0.05)
+    queue.submit("history", [{"id": "a"}])
+    assert queue.drain(5)
+    assert sink.rows("history") == [{"id": "a"}]
+    stats = queue.stats
+    assert stats["failures"] == 2 and stats["last_error"] is None
+    queue.close()
+
+
+def test_orphan_journal_is_replayed(tmp_path):
+    # 前に落ちたプロセスのジャーナル（最後の行は書きかけ）
+    orphan = tmp_path / "journal-crashed.jsonl"
+    lines = [json.dumps({"at": 1.0, "kind": "history", "row": {"id": rid}}) for rid in ("a", "b")]
+    orphan.write_text("\n".join(lines) + '\n{"at": 2.0, "kind": "hist', encoding="utf-8")
+
+    sink = _Sink()
+    queue = utils.WriteBehindQueue(str(tmp_path), sink, interval=0.01)
+    assert queue.drain(5)
+    assert [r["id"] for r in sink.rows("history")] == ["a", "b"]
+    assert not orphan.exists()
+    queue.close()
+
+
+@pytest.mark.skipif(utils.fcntl is None, reason="ジャーナルの持ち主の判定に fcntl が要る")
+def test_live_journal_is_not_adopted(tmp_path):
+    first_sink = _Sink(fail_times=10 ** 6)
+    first = utils.WriteBehindQueue(str(tmp_path), first_sink, interval=0.01, max_backoff=0.05)
+    first.submit("history", [{"id": "a"}])
+    assert not first.drain(0.2)
+
+    # 持ち主が動いている間は、別のキューが引き取らない（同じ行を2回書かない）
+    second_sink = _Sink()
+    second = utils.WriteBehindQueue(str(tmp_path), second_sink, interval=0.01)
+    assert second.drain(1)
+    assert second_sink.batches == []
+    assert len(_journals(tmp_path)) == 2
+
+    first_sink.fail_times = 0
+    assert first.drain(5)
+    assert first_sink.rows("history") == [{"id": "a"}]
+    first.close()
+    second.close()
+    assert _journals(tmp_path) == []
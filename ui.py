@@ -1,3 +1,6 @@
+import html
+import re
+
 import streamlit as st
 
 def inject_global_css():
@@ -122,3 +125,63 @@ def render_history_card(*, title: str, meta: str, summary: str, fulltext: str):
         """,
         unsafe_allow_html=True,
     )
+
+
+# ---- 履歴カード（HTML 文字列を作るだけ。キャッシュは呼び出し側） ----
+_RE_DETAILS = re.compile(r"<details.*?</details>", re.S)
+_RE_DIV = re.compile(r"<div.*?</div>", re.S)
+_RE_CODE = re.compile(r"```.*?```", re.S)
+_RE_TAG = re.compile(r"<[^>]+>")
+_BULLETS = ("・", "-", "•", "*")
+
+
+def clean_card_text(text: str | None) -> str:
+    """要約・全文に混ざった HTML 断片やコードブロックを取り除く"""
+    if not text:
+        return ""
+    t = _RE_DETAILS.sub("", text)
+    t = _RE_DIV.sub("", t)
+    t = _RE_CODE.sub("", t)
+    t = _RE_TAG.sub("", t)
+    return t.strip()
+
+
+def card_text_html(text: str) -> str:
+    """箇条書きなら <ul>、それ以外は <p> にする"""
+    if not text:
+        return ""
+    esc = html.escape(text)
+    lines = [ln.strip() for ln in esc.splitlines() if ln.strip()]
+    if any(ln[:1] in _BULLETS for ln in lines):
+        items = [f"<li>{(ln[1:] if ln[:1] in _BULLETS else ln).strip()}</li>" for ln in lines]
+        return "<ul>" + "".join(items) + "</ul>"
+    return "<p>" + "<br>".join(lines) + "</p>"
+
+
+def history_card_html(*, title: str, meta: str, summary: str, fulltext: str) -> str:
+    """付箋風の履歴カード（インラインCSS）。空行を含まない1つの HTML ブロックを返す"""
+    title_html = html.escape(title or "Record")
+    meta_html = html.escape(meta or "")
+    summary_html = card_text_html(clean_card_text(summary))
+    full_html = card_text_html(clean_card_text(fulltext))
+
+    parts = [
+        '<div style="background:#FFF7C2;border:1px solid #F3E19A;border-radius:12px;'
+        'padding:16px 18px;box-shadow:0 6px 20px rgba(0,0,0,.08);'
+        'position:relative;margin:8px 0 14px;">',
+        '<div style="position:absolute;top:-12px;left:50%;transform:translateX(-50%) rotate(-2deg);'
+        'width:120px;height:18px;background:rgba(255,235,130,.95);'
+        'box-shadow:0 2px 6px rgba(0,0,0,.15);border-radius:2px;"></div>',
+        f'<div style="font-weight:700;font-size:1rem;margin:0 0 2px;">{title_html}</div>',
+    ]
+    if meta_html:
+        parts.append(f'<div style="font-size:.825rem;color:#6b7280;margin:0 0 10px;">{meta_html}</div>')
+    if summary_html:
+        parts.append(f"<div>{summary_html}</div>")
+    if full_html:
+        parts.append(
+            '<details open style="margin-top:10px;"><summary>全文を表示</summary>'
+            f'<div style="margin-top:8px;white-space:pre-wrap;">{full_html}</div></details>'
+        )
+    parts.append("</div>")
+    return "".join(parts)
@@ -1,11 +1,129 @@
 import os
 import io
+import atexit
+import csv
+import hashlib
+import math
+import json
+import time
+import uuid
+import random
+import bisect
+import heapq
+import importlib.util
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import streamlit as st
 import pandas as pd
-from azure.storage.blob import BlobServiceClient
+from PIL import Image, ImageOps
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+    ResourceNotModifiedError,
+)
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient, BlobType
 from openai import AzureOpenAI
 
+try:
+    import fcntl  # ジャーナルの持ち主の判定（Linux / macOS）
+except ImportError:
+    fcntl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow が無い環境では CSV ストアだけを使う
+    pa = None
+    pq = None
+
+
+# ========== 共有クライアント ==========
+# HTTP セッション・Blob クライアント・OpenAI クライアントはプロセスで1つずつ作って使い回す
+# （呼び出しごとに作ると TLS ハンドシェイクとクライアント生成を毎回払うことになる）。
+# どれもスレッドセーフなので、Streamlit のスクリプトスレッドやワーカーから同時に使ってよい。
+# 接続プールの大きさとリトライ回数は HTTP_POOL_SIZE / HTTP_RETRY_TOTAL（環境変数）で変えられる。
+# 作るのに時間のかかるもの（EasyOCR のモデル読み込みなど）があるので、ロックはキーごとに分け、
+# 1つを作っている間も他のキーのクライアントは待たずに取れるようにする。
+_clients: dict = {}
+_client_locks: dict = {}
+_clients_lock = threading.Lock()  # _client_locks を守るだけ（build はこの外で呼ぶ）
+
+
+def _shared_client(key, build):
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            lock = _client_locks.setdefault(key, threading.Lock())
+        with lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = build()
+    return client
+
+
+def _pooled_session() -> requests.Session:
+    pool_size = int(os.getenv("HTTP_POOL_SIZE") or 16)
+    retry = Retry(
+        total=int(os.getenv("HTTP_RETRY_TOTAL") or 3),
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),  # POST（OCR 投入・チャット）は二重実行になるので自動では再送しない
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def http_session() -> requests.Session:
+    """OCR・要約・クイズの REST 呼び出しで共有する keep-alive セッション"""
+    return _shared_client("http", _pooled_session)
+
+
+def blob_container_client():
+    """接続文字列・コンテナごとに1つだけ作る ContainerClient"""
+    cs = os.getenv("AZURE_CONNECTION_STRING")
+    container = os.getenv("AZURE_CONTAINER")
+
+    def _build():
+        bsc = BlobServiceClient.from_connection_string(
+            cs,
+            transport=RequestsTransport(session=_pooled_session(), session_owner=False),
+            retry_total=int(os.getenv("HTTP_RETRY_TOTAL") or 3),
+        )
+        return bsc.get_container_client(container)
+
+    return _shared_client(("blob", cs, container), _build)
+
+
+def openai_client() -> AzureOpenAI:
+    """AzureOpenAI クライアント（エンドポイント・キー・API バージョンごとに1つ）"""
+    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    key = os.getenv("AZURE_OPENAI_API_KEY")
+    api_version = os.getenv("AZURE_OPENAI_API_VERSION")
+    return _shared_client(
+        ("openai", endpoint, key, api_version),
+        lambda: AzureOpenAI(
+            api_key=key,
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            max_retries=int(os.getenv("HTTP_RETRY_TOTAL") or 3),
+        ),
+    )
+
 
 # ========== OCR ==========
 def run_ocr(uploaded_file):
@@ -25,7 +143,7 @@ def run_ocr(uploaded_file):
     image_data = uploaded_file.read()
 
     try:
-        response = requests.post(endpoint_url, headers=headers, data=image_data)
+        response = http_session().post(endpoint_url, headers=headers, data=image_data, timeout=30)
         response.raise_for_status()
     except requests.exceptions.HTTPError as http_err:
         st.error("❌ OCRのHTTPエラーが発生しました。")
@@ -56,14 +174,185 @@ def result_to_text(result_json):
     return output_text.strip()
 
 
+# ========== OCR 前処理 ==========
+# スマホ写真（4〜12MB）をそのまま送らず、向きを直して OCR に十分な解像度まで縮め、
+# グレースケール化・コントラスト補正をしてから JPEG で詰め直す。
+def _flatten_alpha(img: "Image.Image") -> "Image.Image":
+    """透過のある画像（RGBA / LA / 透過色つきの P）は白の背景に合成する（そのまま変換すると透過部分が黒くなる）"""
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        return Image.alpha_composite(Image.new("RGBA", rgba.size, (255, 255, 255, 255)), rgba).convert("RGB")
+    return img
+
+
+def preprocess_image(
+    data: bytes,
+    *,
+    max_side: int = 2200,
+    grayscale: bool = True,
+    autocontrast: bool = True,
+    quality: int = 85,
+) -> tuple[bytes, dict]:
+    """
+    OCR に送る前の画像の前処理。(送るバイト列, 計測値) を返す。
+    読めない画像や、縮小・回転・透過の合成のどれも不要で元より大きくなる場合は元のバイト列をそのまま返す。
+    """
+    started = time.perf_counter()
+    info = {"orig_bytes": len(data), "sent_bytes": len(data), "prep_seconds": 0.0, "preprocessed": False}
+    try:
+        img = Image.open(io.BytesIO(data))
+        orig_size = img.size
+        # JPEG は読み込み時に DCT 段階で縮小できる（フル解像度でデコードしない）
+        img.draft("L" if grayscale else "RGB", (max_side, max_side))
+        exif_rotated = img.getexif().get(0x0112, 1) != 1
+        img = ImageOps.exif_transpose(img)
+        resized = max(orig_size) > max_side
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+        flat = _flatten_alpha(img)
+        flattened = flat is not img
+        img = flat.convert("L") if grayscale else flat.convert("RGB")
+        if autocontrast:
+            img = ImageOps.autocontrast(img, cutoff=1)
+
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=quality, optimize=True)
+        processed = out.getvalue()
+    except Exception as e:
+        print("[preprocess_image] skipped:", e)
+        info["prep_seconds"] = time.perf_counter() - started
+        return data, info
+
+    info["prep_seconds"] = time.perf_counter() - started
+    # 縮小・回転・透過の合成をしたものは、元より大きくても送る（元のままだと OCR の結果が変わる）
+    if len(processed) >= len(data) and not (resized or exif_rotated or flattened):
+        return data, info
+    info.update(sent_bytes=len(processed), preprocessed=True, size=img.size)
+    return processed, info
+
+
+# ========== OCR エンジン ==========
+class OcrEngine:
+    """
+    OCR のバックエンド。recognize(画像のバイト列) → テキスト。
+    version は OCR 結果キャッシュのキーに入るので、結果が変わる変更をしたら上げる。
+    """
+
+    name = "base"
+    version = "0"
+
+    def available(self) -> bool:
+        return True
+
+    def recognize(self, image_bytes: bytes, *, stats: dict | None = None) -> str:
+        raise NotImplementedError
+
+    def recognize_batch(self, images: list) -> list:
+        return [self.recognize(b) for b in images]
+
+
+class EasyOcrEngine(OcrEngine):
+    """
+    easyocr による CPU ローカル OCR。モデルはプロセスで1回だけ読み込み、全セッションで共有する。
+    推論はロックで1本ずつ流し（torch 自体が複数コアを使う）、同じ大きさの画像はまとめて推論する。
+    """
+
+    name = "easyocr"
+
+    def __init__(self, languages=("ja", "en"), batch_size: int = 16):
+        self.languages = tuple(languages)
+        self.batch_size = batch_size
+        self.version = "easyocr-" + "+".join(self.languages)
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        return importlib.util.find_spec("easyocr") is not None
+
+    def _reader(self):
+        def _build():
+            import easyocr  # torch ごと読み込むので、使うときまで import しない
+
+            return easyocr.Reader(list(self.languages), gpu=False, verbose=False)
+
+        return _shared_client(("easyocr", self.languages), _build)
+
+    @staticmethod
+    def _to_array(image_bytes: bytes) -> np.ndarray:
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+        return np.asarray(img.convert("L"))
+
+    def recognize(self, image_bytes: bytes, *, stats: dict | None = None) -> str:
+        started = time.monotonic()
+        text = self.recognize_batch([image_bytes])[0]
+        if stats is not None:
+            stats.update(polls=0, seconds=time.monotonic() - started, status="succeeded")
+        return text
+
+    def recognize_batch(self, images: list) -> list:
+        arrays = [self._to_array(b) for b in images]
+        groups: dict = {}
+        for i, arr in enumerate(arrays):
+            groups.setdefault(arr.shape, []).append(i)
+
+        reader = self._reader()
+        texts: list = [""] * len(arrays)
+        with self._lock:
+            for idx in groups.values():
+                if len(idx) == 1:
+                    results = [reader.readtext(arrays[idx[0]], detail=0, paragraph=True,
+                                               batch_size=self.batch_size)]
+                else:
+                    results = reader.readtext_batched([arrays[i] for i in idx], detail=0, paragraph=True,
+                                                      batch_size=self.batch_size)
+                for i, lines in zip(idx, results):
+                    texts[i] = "\n".join(lines).strip()
+        return texts
+
+
 # ========== 要約 ==========
-def summarize_text(text):
+# ストリーミング（stream=True）の応答は server-sent events の "data: {...}" 行で届く。
+# 差分を受け取るたびにプレースホルダへ書き出して、最初の文字が出るまでの待ち時間を短くする。
+def iter_chat_deltas(lines):
+    """Chat Completions の SSE 行（bytes / str）から本文の差分を順に取り出す"""
+    for raw in lines:
+        if not raw:
+            continue
+        line = raw.decode("utf-8") if isinstance(raw, bytes) else raw
+        if not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            continue
+        for choice in chunk.get("choices") or []:
+            piece = (choice.get("delta") or {}).get("content")
+            if piece:
+                yield piece
+
+
+def stream_to_placeholder(pieces, placeholder=None, min_interval: float = 0.05) -> str:
+    """差分を連結しながら placeholder（st.empty() など）に書き出し、最後に全文を返す"""
+    buf: list = []
+    last = 0.0
+    for piece in pieces:
+        buf.append(piece)
+        now = time.monotonic()
+        if placeholder is not None and now - last >= min_interval:
+            placeholder.markdown("".join(buf) + "▌")
+            last = now
+    text = "".join(buf).strip()
+    if placeholder is not None:
+        placeholder.markdown(text)
+    return text
+
+
+def summarize_text(text, placeholder=None):
+    """placeholder を渡すと、生成中の要約をストリーミングで書き出す"""
     try:
-        client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        )
+        client = openai_client()
 
         res = client.chat.completions.create(
             model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
@@ -72,44 +361,302 @@ def summarize_text(text):
                 {"role": "user", "content": text},
             ],
             temperature=0.3,
+            stream=placeholder is not None,
         )
+        if placeholder is not None:
+            pieces = (
+                chunk.choices[0].delta.content
+                for chunk in res
+                if chunk.choices and chunk.choices[0].delta.content
+            )
+            return stream_to_placeholder(pieces, placeholder)
         return res.choices[0].message.content.strip()
     except Exception as e:
         st.error(f"要約中にエラーが発生しました: {e}")
         return "要約できませんでした。"
 
 
+# ========== テキスト分割（トークン予算） ==========
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（かな・漢字はほぼ1文字1トークン、英数字は4文字で1トークン）"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def _split_to_budget(text: str, budget: int) -> list:
+    """
+    text を先頭から、どれも budget トークン以内になる長さで切る。
+    1文字は高々1トークンなので、英数字だけでも収まる 4*budget 文字から始め、
+    超えていたらトークン数の比で縮める（縮めるたびに必ず短くなり、1文字なら必ず収まる）。
+    """
+    budget = max(1, budget)
+    pieces = []
+    i = 0
+    while i < len(text):
+        step = 4 * budget
+        cost = estimate_tokens(text[i:i + step])
+        while cost > budget:
+            step = max(1, step * budget // cost)
+            cost = estimate_tokens(text[i:i + step])
+        pieces.append(text[i:i + step])
+        i += step
+    return pieces
+
+
+def pack_chunks(items, budget: int) -> list:
+    """
+    items: [(id, テキスト)] を、1チャンクあたり budget トークン以内になるよう順に詰める。
+    1件で予算を超えるテキストは、予算に収まる長さで区切って複数チャンクに分ける。
+    戻り値は [[(id, テキスト), ...], ...]。
+    """
+    chunks: list = []
+    current: list = []
+    used = 0
+    for item_id, text in items:
+        text = (text or "").strip()
+        if not text:
+            continue
+        pieces = _split_to_budget(text, budget) if estimate_tokens(text) > budget else [text]
+        for piece in pieces:
+            cost = estimate_tokens(piece)
+            if current and used + cost > budget:
+                chunks.append(current)
+                current, used = [], 0
+            current.append((item_id, piece))
+            used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 # ========== 追記保存 (CSV) ==========
-def save_to_azure_blob_csv_append(filename, data_dict):
+# 履歴CSVは Append Blob として保持し、1行分のバイト列だけを末尾に追記する。
+# （以前は毎回 全件ダウンロード → concat → 全件アップロード していた）
+_APPEND_BLOCK_MAX = 4 * 1024 * 1024   # append_block 1回あたりの上限
+_APPEND_BLOCK_LIMIT = 49000           # Append Blob のブロック数上限(50,000)の手前で詰め直す
+_HEADER_PROBE_BYTES = 64 * 1024
+
+# プロセス内で「Append Blob 化済み」と確認できた CSV のヘッダ列
+_append_headers: dict = {}
+_append_lock = threading.Lock()
+
+
+def _get_blob_client(filename: str):
+    return blob_container_client().get_blob_client(filename)
+
+
+def _csv_bytes(df: pd.DataFrame, header: bool) -> bytes:
+    out = io.StringIO()
+    df.to_csv(out, index=False, header=header)  # 既定: UTF-8
+    return out.getvalue().encode("utf-8")
+
+
+def _read_csv_header(bc) -> list | None:
+    """CSV の先頭行だけを取得してヘッダ列を返す（空なら None）"""
+    data = bc.download_blob(offset=0, length=_HEADER_PROBE_BYTES).readall()
+    if not data:
+        return None
+    first_line = data.decode("utf-8", errors="replace").splitlines()[0]
+    return next(csv.reader([first_line]))
+
+
+def _csv_byte_blocks(data: bytes) -> list:
     """
-    Azure Blob Storage に CSV 追記保存（pandas 既定の UTF-8 で保存）
+    CSV のバイト列を _APPEND_BLOCK_MAX 以下のブロックに分ける。
+    行の途中では切らない（他のプロセスの追記が間に入っても行が混ざらないように）。
+    引用符の中の改行は行の区切りとみなさない。1行だけで上限を超える行は、その行だけのブロックにする。
+    """
+    blocks = []
+    start = cut = pos = 0
+    quotes = 0
+    while True:
+        nl = data.find(b"\n", pos)
+        if nl < 0:
+            break
+        quotes += data.count(b'"', pos, nl)
+        pos = nl + 1
+        if quotes % 2:
+            continue  # 引用符の中の改行
+        if pos - start > _APPEND_BLOCK_MAX and cut > start:
+            blocks.append(data[start:cut])
+            start = cut
+        cut = pos
+    if start < len(data):
+        blocks.append(data[start:])
+    return blocks
+
+
+def _csv_row_blocks(df: pd.DataFrame) -> list:
+    """追記用の CSV バイト列を、行の途中で切らずに _APPEND_BLOCK_MAX 以下のブロックに分ける"""
+    return _csv_byte_blocks(_csv_bytes(df, header=False))
+
+
+def _upload_as_append_blob(bc, data: bytes, etag: str | None = None) -> None:
+    """
+    data で Append Blob を作り直す（移行・列追加・詰め直し用）。
+    etag を渡すと、読んでから他の書き込みが入っていたら ResourceModifiedError で失敗する。
+
+    作り直し（空の Blob の作成 → ブロックの追記）の間に他のプロセスが行を追記しても失わないように、
+    自分のブロックは appendpos_condition 付きで書き、割り込まれたらその行を末尾に回して作り直す。
+    """
+    if data and not data.endswith(b"\n"):
+        data += b"\n"
+    kwargs = {}
+    if etag:
+        kwargs = {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+
+    tail_from = None  # 割り込まれた位置（ここから後ろは他のプロセスが追記した行）
+    for attempt in range(8):
+        if tail_from is not None:
+            time.sleep(random.uniform(0.05, 0.2) * attempt)
+            dl = bc.download_blob(offset=tail_from)
+            extra = dl.readall()
+            data += extra
+            tail_from += len(extra)
+            kwargs = {"etag": dl.properties.etag, "match_condition": MatchConditions.IfNotModified}
+        try:
+            bc.create_append_blob(**kwargs)
+        except ResourceModifiedError:
+            if tail_from is None:
+                raise
+            continue  # 取り込んだ後にさらに追記された
+
+        pos = 0
+        try:
+            for block in _csv_byte_blocks(data):
+                bc.append_block(block, appendpos_condition=pos)
+                pos += len(block)
+            return
+        except HttpResponseError as e:
+            if getattr(e, "status_code", None) != 412:
+                raise
+            tail_from = pos
+    raise RuntimeError("Append Blob の作り直しが競合し続けました。")
+
+
+def migrate_csv_to_append_blob(filename: str) -> bool:
     """
+    既存の Block Blob の CSV を、同じ名前の Append Blob に一度だけ移行する。
+    移行した場合 True、既に Append Blob / 存在しない場合 False。
+    """
+    bc = _get_blob_client(filename)
     try:
-        cs = os.getenv("AZURE_CONNECTION_STRING")
-        container = os.getenv("AZURE_CONTAINER")
+        props = bc.get_blob_properties()
+    except ResourceNotFoundError:
+        return False
+    if props.blob_type == BlobType.APPENDBLOB:
+        return False
 
-        bsc = BlobServiceClient.from_connection_string(cs)
-        bc = bsc.get_blob_client(container=container, blob=filename)
+    data = bc.download_blob(etag=props.etag, match_condition=MatchConditions.IfNotModified).readall()
+    _upload_as_append_blob(bc, data, etag=props.etag)
+    return True
 
-        new_row = pd.DataFrame([data_dict])
 
-        # 既存CSVを読み込み（あれば）
+def _rewrite_csv(bc, new_rows: pd.DataFrame | None) -> list:
+    """
+    列が増えたとき・ブロック数が上限に近いときだけ全体を書き直す。
+    途中で他の書き込みが入った場合（ETag 不一致）はやり直す。
+    戻り値は書き直し後のヘッダ列。
+    """
+    for attempt in range(8):
+        props = bc.get_blob_properties()
+        buf = io.BytesIO()
         try:
-            buf = io.BytesIO()
-            bc.download_blob().readinto(buf)
+            bc.download_blob(etag=props.etag, match_condition=MatchConditions.IfNotModified).readinto(buf)
             buf.seek(0)
-            existing = pd.read_csv(buf)  # 既定: UTF-8
-            df = pd.concat([existing, new_row], ignore_index=True)
-        except Exception:
-            # 初回 or まだCSVがない
-            df = new_row
+            df = pd.read_csv(buf) if buf.getbuffer().nbytes else pd.DataFrame()
+            if new_rows is not None:
+                # 新しい列は末尾に付く。古いヘッダを覚えている他のプロセスの行は、足りない列が空になるだけ
+                df = pd.concat([df, new_rows], ignore_index=True)
+            _upload_as_append_blob(bc, _csv_bytes(df, header=True), etag=props.etag)
+            return list(df.columns)
+        except ResourceModifiedError:
+            time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+    raise RuntimeError("CSV の書き直しが競合し続けました。")
 
-        out = io.BytesIO()
-        df.to_csv(out, index=False)  # 既定: UTF-8
-        out.seek(0)
-        bc.upload_blob(out, overwrite=True)
+
+def _ensure_append_blob(bc, filename: str, columns: list) -> list:
+    """
+    filename が Append Blob でヘッダ行を持つ状態にして、そのヘッダ列を返す。
+    結果はプロセス内でキャッシュするので、2回目以降の保存では通信しない。
+    """
+    with _append_lock:
+        cached = _append_headers.get(filename)
+    if cached is not None:
+        return cached
+
+    try:
+        migrate_csv_to_append_blob(filename)
+    except ResourceModifiedError:
+        pass  # 他のプロセスが同時に移行した
+    try:
+        bc.create_append_blob(etag="*", match_condition=MatchConditions.IfMissing)
+    except ResourceExistsError:
+        pass
+
+    header = None
+    for _ in range(5):
+        header = _read_csv_header(bc)
+        if header:
+            break
+        # 空の Blob: 先頭(位置0)に書けた1人だけがヘッダを書く
+        try:
+            bc.append_block(_csv_bytes(pd.DataFrame(columns=columns), header=True),
+                            appendpos_condition=0)
+            header = list(columns)
+            break
+        except HttpResponseError:
+            time.sleep(0.2)
+    if not header:
+        raise RuntimeError(f"{filename} のヘッダ行を確定できませんでした。")
+
+    with _append_lock:
+        _append_headers[filename] = header
+    return header
+
+
+def append_rows_to_azure_blob_csv(filename: str, rows: list) -> None:
+    """
+    rows (list[dict]) を CSV 末尾に追記する。転送量は追記する行の分だけ。
+    """
+    if not rows:
+        return
+    bc = _get_blob_client(filename)
+    new_rows = pd.DataFrame(rows)
+    header = _ensure_append_blob(bc, filename, list(new_rows.columns))
+
+    if any(c not in header for c in new_rows.columns):
+        # 新しい列が増えたときだけ全体を書き直す（まれ）
+        header = _rewrite_csv(bc, new_rows)
+        with _append_lock:
+            _append_headers[filename] = header
+        return
+
+    # 読み込みも条件も要らない追記だけで書く（同時に保存しても行は失われない）
+    for block in _csv_row_blocks(new_rows.reindex(columns=header)):
+        res = bc.append_block(block)
+
+    if int(res.get("blob_committed_block_count") or 0) >= _APPEND_BLOCK_LIMIT:
+        try:
+            _rewrite_csv(bc, None)
+        except Exception as e:
+            # 行はもう保存できている。詰め直しは次の保存でやり直す
+            print("[append_rows_to_azure_blob_csv] repack error:", filename, e)
+
+
+def save_to_azure_blob_csv_append(filename, data_dict):
+    """
+    Azure Blob Storage に CSV 追記保存（pandas 既定の UTF-8 で保存）
+    既存CSVはダウンロードせず、Append Blob に1行分だけ追記する。保存できたら True を返す。
+    """
+    try:
+        append_rows_to_azure_blob_csv(filename, [data_dict])
+        return True
     except Exception as e:
         st.error(f"CSV保存中にエラーが発生しました: {e}")
+        return False
 
 
 # ========== 履歴読み込み ==========
@@ -118,17 +665,2000 @@ def load_csv_from_blob(filename: str, encoding: str = "utf-8") -> pd.DataFrame:
     Azure Blob Storage 上の CSV を DataFrame で読み込む。
     まず UTF-8 で試し、失敗したら CP932（Shift_JIS）で救済。
     """
-    cs = os.getenv("AZURE_CONNECTION_STRING")
-    container = os.getenv("AZURE_CONTAINER")
-
-    bsc = BlobServiceClient.from_connection_string(cs)
-    bc = bsc.get_blob_client(container=container, blob=filename)
+    bc = _get_blob_client(filename)
 
     buf = io.BytesIO()
     bc.download_blob().readinto(buf)
+    if not buf.getbuffer().nbytes:
+        # 作られた直後（ヘッダ行を書く前）の Append Blob
+        return pd.DataFrame()
     buf.seek(0)
     try:
         return pd.read_csv(buf, encoding=encoding)
     except Exception:
         buf.seek(0)
-        return pd.read_csv(buf, encoding="cp932", errors="replace")
+        return pd.read_csv(buf, encoding="cp932", encoding_errors="replace")
+
+
+# ========== 削除・修正（トゥームストーン / パッチ） ==========
+PATCH_COLUMNS = ["op_id", "at", "target", "op", "changes"]
+
+
+class PatchLog:
+    """
+    履歴の削除・修正を小さな行（トゥームストーン / パッチ）として Append Blob の CSV に追記する。
+    削除・修正1回は1行の追記だけで済み、履歴本体は読むときに apply で反映する。
+    溜まった行は HistoryStore.compact で本体に畳み込んでから消す。
+    """
+
+    def __init__(self, blob_name: str):
+        self.blob_name = blob_name
+
+    def _append(self, target, op: str, changes: dict) -> None:
+        append_rows_to_azure_blob_csv(self.blob_name, [{
+            "op_id": uuid.uuid4().hex,
+            "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "target": str(target),
+            "op": op,
+            "changes": json.dumps(changes, ensure_ascii=False),
+        }])
+
+    def delete(self, target) -> None:
+        self._append(target, "delete", {})
+
+    def update(self, target, changes: dict) -> None:
+        self._append(target, "update", changes)
+
+    def load(self) -> pd.DataFrame:
+        try:
+            df = load_csv_from_blob(self.blob_name)
+        except ResourceNotFoundError:
+            return pd.DataFrame(columns=PATCH_COLUMNS)
+        return df.reindex(columns=PATCH_COLUMNS).fillna("").astype(str)
+
+    @staticmethod
+    def apply(df: pd.DataFrame, patches: pd.DataFrame | None, key: str = "id") -> pd.DataFrame:
+        """重複行（同じ key）を後勝ちで1行にし、パッチを記録順に反映する"""
+        if key not in df.columns or df.empty:
+            return df
+        df = df.drop_duplicates(subset=key, keep="last")
+        if patches is None or patches.empty:
+            return df
+
+        deleted: set = set()
+        updates: dict = {}
+        for target, op, changes in zip(patches["target"], patches["op"], patches["changes"]):
+            if op == "delete":
+                deleted.add(target)
+                updates.pop(target, None)
+            elif op == "update" and target not in deleted:
+                updates.setdefault(target, {}).update(json.loads(changes or "{}"))
+
+        keys = df[key].astype(str)
+        if deleted:
+            df = df[~keys.isin(deleted).to_numpy()]
+            keys = df[key].astype(str)
+        if updates:
+            df = df.copy()
+            # 本体にまだ無い列（後から増えた updated_at など）は末尾に足す
+            for col in dict.fromkeys(c for changes in updates.values() for c in changes):
+                if col not in df.columns and col != key:
+                    df[col] = ""
+            for target, changes in updates.items():
+                mask = (keys == target).to_numpy()
+                if not mask.any():
+                    continue
+                for col, value in changes.items():
+                    if col != key:
+                        df.loc[mask, col] = value
+        return df
+
+    @staticmethod
+    def settled(patches: pd.DataFrame, ids, max_age_seconds: float = 86400) -> pd.DataFrame:
+        """
+        畳み込んだら消してよいパッチ（対象の行が本体にある・または十分古いもの）。
+        対象がまだ本体に無いパッチは、後から届く行（書き込みの後回し中など）のために残す。
+        """
+        cutoff = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(time.time() - max_age_seconds))
+        return patches[patches["target"].isin(set(ids)).to_numpy() | (patches["at"] < cutoff).to_numpy()]
+
+    def remove(self, op_ids: set) -> None:
+        """本体に畳み込んだパッチ行を消す（ETag 付きで書き直し、その間に追記されたらやり直す）"""
+        bc = _get_blob_client(self.blob_name)
+        for attempt in range(5):
+            try:
+                props = bc.get_blob_properties()
+            except ResourceNotFoundError:
+                return
+            buf = io.BytesIO()
+            bc.download_blob(etag=props.etag, match_condition=MatchConditions.IfNotModified).readinto(buf)
+            buf.seek(0)
+            df = pd.read_csv(buf, dtype=str) if buf.getbuffer().nbytes else pd.DataFrame(columns=PATCH_COLUMNS)
+            rest = df[~df["op_id"].isin(op_ids)]
+            try:
+                _upload_as_append_blob(bc, _csv_bytes(rest, header=True), etag=props.etag)
+                return
+            except ResourceModifiedError:
+                time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+        raise RuntimeError(f"{self.blob_name} の書き直しが競合し続けました。")
+
+
+def _backfill_ids(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    id の無い行（id 列が無かった頃の行）に、行の内容から決まる id を振る。
+    同じ内容の重複行は同じ id になるので、apply の重複除去でまとめて1行になる。
+    """
+    if "id" not in df.columns:
+        df = df.assign(id="")
+    missing = (df["id"].isna() | (df["id"].astype(str) == "")).to_numpy()
+    if missing.any():
+        rest = df.loc[missing, [c for c in df.columns if c != "id"]].astype(str)
+        df = df.copy()
+        df.loc[missing, "id"] = [
+            "legacy-" + hashlib.sha1("\x1f".join(row).encode("utf-8")).hexdigest()[:16]
+            for row in rest.itertuples(index=False)
+        ]
+    return df
+
+
+# ========== 履歴ストア ==========
+HISTORY_COLUMNS = ["id", "created_at", "filename", "text", "summary", "subject", "updated_at"]
+
+
+def _download_bytes(name: str) -> bytes:
+    return _get_blob_client(name).download_blob().readall()
+
+
+def _upload_bytes(name: str, data: bytes, overwrite: bool = True) -> None:
+    _get_blob_client(name).upload_blob(data, overwrite=overwrite)
+
+
+def _delete_blob_quietly(name: str) -> None:
+    try:
+        _get_blob_client(name).delete_blob()
+    except ResourceNotFoundError:
+        pass
+    except Exception as e:
+        print("[_delete_blob_quietly] error:", name, e)
+
+
+class HistoryStore:
+    """履歴の保存先（CSV / Parquet）を差し替えるための共通インターフェース"""
+
+    def append(self, rows: list) -> None:
+        """rows (list[dict]) を追記する"""
+        raise NotImplementedError
+
+    def load(self, columns: list | None = None, since: str | None = None) -> pd.DataFrame:
+        """columns の列だけ、created_at が since 以降の行だけを読む"""
+        raise NotImplementedError
+
+    def load_text(self, ids) -> dict:
+        """id → OCR全文 の dict を返す（一覧読み込みで全文を省いたとき用）"""
+        raise NotImplementedError
+
+    @property
+    def version_blob(self) -> str:
+        """内容が変わると ETag が変わる Blob 名（スナップショットの再検証に使う）"""
+        raise NotImplementedError
+
+    # ---- 削除・修正（patches があるときだけ） ----
+    patches: PatchLog | None = None
+
+    @property
+    def version_blobs(self) -> tuple:
+        """スナップショットの再検証で見る Blob 名（本体 ＋ パッチ）"""
+        return (self.version_blob,) + ((self.patches.blob_name,) if self.patches else ())
+
+    def delete(self, row_id) -> None:
+        """1行削除する（パッチを1行追記するだけ）"""
+        self.patches.delete(row_id)
+
+    def update(self, row_id, changes: dict) -> None:
+        """1行の列を書き換える（パッチを1行追記するだけ）"""
+        self.patches.update(row_id, changes)
+
+    def compact(self) -> bool:
+        """パッチを本体に畳み込み、重複行を除く。書き直したら True"""
+        return False
+
+
+class CsvHistoryStore(HistoryStore):
+    """従来の単一CSV（Append Blob）。Parquet ストアの移行元としても使う"""
+
+    def __init__(self, blob_name: str, patches: PatchLog | None = None, default_columns=None):
+        self.blob_name = blob_name
+        self.patches = patches
+        self.default_columns = list(default_columns or HISTORY_COLUMNS)
+        self._texts: dict = {}
+
+    @property
+    def version_blob(self) -> str:
+        return self.blob_name
+
+    def append(self, rows: list) -> None:
+        append_rows_to_azure_blob_csv(self.blob_name, rows)
+
+    def load(self, columns: list | None = None, since: str | None = None) -> pd.DataFrame:
+        try:
+            df = load_csv_from_blob(self.blob_name)
+        except ResourceNotFoundError:
+            return pd.DataFrame(columns=columns or self.default_columns)
+
+        if self.patches is not None:
+            df = PatchLog.apply(_backfill_ids(df), self.patches.load())
+        if "id" in df.columns and "text" in df.columns:
+            self._texts = dict(zip(df["id"].astype(str), df["text"].fillna("").astype(str)))
+        if since and "created_at" in df.columns:
+            df = df[df["created_at"].astype(str) >= since]
+        if columns:
+            df = df.reindex(columns=columns)
+        return df
+
+    def load_text(self, ids) -> dict:
+        if not self._texts:
+            self.load()
+        return {i: self._texts.get(i, "") for i in ids}
+
+    def compact(self) -> bool:
+        if self.patches is None:
+            return False
+        patches = self.patches.load()
+        bc = _get_blob_client(self.blob_name)
+        try:
+            props = bc.get_blob_properties()
+        except ResourceNotFoundError:
+            return False
+        buf = io.BytesIO()
+        bc.download_blob(etag=props.etag, match_condition=MatchConditions.IfNotModified).readinto(buf)
+        buf.seek(0)
+        # load() と同じ読み方にする（id の無い行に振る id が load() のときと一致するように）
+        raw = pd.read_csv(buf) if buf.getbuffer().nbytes else pd.DataFrame()
+        if raw.empty:
+            return False
+        needs_ids = "id" not in raw.columns or raw["id"].isna().any()
+        raw = _backfill_ids(raw)
+        patches = PatchLog.settled(patches, raw["id"].astype(str))
+        df = PatchLog.apply(raw, patches)
+        if patches.empty and len(df) == len(raw) and not needs_ids:
+            return False
+
+        # 途中で追記が入っていたら（ETag 不一致）書き直さず、次の回に回す
+        _upload_as_append_blob(bc, _csv_bytes(df, header=True), etag=props.etag)
+        with _append_lock:
+            _append_headers[self.blob_name] = list(df.columns)
+        if not patches.empty:
+            self.patches.remove(set(patches["op_id"]))
+        return True
+
+
+class ParquetHistoryStore(HistoryStore):
+    """
+    月ごとのパーティション（created_at の YYYY-MM）に分けた Parquet シャード＋マニフェスト(JSON)。
+    一覧用の列（meta）と OCR全文（text）は別ファイルに分けてあり、
+    起動時は meta の必要な月だけを読めばよい。シャードは書き込み後に変更しない。
+    """
+
+    META_COLUMNS = ["id", "created_at", "filename", "summary", "subject", "updated_at"]
+    MAX_SHARDS_PER_PARTITION = 16
+    TEXT_CACHE_SHARDS = 64
+    COMPACTION_LEASE_SECONDS = 600
+
+    def __init__(self, prefix: str, legacy: HistoryStore | None = None, patches: PatchLog | None = None):
+        self.prefix = prefix.rstrip("/")
+        self.legacy = legacy
+        self.patches = patches
+        self._patches_df = None
+        self._imported = False
+        self._lock = threading.Lock()
+        self._lease_owner = uuid.uuid4().hex
+        self._id_to_text_shard: dict = {}
+        self._text_cache: "OrderedDict[str, dict]" = OrderedDict()
+
+    # ---- マニフェスト ----
+    @property
+    def manifest_name(self) -> str:
+        return f"{self.prefix}/_manifest.json"
+
+    @property
+    def version_blob(self) -> str:
+        return self.manifest_name
+
+    def _read_manifest(self):
+        """(manifest, etag) を返す。まだ無ければ (None, None)"""
+        try:
+            dl = _get_blob_client(self.manifest_name).download_blob()
+            return json.loads(dl.readall().decode("utf-8")), dl.properties.etag
+        except ResourceNotFoundError:
+            return None, None
+
+    def _update_manifest(self, fn) -> dict:
+        """
+        manifest を fn で書き換えて保存する。
+        他のプロセスと競合したら（ETag 不一致）読み直してやり直す。
+        """
+        bc = _get_blob_client(self.manifest_name)
+        for attempt in range(8):
+            manifest, etag = self._read_manifest()
+            manifest = fn(manifest or {"version": 1, "shards": []})
+            data = json.dumps(manifest, ensure_ascii=False).encode("utf-8")
+            try:
+                if etag:
+                    bc.upload_blob(data, overwrite=True, etag=etag,
+                                   match_condition=MatchConditions.IfNotModified)
+                else:
+                    bc.upload_blob(data, overwrite=True, etag="*",
+                                   match_condition=MatchConditions.IfMissing)
+                return manifest
+            except (ResourceModifiedError, ResourceExistsError):
+                time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+        raise RuntimeError("マニフェストの更新が競合し続けました。")
+
+    # ---- シャード書き込み ----
+    @staticmethod
+    def _partition(created_at) -> str:
+        v = str(created_at or "")
+        return v[:7] if len(v) >= 7 and v[4] == "-" else "unknown"
+
+    @staticmethod
+    def _parquet_bytes(df: pd.DataFrame) -> bytes:
+        buf = io.BytesIO()
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buf, compression="zstd")
+        return buf.getvalue()
+
+    def _write_shards(self, df: pd.DataFrame) -> list:
+        """df をパーティションごとのシャード（meta / text の2ファイル）として書き、manifest 用エントリを返す"""
+        df = df.reindex(columns=HISTORY_COLUMNS).fillna("").astype(str)
+        entries = []
+        for part, g in df.groupby(df["created_at"].map(self._partition)):
+            base = f"{self.prefix}/dt={part}/part-{_shard_stamp()}-{uuid.uuid4().hex[:8]}"
+            entry = {
+                "partition": part,
+                "meta": base + ".meta.parquet",
+                "text": base + ".text.parquet",
+                "rows": int(len(g)),
+                "min_created_at": str(g["created_at"].min()),
+                "max_created_at": str(g["created_at"].max()),
+            }
+            _upload_bytes(entry["text"], self._parquet_bytes(g[["id", "text"]]), overwrite=False)
+            _upload_bytes(entry["meta"], self._parquet_bytes(g[self.META_COLUMNS]), overwrite=False)
+            entries.append(entry)
+        return entries
+
+    def _ensure_imported(self) -> None:
+        """旧CSVの内容を一度だけシャードへ取り込む"""
+        if self._imported:
+            return
+        manifest, _ = self._read_manifest()
+        if manifest is None or not manifest.get("legacy_imported"):
+            legacy_df = self.legacy.load() if self.legacy is not None else pd.DataFrame()
+            entries = self._write_shards(legacy_df) if not legacy_df.empty else []
+
+            def _apply(m):
+                if m.get("legacy_imported"):
+                    return m  # 他のプロセスが先に取り込んだ
+                m["shards"].extend(entries)
+                m["legacy_imported"] = True
+                return m
+
+            result = self._update_manifest(_apply)
+            written = {e["meta"] for e in entries}
+            if written and not written & {s["meta"] for s in result["shards"]}:
+                self._delete_shards(entries)
+        self._imported = True
+
+    def append(self, rows: list) -> None:
+        if not rows:
+            return
+        self._ensure_imported()
+        entries = self._write_shards(pd.DataFrame(rows))
+
+        def _apply(m):
+            m["shards"].extend(entries)
+            return m
+
+        # 小さなシャードが溜まっても、まとめるのは compact()（畳み込みスレッド）に任せる
+        try:
+            self._update_manifest(_apply)
+        except Exception:
+            self._delete_shards(entries)  # manifest に載らなかったシャードは誰も読まない
+            raise
+
+    def _rewrite_partition(self, manifest: dict, partition: str, transform=None) -> bool:
+        """
+        パーティションのシャードを読み、transform(df) を通して1つのシャードに書き直す。
+        他のプロセスが先に同じシャードを書き換えていたら何もしない（False）。
+        """
+        olds = [s for s in manifest["shards"] if s["partition"] == partition]
+        new_entries: list = []
+        try:
+            df = pd.concat([self._read_shard(s, HISTORY_COLUMNS) for s in olds], ignore_index=True)
+            if transform is not None:
+                df = transform(df)
+            new_entries = self._write_shards(df)
+            old_names = {s["meta"] for s in olds}
+
+            def _apply(m):
+                if not old_names <= {s["meta"] for s in m["shards"]}:
+                    raise _CompactionConflict()
+                m["shards"] = [s for s in m["shards"] if s["meta"] not in old_names] + new_entries
+                return m
+
+            self._update_manifest(_apply)
+        except _CompactionConflict:
+            self._delete_shards(new_entries)
+            return False
+        except Exception as e:
+            print("[ParquetHistoryStore] compaction error:", partition, e)
+            self._delete_shards(new_entries)  # manifest に載らなかった書きかけのシャード
+            return False
+        self._delete_shards(olds)
+        return True
+
+    @staticmethod
+    def _delete_shards(entries: list) -> None:
+        for e in entries:
+            _delete_blob_quietly(e["meta"])
+            _delete_blob_quietly(e["text"])
+
+    # ---- 畳み込みのリース（同時に畳み込むのは全プロセスで1つだけ） ----
+    @property
+    def lease_name(self) -> str:
+        return f"{self.prefix}/_compaction_lease.json"
+
+    def _acquire_lease(self) -> bool:
+        """他のプロセスが期限内のリースを持っていなければ取る。取れたら True"""
+        now = time.time()
+
+        def _apply(lease):
+            if lease.get("owner") not in (None, self._lease_owner) and lease.get("expires_at", 0) > now:
+                return None
+            return {"owner": self._lease_owner, "expires_at": now + self.COMPACTION_LEASE_SECONDS}
+
+        return (update_json_blob(self.lease_name, _apply, empty={}) or {}).get("owner") == self._lease_owner
+
+    def _release_lease(self) -> None:
+        try:
+            update_json_blob(self.lease_name,
+                             lambda lease: {} if lease.get("owner") == self._lease_owner else None, empty={})
+        except Exception as e:
+            print("[ParquetHistoryStore] lease release error:", e)
+
+    def compact(self) -> bool:
+        """
+        パッチの対象を含むパーティション・id が重複しているパーティション・
+        小さなシャードが MAX_SHARDS_PER_PARTITION を超えて溜まったパーティションを書き直す。
+        すべて書き直せたら、畳み込んだパッチ行を消す。
+        他のプロセスが畳み込み中（リースを持っている）なら何もしない。
+        """
+        if not self._acquire_lease():
+            return False
+        try:
+            return self._compact()
+        finally:
+            self._release_lease()
+
+    def _compact(self) -> bool:
+        self._ensure_imported()
+        patches = self.patches.load() if self.patches is not None else pd.DataFrame(columns=PATCH_COLUMNS)
+        manifest, _ = self._read_manifest()
+        if not manifest or not manifest.get("shards"):
+            return False
+
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            id_frames = list(ex.map(lambda sh: self._read_shard(sh, ["id"]), manifest["shards"]))
+        ids_by_partition: dict = {}
+        for shard, ids in zip(manifest["shards"], id_frames):
+            ids_by_partition.setdefault(shard["partition"], []).extend(ids["id"].astype(str).tolist())
+        patches = PatchLog.settled(patches, (i for ids in ids_by_partition.values() for i in ids))
+        targets = set(patches["target"])
+        partitions = [
+            part for part, ids in ids_by_partition.items()
+            if targets.intersection(ids) or len(set(ids)) < len(ids)
+            or sum(1 for sh in manifest["shards"] if sh["partition"] == part) > self.MAX_SHARDS_PER_PARTITION
+        ]
+        if not partitions and patches.empty:
+            return False
+
+        ok = all([
+            self._rewrite_partition(manifest, part, transform=lambda df: PatchLog.apply(df, patches))
+            for part in partitions
+        ])
+        if ok and not patches.empty:
+            self.patches.remove(set(patches["op_id"]))
+        return bool(partitions) or ok
+
+    # ---- 読み込み ----
+    def _read_text_shard(self, name: str) -> dict:
+        with self._lock:
+            hit = self._text_cache.get(name)
+            if hit is not None:
+                self._text_cache.move_to_end(name)
+                return hit
+        table = pq.read_table(io.BytesIO(_download_bytes(name)), columns=["id", "text"])
+        texts = dict(zip(table.column("id").to_pylist(), table.column("text").to_pylist()))
+        with self._lock:
+            self._text_cache[name] = texts
+            while len(self._text_cache) > self.TEXT_CACHE_SHARDS:
+                self._text_cache.popitem(last=False)
+        return texts
+
+    def _read_shard(self, shard: dict, columns: list) -> pd.DataFrame:
+        meta = pq.ParquetFile(io.BytesIO(_download_bytes(shard["meta"])))
+        wanted = [c for c in self.META_COLUMNS if c in columns or c == "id"]
+        meta_cols = [c for c in wanted if c in meta.schema_arrow.names]
+        df = meta.read(columns=meta_cols).to_pandas()
+        for c in wanted:
+            if c not in meta_cols:
+                df[c] = ""  # 列が増える前に書いたシャード
+        with self._lock:
+            for rid in df["id"]:
+                self._id_to_text_shard[rid] = shard["text"]
+        if "text" in columns:
+            df["text"] = df["id"].map(self._read_text_shard(shard["text"])).fillna("")
+        return df
+
+    def load(self, columns: list | None = None, since: str | None = None) -> pd.DataFrame:
+        columns = list(columns or HISTORY_COLUMNS)
+        self._ensure_imported()
+        for attempt in range(2):
+            manifest, _ = self._read_manifest()
+            shards = [
+                s for s in (manifest or {}).get("shards", [])
+                if not since or s["max_created_at"] >= since
+            ]
+            try:
+                with ThreadPoolExecutor(max_workers=8) as ex:
+                    frames = list(ex.map(lambda s: self._read_shard(s, columns), shards))
+                break
+            except ResourceNotFoundError:
+                # 読んでいる間にまとめ直された → マニフェストから読み直す
+                if attempt == 1:
+                    raise
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        df = pd.concat(frames, ignore_index=True)
+        if self.patches is not None:
+            self._patches_df = self.patches.load()
+            df = PatchLog.apply(df, self._patches_df)
+        if since:
+            df = df[df["created_at"] >= since]
+        return df.reindex(columns=columns)
+
+    def load_text(self, ids) -> dict:
+        ids = list(ids)
+        with self._lock:
+            missing = [i for i in ids if i not in self._id_to_text_shard]
+        if missing:
+            self.load(columns=["id"])  # id → シャードの対応を作り直す
+        by_shard: dict = {}
+        with self._lock:
+            for i in ids:
+                shard = self._id_to_text_shard.get(i)
+                if shard:
+                    by_shard.setdefault(shard, []).append(i)
+        out = {i: "" for i in ids}
+        for shard, shard_ids in by_shard.items():
+            texts = self._read_text_shard(shard)
+            for i in shard_ids:
+                out[i] = texts.get(i, "") or ""
+        if self._patches_df is not None and not self._patches_df.empty:
+            # 全文の修正・削除もパッチから反映する（パッチは直近の load() で読んだもの）
+            patched = PatchLog.apply(pd.DataFrame({"id": list(out), "text": list(out.values())}), self._patches_df)
+            out = {i: "" for i in ids} | dict(zip(patched["id"], patched["text"]))
+        return out
+
+
+class _CompactionConflict(Exception):
+    pass
+
+
+def _shard_stamp() -> str:
+    return time.strftime("%Y%m%dT%H%M%S")
+
+
+def make_history_store(kind: str, csv_blob: str) -> HistoryStore:
+    """
+    kind: "parquet"（既定）/ "csv"
+    Parquet ストアは csv_blob の拡張子を除いた名前をプレフィックスにし、旧CSVを一度だけ取り込む。
+    """
+    patches = PatchLog(os.path.splitext(csv_blob)[0] + ".patches.csv")
+    if kind == "csv" or pq is None:
+        if kind != "csv":
+            print("[make_history_store] pyarrow が無いため CSV ストアを使います")
+        return CsvHistoryStore(csv_blob, patches=patches)
+    return ParquetHistoryStore(os.path.splitext(csv_blob)[0], legacy=CsvHistoryStore(csv_blob), patches=patches)
+
+
+# ========== 共有スナップショット ==========
+class SharedSnapshot:
+    """
+    プロセス全体で共有する読み取り専用の履歴スナップショット。
+    Blob の ETag を条件付きリクエスト（If-None-Match）で確認し、変わっていなければ再ダウンロードしない。
+    確認も min_interval 秒に1回までにする。
+    """
+
+    def __init__(self, blob_name, loader, empty=(), min_interval: float = 10.0):
+        # blob_name はタプルでもよい（本体 ＋ パッチなど）。そのときの version は ETag のタプル
+        self.blob_name = blob_name
+        self.loader = loader
+        self.min_interval = min_interval
+        self._value = empty
+        self._version = None
+        self._loaded = False
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _etag_of(name: str, previous):
+        """今の ETag を返す（変わっていなければ本体は転送されない）。Blob が無ければ None"""
+        bc = _get_blob_client(name)
+        try:
+            if previous:
+                props = bc.get_blob_properties(etag=previous,
+                                               match_condition=MatchConditions.IfModified)
+            else:
+                props = bc.get_blob_properties()
+            return props.etag
+        except ResourceNotModifiedError:
+            return previous
+        except ResourceNotFoundError:
+            return None
+
+    def _current_etag(self):
+        if isinstance(self.blob_name, str):
+            return self._etag_of(self.blob_name, self._version)
+        previous = self._version or (None,) * len(self.blob_name)
+        return tuple(self._etag_of(n, p) for n, p in zip(self.blob_name, previous))
+
+    def get(self):
+        """(version, value) を返す。value は全セッションで共有するので書き換えないこと"""
+        with self._lock:
+            now = time.monotonic()
+            if self._loaded and now - self._checked_at < self.min_interval:
+                return self._version, self._value
+            self._checked_at = now
+
+            try:
+                etag = self._current_etag()
+            except Exception as e:
+                print("[SharedSnapshot] revalidate error:", self.blob_name, e)
+                if self._loaded:
+                    return self._version, self._value
+                etag = None
+
+            if self._loaded and etag == self._version:
+                return self._version, self._value
+
+            try:
+                self._value = self.loader()
+                self._version = etag
+                self._loaded = True
+            except Exception as e:
+                print("[SharedSnapshot] load error:", self.blob_name, e)
+            return self._version, self._value
+
+    def invalidate(self) -> None:
+        """次の get() で必ず再検証させる"""
+        with self._lock:
+            self._checked_at = 0.0
+
+
+# ========== JSON Blob（ETag 付きの読み書き） ==========
+def read_json_blob(name: str):
+    """(内容, etag) を返す。まだ無ければ (None, None)"""
+    try:
+        dl = _get_blob_client(name).download_blob()
+        return json.loads(dl.readall().decode("utf-8")), dl.properties.etag
+    except ResourceNotFoundError:
+        return None, None
+
+
+def delete_json_blob(name: str) -> None:
+    """JSON の Blob を消す（次に読む側で作り直させるとき用）。無ければ何もしない"""
+    _delete_blob_quietly(name)
+
+
+def update_json_blob(name: str, fn, empty=None):
+    """
+    JSON の Blob を fn(現在の内容) の戻り値で置き換える。fn が None を返したら書き込まない。
+    他のプロセスと競合したら（ETag 不一致）読み直して fn からやり直す。
+    """
+    bc = _get_blob_client(name)
+    for attempt in range(8):
+        current, etag = read_json_blob(name)
+        value = fn(current if current is not None else empty)
+        if value is None:
+            return current
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        try:
+            if etag:
+                bc.upload_blob(data, overwrite=True, etag=etag,
+                               match_condition=MatchConditions.IfNotModified)
+            else:
+                bc.upload_blob(data, overwrite=True, etag="*",
+                               match_condition=MatchConditions.IfMissing)
+            return value
+        except (ResourceModifiedError, ResourceExistsError):
+            time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+    raise RuntimeError(f"{name} の更新が競合し続けました。")
+
+
+# ========== 書き込みの後回し（ライトビハインド） ==========
+class WriteBehindQueue:
+    """
+    保存したい行をローカルのジャーナル（JSON Lines）に書いてすぐ返し、
+    バックグラウンドのスレッドが種類ごとにまとめて flush(kind, rows) で Blob に書く。
+
+    - 失敗したら待ち時間を延ばしながら再試行する（行はジャーナルとキューに残る）
+    - プロセスが落ちても、次に起動したプロセスが持ち主のいないジャーナルを読み直して書く
+    - 終了時（atexit）に残りを書き切る
+    書き込みは「少なくとも1回」なので、flush 側は同じ行が2回来ても困らないようにしておくこと
+    （履歴は id で重複を除いて読む）。
+    """
+
+    def __init__(self, directory: str, flush, batch_size: int = 200,
+                 interval: float = 1.0, max_backoff: float = 60.0):
+        self.directory = directory
+        self.flush = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._cond = threading.Condition()
+        self._pending: list = []   # [(受付時刻, kind, row), ...]（古い順）
+        self._closed = False
+        self._stats = {"flushed_rows": 0, "flushed_batches": 0, "failures": 0,
+                       "last_flush_at": None, "last_error": None}
+
+        os.makedirs(directory, exist_ok=True)
+        self._journal_path = os.path.join(directory, f"journal-{uuid.uuid4().hex}.jsonl")
+        self._journal = open(self._journal_path, "a", encoding="utf-8")
+        if fcntl is not None:
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)  # 生きている間はこのプロセスのもの
+        self._adopt_orphans()
+
+        self._thread = threading.Thread(target=self._loop, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ---- ジャーナル ----
+    def _write_journal(self, entries: list) -> None:
+        for at, kind, row in entries:
+            self._journal.write(json.dumps({"at": at, "kind": kind, "row": row}, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _rewrite_journal(self) -> None:
+        """書き終えた行を消す（残っている行だけで書き直す）"""
+        self._journal.seek(0)
+        self._journal.truncate()
+        self._write_journal(self._pending)
+
+    def _adopt_orphans(self) -> None:
+        """前に落ちたプロセスが書き残したジャーナルを引き取る"""
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if path == self._journal_path or not name.startswith("journal-"):
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    if fcntl is not None:
+                        try:
+                            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except OSError:
+                            continue  # 持ち主のプロセスがまだ動いている
+                    entries = []
+                    for line in f:
+                        try:
+                            e = json.loads(line)
+                        except ValueError:
+                            continue  # 書きかけの最終行
+                        entries.append((e["at"], e["kind"], e["row"]))
+                    with self._cond:
+                        self._pending.extend(entries)
+                        self._write_journal(entries)
+                os.remove(path)
+                if entries:
+                    print(f"[WriteBehindQueue] {name} から {len(entries)} 件を引き取りました")
+            except OSError as e:
+                print("[WriteBehindQueue] adopt error:", name, e)
+
+    # ---- 受付 ----
+    def submit(self, kind: str, rows: list) -> None:
+        """rows をジャーナルに書いてキューに積む（Blob への書き込みは待たない）"""
+        if not rows:
+            return
+        now = time.time()
+        entries = [(now, kind, row) for row in rows]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WriteBehindQueue は閉じられています。")
+            self._write_journal(entries)
+            self._pending.extend(entries)
+            self._cond.notify()
+
+    @property
+    def stats(self) -> dict:
+        """depth: 未書き込みの行数 / lag_seconds: 一番古い未書き込みの行の待ち時間"""
+        with self._cond:
+            oldest = self._pending[0][0] if self._pending else None
+            return {**self._stats, "depth": len(self._pending),
+                    "lag_seconds": time.time() - oldest if oldest is not None else 0.0}
+
+    # ---- 書き込み ----
+    def _take_batch(self):
+        """一番古い行と同じ種類の行を batch_size 件まで取り出す（キューからはまだ消さない）"""
+        kind = self._pending[0][1]
+        return kind, [e for e in self._pending if e[1] == kind][: self.batch_size]
+
+    def _flush_once(self) -> bool:
+        with self._cond:
+            if not self._pending:
+                return True
+            kind, batch = self._take_batch()
+        try:
+            self.flush(kind, [row for _, _, row in batch])
+        except Exception as e:
+            with self._cond:
+                self._stats["failures"] += 1
+                self._stats["last_error"] = f"{type(e).__name__}: {e}"
+            print("[WriteBehindQueue] flush error:", kind, e)
+            return False
+        done = {id(e) for e in batch}
+        with self._cond:
+            self._pending = [e for e in self._pending if id(e) not in done]
+            self._rewrite_journal()
+            self._stats["flushed_rows"] += len(batch)
+            self._stats["flushed_batches"] += 1
+            self._stats["last_flush_at"] = time.time()
+            self._stats["last_error"] = None
+            self._cond.notify_all()
+        return True
+
+    def _loop(self) -> None:
+        backoff = self.interval
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return  # 閉じられて、書き残しも無い
+                if not self._closed:
+                    # 少しだけ待って、続けて来る行を同じバッチにまとめる
+                    self._cond.wait(self.interval)
+            if self._flush_once():
+                backoff = self.interval
+            else:
+                time.sleep(min(backoff, 1.0) if self._closed else backoff * random.uniform(0.5, 1.0))
+                backoff = min(self.max_backoff, backoff * 2)
+
+    def drain(self, timeout: float = 30.0) -> bool:
+        """キューが空になるまで待つ（空になれば True）"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 30.0) -> None:
+        """残りを書き切ってから止める。書き切れなかった行はジャーナルに残り、次のプロセスが引き取る"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return
+        with self._cond:
+            empty = not self._pending
+            self._journal.close()
+        if empty:
+            try:
+                os.remove(self._journal_path)
+            except OSError:
+                pass
+
+
+# ========== バックグラウンドジョブ ==========
+class Job:
+    """
+    ジョブ表の1行。status は "queued" → "running" → "done" / "failed"。
+    実行中の関数は stage（今の段階）と partial（途中経過の文字列）を書き換えてよい。
+    warning は終わったけれど一部がうまくいかなかったとき（保存の失敗など）の知らせ。
+    """
+
+    def __init__(self, owner: str, label: str):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.label = label
+        self.status = "queued"
+        self.stage = "待機中"
+        self.partial = ""
+        self.result = None
+        self.error = None
+        self.warning = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def markdown(self, text: str) -> None:
+        """st.empty() の代わりに渡すと、ストリーミングの途中経過を partial に残す"""
+        self.partial = text
+
+
+class JobRunner:
+    """
+    スレッドプールでジョブを流し、状態をジョブ表（プロセスで共有）に持つ。
+    画面側は表を見るだけなので、Streamlit の再実行やタブ移動で処理が止まらない。
+    終わったジョブは retain_seconds だけ表に残す。
+    """
+
+    def __init__(self, max_workers: int = 4, retain_seconds: float = 3600):
+        self.retain_seconds = retain_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, owner: str = "", label: str = "") -> str:
+        """fn(job, *args) をジョブとして積み、ジョブ ID を返す。fn の戻り値が job.result になる"""
+        job = Job(owner, label)
+        with self._lock:
+            self._prune_locked()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn, args)
+        return job.id
+
+    def _run(self, job: Job, fn, args) -> None:
+        job.status, job.stage, job.started_at = "running", "実行中", time.time()
+        try:
+            job.result = fn(job, *args)
+            job.status = "done"
+        except Exception as e:
+            print("[JobRunner] job failed:", job.label, e)
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+
+    def _prune_locked(self) -> None:
+        cutoff = time.time() - self.retain_seconds
+        for job_id in [k for k, j in self._jobs.items() if j.finished and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self, owner: str | None = None) -> list:
+        """ジョブ（古い順）。owner を渡すとその持ち主の分だけ"""
+        with self._lock:
+            return [j for j in self._jobs.values() if owner is None or j.owner == owner]
+
+    def counts(self) -> dict:
+        """状態ごとの件数"""
+        out = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        with self._lock:
+            for j in self._jobs.values():
+                out[j.status] += 1
+        return out
+
+
+# ========== 進捗の集計（ロールアップ） ==========
+class Rollups:
+    """
+    進捗タブ用の集計（日 × 科目の件数・科目別の累計・クイズの回数と正答数）。
+    小さな JSON として Blob に置き、記録やクイズ結果を保存するたびに O(1) で足し込む。
+    足し込んだ行の id も applied に APPLIED_KEEP_SECONDS だけ残し、同じ行を2回数えないようにする。
+    """
+
+    APPLIED_KEEP_SECONDS = 7 * 86400
+
+    def __init__(self, data: dict | None = None):
+        self.data = data or self.empty()
+
+    @staticmethod
+    def empty() -> dict:
+        return {
+            "version": 1,
+            "total": 0,
+            "subjects": {},
+            "days": {},
+            "quiz": {"count": 0, "questions": 0, "answered": 0, "correct": 0, "subjects": {}},
+            "applied": {},
+        }
+
+    def first_seen(self, ids, now: float | None = None) -> set:
+        """
+        ids のうち、まだ足し込んでいないものを返して記録する
+        （ライトビハインドのジャーナルを再生して同じ行がもう一度来ても、2回は数えない）。
+        """
+        now = int(time.time() if now is None else now)
+        applied = self.data.setdefault("applied", {})
+        cutoff = now - self.APPLIED_KEEP_SECONDS
+        for k in [k for k, at in applied.items() if at < cutoff]:
+            del applied[k]
+        fresh = {i for i in ids if i and i not in applied}
+        for i in fresh:
+            applied[i] = now
+        return fresh
+
+    def bump(self, records=(), quiz_logs=(), n: int = 1, now: float | None = None) -> bool:
+        """
+        records・quiz_logs の分を足す（n=-1 で引く）。変わったら True。
+        id のある行は足す・引くをそれぞれ1回だけ数える（引いた印は "-:id" で applied に残す）。
+        """
+        recs, logs = list(records), list(quiz_logs)
+
+        def _key(x):
+            rid = x.get("id") if isinstance(x, dict) else getattr(x, "id", None)
+            if not rid:
+                return None
+            return str(rid) if n > 0 else f"-:{rid}"
+
+        fresh = self.first_seen([_key(x) for x in recs + logs], now)
+
+        def _once(items):
+            out = []
+            for x in items:
+                k = _key(x)
+                if k is None or k in fresh:
+                    fresh.discard(k)  # 同じ呼び出しの中で同じ行が2回来ても1回だけ
+                    out.append(x)
+            return out
+
+        recs, logs = _once(recs), _once(logs)
+        for rec in recs:
+            self.add_record(rec.created_at, rec.subject, n)
+        for log in logs:
+            self.add_quiz(log, n)
+        return bool(recs or logs)
+
+    @staticmethod
+    def _day(created_at) -> str:
+        return str(created_at or "")[:10] or "unknown"
+
+    def add_record(self, created_at, subject, n: int = 1) -> None:
+        """n=-1 で削除分を引く"""
+        subject = subject or "未分類"
+        d = self.data
+        d["total"] += n
+        d["subjects"][subject] = d["subjects"].get(subject, 0) + n
+        if d["subjects"][subject] <= 0:
+            del d["subjects"][subject]
+        key = self._day(created_at)
+        day = d["days"].setdefault(key, {})
+        day[subject] = day.get(subject, 0) + n
+        if day[subject] <= 0:
+            del day[subject]
+            if not day:
+                del d["days"][key]
+
+    def add_quiz(self, log, n: int = 1) -> None:
+        """n=-1 で削除分を引く"""
+        q = self.data["quiz"]
+        total, answered, correct = int(log["total"] or 0), int(log["answered"] or 0), int(log["correct_count"] or 0)
+        q["count"] += n
+        q["questions"] += n * total
+        q["answered"] += n * answered
+        q["correct"] += n * correct
+        per = q["subjects"].setdefault(log["subject"] or "未分類", {"count": 0, "questions": 0, "correct": 0})
+        per["count"] += n
+        per["questions"] += n * total
+        per["correct"] += n * correct
+
+    @classmethod
+    def build(cls, records: pd.DataFrame | None, quiz: pd.DataFrame | None, now: float | None = None) -> "Rollups":
+        """
+        履歴の全件から作り直す（ロールアップがまだ無いとき・壊れたときに1回だけ）。
+        数えた行のうち直近 APPLIED_KEEP_SECONDS の分の id を applied に入れ、
+        作り直しの前後に届いた足し込みで同じ行を2回数えないようにする（古い行の id は入れても期限で消えるだけ）。
+        """
+        now = int(time.time() if now is None else now)
+        r = cls()
+        d = r.data
+        cutoff = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now - cls.APPLIED_KEEP_SECONDS))
+        for df in (records, quiz):
+            if df is not None and len(df) and "id" in df.columns and "created_at" in df.columns:
+                recent = df[df["created_at"].astype(str) >= cutoff]
+                d["applied"].update((str(i), now) for i in recent["id"].dropna() if str(i))
+        if records is not None and len(records):
+            df = pd.DataFrame({
+                "day": records["created_at"].astype(str).str[:10],
+                "subject": records["subject"].fillna("未分類").replace("", "未分類"),
+            })
+            d["total"] = int(len(df))
+            d["subjects"] = {k: int(v) for k, v in df["subject"].value_counts().items()}
+            for (day, subject), n in df.groupby(["day", "subject"]).size().items():
+                d["days"].setdefault(day, {})[subject] = int(n)
+        if quiz is not None and len(quiz):
+            for _, log in quiz.fillna(0).iterrows():
+                r.add_quiz(log)
+        return r
+
+    def summary(self, today) -> dict:
+        """進捗タブに出す値（日付の窓は直近30日だけを見るので、履歴の長さに関係なく一定時間）"""
+        d = self.data
+        days = d["days"]
+        labels, values = [], []
+        for k in range(29, -1, -1):
+            day = (today - timedelta(days=k)).isoformat()
+            n = sum(days.get(day, {}).values())
+            if n:
+                labels.append(day)
+                values.append(n)
+        recent7 = sum(
+            sum(days.get((today - timedelta(days=k)).isoformat(), {}).values()) for k in range(8)
+        )
+        subjects = sorted(d["subjects"].items(), key=lambda kv: kv[1], reverse=True)
+        q = d["quiz"]
+        return {
+            "total": d["total"],
+            "recent7": recent7,
+            "daily": (tuple(labels), tuple(values)),
+            "subjects": (tuple(k for k, _ in subjects), tuple(v for _, v in subjects)),
+            "quiz_count": q["count"],
+            "quiz_rate": (q["correct"] / q["questions"] * 100) if q["questions"] else None,
+        }
+
+
+# ========== 間隔反復（SM-2） ==========
+class ReviewScheduler:
+    """
+    ノートごとの間隔反復（SM-2 簡易）の状態と、科目ごとの next_due の優先度付きキュー。
+    状態は {レコードID: [科目, ef, interval, streak, next_due(日付の序数), last]} の形で保存する。
+    スナップショットとして全セッションで共有するので、作ったあとは書き換えない
+    （更新は apply で保存用の items に対して行い、作り直す）。
+    """
+
+    def __init__(self, items: dict | None = None):
+        self.items = items or {}
+        self._heaps: dict = {}
+        for rid, (subject, _ef, _interval, _streak, due, _last) in self.items.items():
+            self._heaps.setdefault(subject, []).append((due, rid))
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+
+    def __contains__(self, rid) -> bool:
+        return rid in self.items
+
+    def state(self, rid) -> dict | None:
+        item = self.items.get(rid)
+        if item is None:
+            return None
+        subject, ef, interval, streak, due, last = item
+        return {"subject": subject, "ef": ef, "interval": interval, "streak": streak,
+                "next_due": date.fromordinal(due), "last": last}
+
+    def due(self, subject: str, today: date, limit: int | None = None) -> list:
+        """
+        subject のうち today までに期限が来たレコード ID を期限の古い順に返す。
+        ヒープ配列を根から辿るだけなので O(k log k)（k = 返す件数）で、ヒープ自体は変えない。
+        """
+        heap = self._heaps.get(subject)
+        if not heap:
+            return []
+        today_n = today.toordinal()
+        out: list = []
+        frontier = [(heap[0], 0)]
+        while frontier and (limit is None or len(out) < limit):
+            (due, rid), i = heapq.heappop(frontier)
+            if due > today_n:
+                break
+            out.append(rid)
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+        return out
+
+    def seeded(self, notes) -> "ReviewScheduler":
+        """
+        notes: (レコードID, 科目) の並び。まだ一度も復習していないノートを
+        next_due=0（いつでも期限）で入れたスケジューラを新しく作って返す。
+        """
+        items = dict(self.items)
+        for rid, subject in notes:
+            if rid not in items:
+                items[rid] = [subject, 2.5, 1, 0, 0, None]
+        return ReviewScheduler(items)
+
+    @staticmethod
+    def apply(items: dict, rid, subject: str, quality: int, today: date) -> None:
+        """items の rid に1回分の復習結果（quality: 0〜5）を反映する"""
+        _, ef, interval, streak, _, _ = items.get(rid) or (subject, 2.5, 1, 0, 0, None)
+        ef = ef + (0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+        ef = max(1.3, min(2.8, ef))
+        streak = 0 if quality < 3 else streak + 1
+        if streak <= 1:
+            interval = 1
+        elif streak == 2:
+            interval = 2
+        else:
+            interval = math.ceil(interval * ef)
+        items[rid] = [subject, round(ef, 3), interval, streak, today.toordinal() + interval, quality]
+
+    @staticmethod
+    def move(items: dict, rid, subject: str) -> bool:
+        """items の rid を別の科目のキューへ付け替える（間隔などの状態はそのまま）。変えたら True"""
+        item = items.get(rid)
+        if item is None or item[0] == subject:
+            return False
+        items[rid] = [subject] + list(item[1:])
+        return True
+
+    @staticmethod
+    def forget(items: dict, rid) -> bool:
+        """items から rid を消す（ノートを削除したとき）。消したら True"""
+        return items.pop(rid, None) is not None
+
+
+# ========== クイズバンク ==========
+class QuizBank:
+    """
+    科目ごとに事前生成しておくクイズ問題（Blob 上の JSON 1つ／科目）。
+    各問題は出題元ノートの ID と内容ハッシュ（source_hash）を持ち、
+    ノートが消えたり書き換わったりした問題は valid() で外れる。
+    """
+
+    def __init__(self, prefix: str = "quiz_bank", max_questions: int = 60):
+        self.prefix = prefix.rstrip("/")
+        self.max_questions = max_questions
+
+    def blob_name(self, subject: str) -> str:
+        return f"{self.prefix}/{hashlib.sha1(subject.encode('utf-8')).hexdigest()[:16]}.json"
+
+    @staticmethod
+    def note_hash(text: str) -> str:
+        return hashlib.sha1((text or "").encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def valid(questions: list, note_hashes: dict) -> list:
+        """出題元ノートがすべて今も同じ内容で残っている問題だけを返す"""
+        return [
+            q for q in questions
+            if q.get("source_ids")
+            and all(note_hashes.get(rid) == q.get("source_hash", {}).get(rid) for rid in q["source_ids"])
+        ]
+
+    def load_bank(self, subject: str) -> dict:
+        bank, _ = read_json_blob(self.blob_name(subject))
+        return bank or {}
+
+    def load(self, subject: str) -> list:
+        return self.load_bank(subject).get("questions", [])
+
+    def merge(self, subject: str, new_questions: list, note_hashes: dict, key, cursor: int | None = None) -> list:
+        """無効になった問題を捨て、新しい問題を（key で重複を除いて）足して保存する。cursor は次に巡回を始める位置"""
+
+        def _apply(bank: dict) -> dict:
+            kept = self.valid(bank.get("questions", []), note_hashes)
+            seen = {key(q) for q in kept}
+            added = []
+            for q in new_questions:
+                k = key(q)
+                if k not in seen:
+                    seen.add(k)
+                    added.append(q)
+            # 上限を超えたら古い問題から落とす（今回足した問題は落とさない）
+            added = added[-self.max_questions:]
+            kept = kept[max(0, len(kept) + len(added) - self.max_questions):] + added
+            out = {"subject": subject, "updated_at": time.time(), "questions": kept}
+            if cursor is not None or "cursor" in bank:
+                out["cursor"] = cursor if cursor is not None else bank["cursor"]
+            return out
+
+        return update_json_blob(self.blob_name(subject), _apply, empty={})["questions"]
+
+    def top_up(self, subject: str, notes: list, generate, key, target: int, per_note: int = 3) -> list:
+        """
+        notes: [(レコードID, 本文)]。出題元が変わった問題を外し、target 問に足りない分だけ
+        generate(選んだノート, 問題数) で作って足す。足りていれば generate は呼ばない。
+        作る元のノートは、まだ問題の無いノートを優先して、前回の続き（cursor）から巡回して選ぶ（1ノート per_note 問まで）。
+        足した問題のリストを返す。
+        """
+        hashes = {rid: self.note_hash(t) for rid, t in notes}
+        bank = self.load_bank(subject)
+        current = bank.get("questions", [])
+        valid = self.valid(current, hashes)
+        need = target - len(valid)
+        if need <= 0 or not notes:
+            if len(valid) != len(current):
+                self.merge(subject, [], hashes, key)
+            return []
+
+        covered = {rid for q in valid for rid in q["source_ids"]}
+        pool = [note for note in notes if note[0] not in covered] or notes
+        count = min(len(pool), math.ceil(need / per_note))
+        start = int(bank.get("cursor", 0)) % len(pool)
+        picked = [pool[(start + i) % len(pool)] for i in range(count)]
+        now = time.strftime("%Y-%m-%dT%H:%M:%S")
+        new_questions = [
+            {**q, "source_hash": {rid: hashes[rid] for rid in q["source_ids"]}, "created_at": now}
+            for q in generate(picked, min(need, per_note * count))
+        ]
+        self.merge(subject, new_questions, hashes, key, cursor=start + count)
+        return new_questions
+
+
+# ========== LRU キャッシュ ==========
+class LruCache:
+    """上限付きの LRU（スレッドセーフ。プロセス内で共有して使う）"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, factory):
+        _missing = object()
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def __len__(self):
+        return len(self._data)
+
+
+# ========== ディスク / Blob キャッシュ ==========
+class DiskLruCache:
+    """
+    ローカルディスク上の上限付き LRU（値は bytes）。
+    合計サイズが max_bytes を超えたら、最後に使われたのが古いものから消す。
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # key → サイズ（古い順）
+        self._total = 0
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st_ = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st_.st_mtime, name, st_.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total += size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex[:6]}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._total += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_key, size = self._entries.popitem(last=False)
+                self._total -= size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._total -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class BlobCache:
+    """Blob 上の共有キャッシュ（全インスタンスで共有。値は bytes）"""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix.rstrip("/")
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            return _download_bytes(f"{self.prefix}/{key}")
+        except ResourceNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes) -> None:
+        _upload_bytes(f"{self.prefix}/{key}", data, overwrite=True)
+
+    def delete(self, key: str) -> None:
+        _delete_blob_quietly(f"{self.prefix}/{key}")
+
+
+class TieredCache:
+    """ローカル(ディスク) → 共有(Blob) の順に引くキャッシュ。ヒット・ミス数を数える"""
+
+    def __init__(self, local: DiskLruCache, shared: BlobCache | None = None):
+        self.local = local
+        self.shared = shared
+        self.stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key: str) -> bytes | None:
+        data = self.local.get(key)
+        if data is not None:
+            self._count("local_hits")
+            return data
+        if self.shared is not None:
+            try:
+                data = self.shared.get(key)
+            except Exception as e:
+                print("[TieredCache] shared get error:", e)
+                data = None
+            if data is not None:
+                self.local.put(key, data)
+                self._count("shared_hits")
+                return data
+        self._count("misses")
+        return None
+
+    def put(self, key: str, data: bytes) -> None:
+        self.local.put(key, data)
+        if self.shared is not None:
+            try:
+                self.shared.put(key, data)
+            except Exception as e:
+                print("[TieredCache] shared put error:", e)
+
+    def delete(self, key: str) -> None:
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+
+class ResponseCache:
+    """
+    LLM 応答のキャッシュ（リクエストの指紋 → 応答テキスト）。
+    TTL を過ぎたものは使わず、ディスク LRU に保存するので再起動後も残る。
+    よく使うものはメモリ上の LRU からも引く。
+    """
+
+    def __init__(self, directory: str, ttl_seconds: float, max_bytes: int = 64 * 1024 * 1024,
+                 memory_items: int = 256):
+        self.ttl_seconds = ttl_seconds
+        self.disk = DiskLruCache(directory, max_bytes)
+        self.memory = LruCache(memory_items)
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def fingerprint(**parts) -> str:
+        """メッセージ・デプロイ名・API バージョン・サンプリング設定などから指紋を作る"""
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, fp: str) -> str | None:
+        entry = self.memory.get(fp)
+        if entry is None:
+            raw = self.disk.get(fp)
+            entry = json.loads(raw.decode("utf-8")) if raw else None
+        if entry is None or time.time() - entry["created"] > self.ttl_seconds:
+            self.stats["misses"] += 1
+            return None
+        self.memory.put(fp, entry)
+        self.stats["hits"] += 1
+        return entry["content"]
+
+    def put(self, fp: str, content: str) -> None:
+        entry = {"created": time.time(), "content": content}
+        self.memory.put(fp, entry)
+        self.disk.put(fp, json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+
+
+def content_key(data: bytes, *parts) -> str:
+    """内容（bytes）と付帯情報から SHA-256 のキーを作る"""
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(str(p).encode("utf-8"))
+        h.update(b"\0")
+    h.update(data)
+    return h.hexdigest()
+
+
+# ========== 列指向レコードストア ==========
+_EMPTY_META = MappingProxyType({})
+
+
+class RecordRow:
+    """RecordStore の1行を指す軽量ビュー（rec.subject でも log["subject"] でも読める）"""
+
+    __slots__ = ("_store", "_i")
+
+    def __init__(self, store: "RecordStore", i: int):
+        self._store = store
+        self._i = i
+
+    def __getattr__(self, name):
+        try:
+            return self._store.value(name, self._i)
+        except KeyError:
+            if name == "meta":
+                return _EMPTY_META
+            raise AttributeError(name) from None
+
+    def __getitem__(self, name):
+        return self._store.value(name, self._i)
+
+    def get(self, name, default=None):
+        try:
+            return self._store.value(name, self._i)
+        except KeyError:
+            return default
+
+    def to_dict(self) -> dict:
+        return {c: self._store.value(c, self._i) for c in self._store.columns}
+
+    def __repr__(self):
+        return f"RecordRow({self.to_dict()!r})"
+
+
+class RecordStore:
+    """
+    読み取り専用の列指向レコード集合（列ごとに numpy 配列）。
+    DataFrame から iterrows を使わずに作り、絞り込み・並べ替え・集計は列のまま行う。
+    """
+
+    __slots__ = ("_cols", "_defaults", "_n", "_keys", "_key", "_pos", "_derived")
+
+    def __init__(self, cols: dict, defaults: dict | None = None, key: str = "id"):
+        self._cols = cols
+        self._defaults = dict(defaults or {})
+        self._n = len(next(iter(cols.values()))) if cols else 0
+        self._key = key
+        self._keys = None
+        self._pos = None
+        self._derived = {}
+
+    @classmethod
+    def empty(cls, schema: dict, key: str = "id") -> "RecordStore":
+        return cls.from_frame(None, schema, key=key)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame | None, schema: dict, key: str = "id") -> "RecordStore":
+        """
+        schema: 列名 → 既定値。既定値の型（str / int / float）に合わせて列を変換する。
+        """
+        cols = {}
+        n = 0 if df is None else len(df)
+        for name, default in schema.items():
+            if df is not None and name in df.columns:
+                col = df[name]
+                if isinstance(default, str):
+                    col = col.fillna(default).astype(str)
+                    if default:
+                        col = col.str.strip().replace("", default)
+                    arr = col.to_numpy(dtype=object)
+                else:
+                    arr = pd.to_numeric(col, errors="coerce").fillna(default).to_numpy(
+                        dtype=type(default))
+            else:
+                arr = np.full(n, default, dtype=object if isinstance(default, str) else type(default))
+            cols[name] = arr
+        return cls(cols, defaults=schema, key=key)
+
+    # ---- 基本 ----
+    def __len__(self):
+        return self._n
+
+    def __bool__(self):
+        return self._n > 0
+
+    def __iter__(self):
+        for i in range(self._n):
+            yield RecordRow(self, i)
+
+    def __getitem__(self, i: int) -> RecordRow:
+        if i < 0:
+            i += self._n
+        if not 0 <= i < self._n:
+            raise IndexError(i)
+        return RecordRow(self, i)
+
+    @property
+    def columns(self) -> list:
+        return list(self._cols)
+
+    @property
+    def key(self) -> str:
+        return self._key
+
+    def value(self, name: str, i: int):
+        col = self._cols.get(name)
+        if col is None:
+            if name in self._defaults:
+                return self._defaults[name]
+            raise KeyError(name)
+        v = col[i]
+        return v.item() if isinstance(v, np.generic) else v
+
+    def column(self, name: str) -> np.ndarray:
+        col = self._cols.get(name)
+        if col is None:
+            return np.full(self._n, self._defaults.get(name, ""), dtype=object)
+        return col
+
+    @property
+    def keys(self) -> frozenset:
+        """キー列（既定は id）の集合（初回だけ作る）"""
+        if self._keys is None:
+            self._keys = frozenset(self.column(self._key).tolist())
+        return self._keys
+
+    def positions(self, keys) -> np.ndarray:
+        """キーの並びに対応する行番号（このストアに無いキーは飛ばす）"""
+        if self._pos is None:
+            self._pos = {k: i for i, k in enumerate(self.column(self._key).tolist())}
+        pos = self._pos
+        return np.fromiter((pos[k] for k in keys if k in pos), dtype=np.int64)
+
+    def derived(self, name: str, build):
+        """このストアから作る索引などを1回だけ作って保持する（ストアは不変なので作り直し不要）"""
+        value = self._derived.get(name)
+        if value is None:
+            value = self._derived[name] = build(self)
+        return value
+
+    def seed_derived(self, name: str, value) -> None:
+        self._derived[name] = value
+
+    # ---- 列のままの操作 ----
+    def take(self, idx) -> "RecordStore":
+        idx = np.asarray(idx, dtype=np.int64)
+        return RecordStore({k: v[idx] for k, v in self._cols.items()}, self._defaults, self._key)
+
+    def where(self, mask) -> "RecordStore":
+        return self.take(np.flatnonzero(mask))
+
+    def argsort(self, name: str, reverse: bool = False) -> np.ndarray:
+        order = np.argsort(self.column(name).astype(str), kind="stable")
+        return order[::-1] if reverse else order
+
+    def frame(self, columns: list | None = None) -> pd.DataFrame:
+        """列をそのまま渡して DataFrame を作る（行オブジェクトを経由しない）"""
+        names = columns or self.columns
+        return pd.DataFrame({c: self.column(c) for c in names})
+
+    def extend(self, rows: list) -> "RecordStore":
+        """rows (dict / 属性を持つオブジェクト) を末尾に足した新しいストアを返す"""
+        if not rows:
+            return self
+        extra = {c: [] for c in self._cols}
+        for r in rows:
+            for c in self._cols:
+                if isinstance(r, dict):
+                    v = r.get(c, self._defaults.get(c, ""))
+                else:
+                    v = getattr(r, c, self._defaults.get(c, ""))
+                extra[c].append(v)
+        cols = {
+            c: np.concatenate([v, np.asarray(extra[c], dtype=v.dtype)])
+            for c, v in self._cols.items()
+        }
+        return RecordStore(cols, self._defaults, self._key)
+
+
+class TimeSubjectIndex:
+    """
+    created_at 順に並べた行番号と、科目ごとのバケット（バケット内も created_at 順）。
+    期間フィルタは bisect、科目フィルタはバケットを引くだけで済む。
+    """
+
+    NAME = "time_subject"
+
+    def __init__(self, store: RecordStore | None = None):
+        self.keys: list = []
+        self.order = np.empty(0, dtype=np.int64)
+        self.buckets: dict = {}
+        if store is None or not len(store):
+            return
+        created = store.column("created_at").astype(str)
+        order = np.argsort(created, kind="stable")
+        self.keys = created[order].tolist()
+        self.order = order
+        subjects = store.column("subject")[order]
+        for subj in set(subjects.tolist()):
+            sel = np.flatnonzero(subjects == subj)
+            self.buckets[subj] = ([self.keys[i] for i in sel], order[sel])
+
+    def with_rows(self, store: RecordStore, positions) -> "TimeSubjectIndex":
+        """store の positions 行を差し込んだ新しい索引を返す（元の索引は共有なので変更しない）"""
+        out = TimeSubjectIndex()
+        keys, order = list(self.keys), self.order.tolist()
+        buckets = {s: (list(k), v.tolist()) for s, (k, v) in self.buckets.items()}
+        created = store.column("created_at")
+        subjects = store.column("subject")
+        for p in positions:
+            key, subj = str(created[p]), subjects[p]
+            i = bisect.bisect_right(keys, key)
+            keys.insert(i, key)
+            order.insert(i, p)
+            bkeys, bpos = buckets.setdefault(subj, ([], []))
+            j = bisect.bisect_right(bkeys, key)
+            bkeys.insert(j, key)
+            bpos.insert(j, p)
+        out.keys, out.order = keys, np.asarray(order, dtype=np.int64)
+        out.buckets = {s: (k, np.asarray(v, dtype=np.int64)) for s, (k, v) in buckets.items()}
+        return out
+
+    def select(self, start: str | None = None, subject: str | None = None) -> np.ndarray:
+        """created_at >= start（かつ科目が subject）の行番号を新しい順で返す"""
+        if subject is None:
+            keys, pos = self.keys, self.order
+        else:
+            keys, pos = self.buckets.get(subject, ([], np.empty(0, dtype=np.int64)))
+        lo = bisect.bisect_left(keys, start) if start else 0
+        return pos[lo:][::-1]
+
+
+class HistoryOverlay:
+    """
+    セッションごとの履歴ビュー。
+    共有スナップショット（RecordStore・全セッション共通）＋ このセッションで追加した分 だけを持つ。
+    """
+
+    def __init__(self, key: str = "id"):
+        self.key = key
+        self.base: RecordStore = RecordStore({}, key=key)
+        self.base_version = None
+        self.added: list = []
+        self.hidden: set = set()
+        self._view = None
+
+    def _key_of(self, item):
+        return item.get(self.key) if isinstance(item, dict) else getattr(item, self.key, None)
+
+    @property
+    def version(self) -> tuple:
+        """中身が変わったら変わる値（集計結果のキャッシュキーに使う）"""
+        return (self.base_version, id(self.base), len(self.added), len(self.hidden))
+
+    def rebase(self, version, store: RecordStore) -> None:
+        """スナップショットが更新されたら差し替え、取り込まれた追加分は重複しないよう外す"""
+        if version == self.base_version and store is self.base:
+            return
+        self.base, self.base_version = store, version
+        keys = store.keys
+        self.added = [x for x in self.added if self._key_of(x) not in keys]
+        self._view = None
+
+    def add(self, item) -> None:
+        if self._key_of(item) in self.base.keys:
+            return  # もうスナップショットに入っている
+        self.added.append(item)
+        self._view = None
+
+    def append(self, item) -> None:
+        self.add(item)
+
+    def hide(self, key) -> None:
+        """このセッションの表示から外す"""
+        self.hidden.add(key)
+        self._view = None
+
+    def view(self) -> RecordStore:
+        """スナップショット＋追加分−非表示 の RecordStore（追加・非表示が無ければ共有のものをそのまま返す）"""
+        if self._view is None:
+            view = self.base.extend(self.added) if self.added else self.base
+            if self.added and not self.hidden:
+                # 共有側の時刻索引に追加分だけ差し込む（全件の並べ替えはしない）
+                base_index = self.base.derived(TimeSubjectIndex.NAME, TimeSubjectIndex)
+                view.seed_derived(TimeSubjectIndex.NAME,
+                                  base_index.with_rows(view, range(len(self.base), len(view))))
+            if self.hidden:
+                view = view.where(~np.isin(view.column(self.key), list(self.hidden)))
+            self._view = view
+        return self._view
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __reversed__(self):
+        view = self.view()
+        return (view[i] for i in range(len(view) - 1, -1, -1))
+
+    def __len__(self):
+        return len(self.view())
+
+    def __bool__(self):
+        return len(self.view()) > 0
+
+
+# ========== キーワード検索（n-gram 転置インデックス） ==========
+class NgramIndex:
+    """
+    文字 n-gram の転置インデックス（形態素解析なしで日本語の部分一致を絞り込む）。
+    token_pattern に合う文字の並びだけから n-gram を作り、1文字の検索語用に 1-gram も持つ。
+    候補は最後に部分文字列で確認するので、結果は素朴な部分一致と同じになる。
+
+    常に持つのは転置リストと doc_id ごとの signature だけ。本文は上限付きのキャッシュに置き、
+    最後の確認で足りない候補の本文は loader から取り直す。
+    削除・入れ直しのときに古い n-gram の転置リストからは外さない（余分な候補は最後の確認で落ちる）。
+    """
+
+    def __init__(self, token_pattern, n: int = 2, cache_size: int = 2000):
+        self.token_pattern = token_pattern
+        self.n = n
+        self._postings: dict = {}
+        self._sigs: dict = {}  # doc_id → 索引に入れたときの signature（変わったら入れ直す）
+        self._cache = LruCache(cache_size)  # doc_id → 小文字にした本文
+        self._synced = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def _grams(self, text: str) -> set:
+        grams = set()
+        n = self.n
+        for run in self.token_pattern.findall(text):
+            grams.update(run)
+            for i in range(len(run) - n + 1):
+                grams.add(run[i:i + n])
+        return grams
+
+    @staticmethod
+    def _doc(fields) -> str:
+        return " ".join(str(f or "") for f in fields).lower()
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._sigs
+
+    def __len__(self):
+        return len(self._sigs)
+
+    def add(self, doc_id, *fields, sig=None) -> None:
+        """1件追加（かかる時間はその1件の文字数だけ。履歴の件数には依存しない）"""
+        doc = self._doc(fields)
+        grams = self._grams(doc)
+        with self._lock:
+            for g in grams:
+                self._postings.setdefault(g, set()).add(doc_id)
+            self._sigs[doc_id] = sig
+        self._cache.put(doc_id, doc)
+
+    def remove(self, doc_id) -> None:
+        with self._lock:
+            self._sigs.pop(doc_id, None)
+        self._cache.pop(doc_id)
+
+    def loader(self, store: RecordStore, fields: tuple, text_loader=None):
+        """store の行から本文を作る関数（doc_id の並び → {doc_id: 本文}）を返す。search の loader に渡す"""
+        def load(doc_ids) -> dict:
+            positions = store.positions(doc_ids)
+            ids = store.column(store.key)[positions].tolist()
+            return dict(zip(ids, self._docs_at(store, positions, fields, text_loader)))
+        return load
+
+    def _docs_at(self, store: RecordStore, positions, fields: tuple, text_loader) -> list:
+        cols = {f: store.column(f)[positions] for f in fields}
+        if text_loader is not None and "text" in cols:
+            ids = store.column(store.key)[positions]
+            lazy = [rid for rid, t in zip(ids, cols["text"]) if not t]
+            texts = text_loader(lazy) if lazy else {}
+            cols["text"] = [t or texts.get(rid, "") for rid, t in zip(ids, cols["text"])]
+        return [self._doc(row) for row in zip(*(cols[f] for f in fields))]
+
+    def sync(self, store: RecordStore, fields: tuple, text_loader=None, signature: tuple = (),
+             batch: int = 500) -> None:
+        """
+        store にあってまだ索引に無い行と、signature の列の値が索引に入れたときから変わった行
+        （他のプロセスで修正されたノートなど）だけを入れ直す。signature を省くと fields で比べる。
+        text_loader: id の並び → {id: 全文}。全文は batch 件ずつ読み、索引に入れたら手放す。
+        """
+        if self._synced is store:
+            return
+        with self._sync_lock:  # バックグラウンドの先読みと検索が同じ行を二重に読まないように
+            if self._synced is store:
+                return
+            ids = store.column(store.key).tolist()
+            sigs = [hash(v) for v in zip(*(store.column(c).tolist() for c in (signature or fields)))]
+            with self._lock:
+                stale = [i for i, (k, sig) in enumerate(zip(ids, sigs)) if self._sigs.get(k) != sig]
+            for start in range(0, len(stale), batch):
+                positions = np.asarray(stale[start:start + batch], dtype=np.int64)
+                for i, doc in zip(positions, self._docs_at(store, positions, fields, text_loader)):
+                    self.add(ids[i], doc, sig=sigs[i])
+            self._synced = store
+
+    def search(self, q: str, rank: bool = False, loader=None) -> list:
+        """
+        q を部分文字列として含む doc_id のリスト（rank=True なら出現回数の多い順）。
+        loader: doc_id の並び → {doc_id: 本文}。キャッシュに無い候補の本文はここから取る
+        """
+        ql = (q or "").lower()
+        if not ql:
+            return []
+        grams = self._grams(ql)
+        # 検索語の中で一番長い並びの n-gram を使えば十分（1文字だけなら 1-gram）
+        longest = max(self.token_pattern.findall(ql), key=len, default="")
+        if len(longest) >= self.n:
+            grams = {g for g in grams if len(g) == self.n}
+        with self._lock:
+            if grams:
+                postings = sorted((self._postings.get(g, set()) for g in grams), key=len)
+                cands = set(postings[0])
+                for p in postings[1:]:
+                    if not cands:
+                        break
+                    cands &= p
+            else:
+                cands = set(self._sigs)  # 記号だけの検索語は全件を確認
+            cands = [d for d in cands if d in self._sigs]
+
+        docs: dict = {}
+        missing = []
+        for d in cands:
+            doc = self._cache.get(d)
+            if doc is None:
+                missing.append(d)
+            else:
+                docs[d] = doc
+        if missing and loader is not None:
+            for d, doc in loader(missing).items():
+                self._cache.put(d, doc)
+                docs[d] = doc
+        hits = [d for d in cands if ql in docs.get(d, "")]
+        if rank:
+            hits.sort(key=lambda d: docs[d].count(ql), reverse=True)
+        return hits